@@ -1,6 +1,13 @@
 #!/bin/bash
 #--------------------------------------------------------------
 # This script executes $SHELL_SCRIPT for $SUB and matlab $SCRIPT
+# fMRI/utils/batch_planner.py runs the same job for many subjects per
+# MATLAB session in one array job, and skips subjects that have SPM.mat, e.g.
+# python3 ../../utils/batch_planner.py plan -d fx_event_stage.json -s subject_list_test.txt --submit
+# first_level_glm.py fits the same kind of model in Python, for a whole cohort on one node, e.g.
+# OMP_NUM_THREADS=1 python3 first_level_glm.py -m sst_conditions_glm.json -s subject_list_test.txt -j 16
+# and beta_series_lss.py fits the LSS beta series of the betaseries files the same way, e.g.
+# OMP_NUM_THREADS=1 python3 beta_series_lss.py -m sst_betaseries_lss.json -s subject_list_test.txt -j 16
 #	
 # D.Cos 2018.11.06
 #--------------------------------------------------------------
@@ -0,0 +1,254 @@
+"""
+Least squares - separate (LSS) beta series of the betaseries .mat files of multiconds (one condition per trial),
+without fitting one GLM per trial.
+
+The LSS model of trial i has two regressors of interest, the trial itself and the sum of every other trial of its
+run, and the nuisance regressors of the run (motion, constant and the discrete cosines of the high-pass filter).
+With the nuisance projected out of the trial regressors (r_i), their sum (s) and the other trials (s - r_i), the
+beta of trial i is the solution of a 2 x 2 system,
+    beta_i = ((c_i + b_i) r_i'y - b_i s'y) / (a_i c_i - b_i^2)
+    with a_i = r_i'r_i, b_i = r_i'(s - r_i), c_i = (s - r_i)'(s - r_i)
+which is linear in the data y. So the weights of every trial are computed once per run, as a trials x scans
+matrix, and the beta series of a chunk of voxels is one matrix product with it: one pass over the data instead of
+one model estimation per trial. With the AR(1) noise model, voxels are grouped by their rounded lag-1
+autocorrelation (of the residuals of all trials as one regressor), as in first_level_glm.py, and each group gets
+the weights of the prewhitened model.
+
+Runs are prepared, scaled and masked as first_level_glm.py does, and each run is fit separately. The model
+directory gets:
+    beta_series.nii     4D, one volume per trial in the order of the betaseries files, NaN outside the mask
+    mask.nii
+    beta_series.tsv     volume, run, trial name, onset and duration of each volume, written last
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+
+from first_level_glm import AR1_STEP, GRAND_MEAN, HIGH_PASS_CUTOFF, MASK_NAME, MAX_AR1, bold_data, \
+    condition_regressors, create_image, dct_basis, decompress, fit_subjects, global_means, output_header, \
+    read_conditions, read_motion, read_subject_list, remove_temporary, save_mask, subject_model, voxel_ranges, \
+    whiten, write_tsv
+
+BETA_SERIES_NAME = 'beta_series.nii'
+TRIALS_NAME = 'beta_series.tsv'
+
+
+class BetaSeriesModel(NamedTuple):
+    """Specification of a beta series, with {subject} in paths replaced by each subject ID"""
+    name: str
+    bold: List[str]  # one file per run
+    conditions: List[str]  # one betaseries .mat file per run
+    motion: List[str]  # one file per run, or none
+    output_dir: str
+    tr: Optional[float] = None  # seconds, by default from the header of the first run
+    high_pass: float = HIGH_PASS_CUTOFF
+    noise_model: str = 'ols'  # 'ols' or 'ar1'
+    mask: Optional[str] = None  # explicit mask, in the space of the BOLD runs
+
+
+class Run(NamedTuple):
+    """One run prepared for fitting"""
+    file: Path  # uncompressed BOLD file, memory-mapped by the workers
+    temporary: bool  # whether the file was decompressed for this model, and should be removed
+    scale: float  # grand mean scaling
+    trials: np.ndarray  # trial regressors, scans x trials
+    nuisance: np.ndarray  # motion, constant and cosines, scans x regressors
+    weights: np.ndarray  # LSS weights of the OLS model, trials x scans
+    first_volume: int  # of its trials in the beta series
+
+
+class Subject(NamedTuple):
+    subject: str
+    output_dir: Path
+    shape: Tuple[int, int, int]
+    runs: List[Run]
+    num_trials: int
+    noise_model: str
+    data_offset: int
+    trials: List[List[str]]  # rows of beta_series.tsv
+
+
+def read_model(file: str) -> BetaSeriesModel:
+    with open(file, 'r') as f:
+        spec = json.load(f)
+    return BetaSeriesModel(**spec)
+
+
+def lss_weights(trials: np.ndarray, nuisance: np.ndarray) -> np.ndarray:
+    """
+    Weights of the LSS beta of every trial, trials x scans: the beta series of data y (scans x voxels) is
+    weights @ y. A trial whose other trials are collinear with it (a single trial) gets its OLS beta alone.
+    """
+    trials = trials - nuisance @ (np.linalg.pinv(nuisance) @ trials)
+    total = trials.sum(axis=1)
+    others = total[:, np.newaxis] - trials
+    a = np.einsum('ij,ij->j', trials, trials)
+    b = np.einsum('ij,ij->j', trials, others)
+    c = np.einsum('ij,ij->j', others, others)
+    determinant = a * c - b * b
+    singular = determinant <= 1e-10 * a * c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trial_weight = np.where(singular, 1.0 / a, (c + b) / determinant)
+        total_weight = np.where(singular, 0.0, b / determinant)
+    return trial_weight[:, np.newaxis] * trials.T - total_weight[:, np.newaxis] * total[np.newaxis, :]
+
+
+def nuisance_regressors(motion: Optional[np.ndarray], num_scans: int, tr: float, cutoff: float) -> np.ndarray:
+    columns = [motion] if motion is not None else []
+    columns += [np.ones((num_scans, 1)), dct_basis(num_scans, tr, cutoff)]
+    return np.column_stack(columns)
+
+
+def prepare_subject(model: BetaSeriesModel, subject: str) -> Subject:
+    """
+    Build the trial and nuisance regressors and the LSS weights of each run of one subject, compute its mask,
+    and create its beta series image. Gzipped runs are decompressed into the output directory first.
+    """
+    model = subject_model(model, subject)
+    output_dir = Path(model.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if (model.motion and len(model.motion) != len(model.bold)) or len(model.conditions) != len(model.bold):
+        raise ValueError(f'{model.name} needs one betaseries file (and motion file, if any) per BOLD run')
+
+    files = [Path(f) for f in model.bold]
+    temporary = [f.name.endswith('.gz') for f in files]
+    files = [decompress(f, output_dir) if t else f for f, t in zip(files, temporary)]
+    try:
+        image = nib.load(str(files[0]))
+        shape = tuple(image.shape[:3])
+        tr = model.tr or float(image.header.get_zooms()[3])
+        mask = np.ones(int(np.prod(shape)), dtype=bool)
+        runs, rows = [], []
+        for i, (file, is_temporary) in enumerate(zip(files, temporary)):
+            if tuple(nib.load(str(file)).shape[:3]) != shape:
+                raise ValueError(f'{file} is not {shape}, like the first run')
+            means, run_mask = global_means(file)
+            mask &= run_mask
+            conditions = read_conditions(model.conditions[i])
+            motion = read_motion(model.motion[i], means.size) if model.motion else None
+            trials = condition_regressors(conditions, means.size, tr)
+            nuisance = nuisance_regressors(motion, means.size, tr, model.high_pass)
+            first_volume = len(rows)
+            rows += [[str(volume), str(i + 1), c.name, f'{c.onsets[0]:.5f}', f'{c.durations[0]:.5f}']
+                     for volume, c in enumerate(conditions, start=first_volume + 1)]
+            runs.append(Run(file, is_temporary, GRAND_MEAN / means.mean(), trials, nuisance,
+                            lss_weights(trials, nuisance), first_volume))
+        if model.mask:
+            mask &= np.asanyarray(nib.load(model.mask).dataobj).reshape(-1, order='F') > 0
+
+        save_mask(output_dir / MASK_NAME, mask, image, shape)
+        data_offset = create_image(output_dir / BETA_SERIES_NAME, output_header(image, shape + (len(rows),)))
+        return Subject(subject, output_dir, shape, runs, len(rows), model.noise_model, data_offset, rows)
+    except Exception:
+        remove_temporary(files, temporary)
+        raise
+
+
+def ar1_steps(data: np.ndarray, run: Run) -> np.ndarray:
+    """
+    Lag-1 autocorrelation of each voxel, in steps of AR1_STEP, from the residuals of the model with every trial
+    as one regressor
+    """
+    design = np.column_stack([run.trials.sum(axis=1), run.nuisance])
+    residuals = data - design @ (np.linalg.pinv(design) @ data)
+    rho = (residuals[1:] * residuals[:-1]).sum(axis=0) / np.maximum((residuals ** 2).sum(axis=0),
+                                                                     np.finfo(float).tiny)
+    return np.round(np.clip(rho, -MAX_AR1, MAX_AR1) / AR1_STEP).astype(np.int64)
+
+
+def fit_chunk(subject: Subject, start: int, stop: int):
+    """Fit the beta series of voxels start..stop - 1 of :param subject: and write them into its image"""
+    mask_image = nib.load(str(subject.output_dir / MASK_NAME), mmap=True)
+    in_mask = np.asanyarray(mask_image.dataobj).reshape(-1, order='F')[start:stop] > 0
+    betas = np.full((subject.num_trials, stop - start), np.nan, dtype=np.float32)
+
+    if np.any(in_mask):
+        for run in subject.runs:
+            run_data, slope, inter = bold_data(run.file)
+            data = (np.asarray(run_data[start:stop], dtype=np.float64)[in_mask].T * slope + inter) * run.scale
+            volumes = slice(run.first_volume, run.first_volume + run.weights.shape[0])
+            if subject.noise_model == 'ar1':
+                run_betas = np.empty((run.weights.shape[0], data.shape[1]))
+                steps = ar1_steps(data, run)
+                for step in np.unique(steps):
+                    voxels = np.flatnonzero(steps == step)
+                    rho = step * AR1_STEP
+                    weights = lss_weights(whiten(run.trials, rho, [0]), whiten(run.nuisance, rho, [0]))
+                    run_betas[:, voxels] = weights @ whiten(data[:, voxels], rho, [0])
+            else:
+                run_betas = run.weights @ data
+            betas[volumes][:, in_mask] = run_betas
+
+    num_voxels = int(np.prod(subject.shape))
+    fd = os.open(str(subject.output_dir / BETA_SERIES_NAME), os.O_WRONLY)
+    try:
+        for volume, values in enumerate(betas):
+            os.pwrite(fd, values.tobytes(), subject.data_offset + (volume * num_voxels + start) * values.itemsize)
+    finally:
+        os.close(fd)
+
+
+def chunks(subject: Subject, memory_budget: int) -> List[Tuple[int, int]]:
+    """
+    Voxel ranges of :param subject: whose working memory fits :param memory_budget: bytes:
+    about three float64 copies of each voxel time series of the longest run, and its float32 betas
+    """
+    num_scans = max(run.trials.shape[0] for run in subject.runs)
+    return voxel_ranges(int(np.prod(subject.shape)), num_scans * 3 * 8 + subject.num_trials * 12, memory_budget)
+
+
+def remove_runs(subject: Subject):
+    remove_temporary([run.file for run in subject.runs], [run.temporary for run in subject.runs])
+
+
+def finish_subject(subject: Subject):
+    """Write the trials of the beta series, last, as the sign that it is complete"""
+    write_tsv(subject.output_dir / TRIALS_NAME, [['volume', 'run', 'trial', 'onset', 'duration']] + subject.trials)
+
+
+def fit_beta_series(model: BetaSeriesModel, subjects: List[str], jobs: int = 1, memory_budget: int = 1 << 30,
+                    overwrite: bool = False) -> List[str]:
+    """
+    Fit the beta series of each subject, skipping subjects that have one unless :param overwrite:.
+    A subject that fails is reported and left out. :return: subjects whose beta series was fit
+    """
+    return fit_subjects(model, subjects, prepare_subject, fit_chunk, chunks, finish_subject, remove_runs,
+                        TRIALS_NAME, jobs, memory_budget, overwrite)
+
+
+if __name__ == "__main__":
+    description = 'Fit LSS beta series of a cohort from the multiconds betaseries files'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--model', metavar='Model file', action='store',
+                        type=str, required=True,
+                        help='JSON specification: name, bold, conditions (betaseries files), motion and output_dir, '
+                             'with {subject} in paths, and optionally tr, high_pass, noise_model and mask.',
+                        dest='model_file')
+    parser.add_argument('-s', '--subjects', metavar='Subject list', action='store',
+                        type=str, required=True,
+                        help='file listing subject IDs, separated by whitespace.',
+                        dest='subject_list')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of subjects or chunks of voxels to process in parallel.',
+                        dest='jobs')
+    parser.add_argument('-M', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1024,
+                        help='memory budget of each job for a chunk of voxels.',
+                        dest='memory')
+    parser.add_argument('--overwrite', action='store_true',
+                        help=f'fit subjects whose model directory has {TRIALS_NAME} again.',
+                        dest='overwrite')
+    args = parser.parse_args()
+
+    subjects = read_subject_list(args.subject_list)
+    fitted = fit_beta_series(read_model(args.model_file), subjects, args.jobs, args.memory << 20, args.overwrite)
+    print(f'Fit {len(fitted)} of {len(subjects)} subjects')
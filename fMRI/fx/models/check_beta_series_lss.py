@@ -0,0 +1,142 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy.io import savemat
+
+from beta_series_lss import BETA_SERIES_NAME, TRIALS_NAME, fit_beta_series, nuisance_regressors, read_model
+from first_level_glm import AR1_STEP, GRAND_MEAN, MASK_NAME, condition_regressors, read_conditions, read_motion, \
+    subject_model, whiten
+from check_first_level_glm import SHAPE, TR, write_motion
+
+
+def write_betaseries(file: Path, num_scans: int, num_trials: int, rng: np.random.Generator):
+    """A betaseries .mat file, as multiconds writes them: one condition per trial, named by its number"""
+    onsets = np.sort(rng.uniform(0.0, (num_scans - 10) * TR, size=num_trials))
+    cells = {key: np.empty((1, num_trials), dtype=object) for key in ('names', 'onsets', 'durations')}
+    for i in range(num_trials):
+        cells['names'][0, i] = np.array([[i + 1.0]])
+        cells['onsets'][0, i] = np.array([[onsets[i]]])
+        cells['durations'][0, i] = np.array([[rng.uniform(0.5, 1.5)]])
+    savemat(str(file), cells)
+
+
+def synthetic_subject(tmp_dir: Path, subject: str, scans, num_trials: int, rng: np.random.Generator):
+    """Write the runs, betaseries and motion files of one subject, with a random response to every trial"""
+    brain = np.zeros(SHAPE, dtype=bool)
+    brain[2:8, 2:10, 1:7] = True
+    affine = np.diag([3.0, 3.0, 3.5, 1.0])
+    for run, num_scans in enumerate(scans, start=1):
+        write_betaseries(tmp_dir / f'{subject}_{run}.mat', num_scans, num_trials, rng)
+        write_motion(tmp_dir / f'{subject}_{run}_motion.txt', num_scans, rng, confounds=run == 2)
+        trials = condition_regressors(read_conditions(tmp_dir / f'{subject}_{run}.mat'), num_scans, TR)
+        noise = rng.normal(0.0, 5.0, size=(num_scans, int(brain.sum())))
+        for t in range(1, num_scans):
+            noise[t] += 0.3 * noise[t - 1]
+        data = np.zeros(SHAPE + (num_scans,), dtype=np.float32)
+        data[brain] = (1000.0 + trials @ rng.normal(20.0, 10.0, size=(num_trials, noise.shape[1])) + noise).T
+        image = nib.Nifti1Image(data, affine)
+        image.header.set_zooms((3.0, 3.0, 3.5, TR))
+        nib.save(image, str(tmp_dir / f'{subject}_{run}_bold.nii'))
+
+
+def reference_beta_series(model, subject: str, mask: np.ndarray) -> np.ndarray:
+    """One least squares fit per trial and voxel, of the trial, the other trials of its run and the nuisance"""
+    model = subject_model(model, subject)
+    series = []
+    for run, (bold, conditions, motion) in enumerate(zip(model.bold, model.conditions, model.motion)):
+        data = np.asarray(nib.load(bold).dataobj, dtype=np.float64)
+        volumes = data.reshape(-1, data.shape[3])
+        globals_ = np.array([v[v > v.mean() / 8].mean() for v in volumes.T])
+        data = data[mask].T * GRAND_MEAN / globals_.mean()
+        trials = condition_regressors(read_conditions(conditions), data.shape[0], TR)
+        nuisance = nuisance_regressors(read_motion(motion, data.shape[0]), data.shape[0], TR, model.high_pass)
+        betas = np.empty((trials.shape[1], data.shape[1]))
+        for v in range(data.shape[1]):
+            y = data[:, v]
+            rho = 0.0
+            if model.noise_model == 'ar1':
+                design = np.column_stack([trials.sum(axis=1), nuisance])
+                r = y - design @ np.linalg.lstsq(design, y, rcond=None)[0]
+                rho = np.round(np.clip((r[1:] * r[:-1]).sum() / (r ** 2).sum(), -0.99, 0.99) / AR1_STEP) * AR1_STEP
+            for i in range(trials.shape[1]):
+                design = np.column_stack([trials[:, i], trials.sum(axis=1) - trials[:, i], nuisance])
+                betas[i, v] = np.linalg.lstsq(whiten(design, rho, [0]), whiten(y, rho, [0]), rcond=None)[0][0]
+        series.append(betas)
+    return np.concatenate(series)
+
+
+def main(num_subjects: int, num_scans: int, num_trials: int, jobs: int, memory: int):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        subjects = [f'{i:03d}' for i in range(1, num_subjects + 1)]
+        for subject in subjects:
+            synthetic_subject(tmp_dir, subject, (num_scans, num_scans + 7), num_trials, rng)
+
+        for noise_model in ('ols', 'ar1'):
+            spec = {'name': f'check_{noise_model}',
+                    'bold': [str(tmp_dir / ('{subject}_%d_bold.nii' % run)) for run in (1, 2)],
+                    'conditions': [str(tmp_dir / ('{subject}_%d.mat' % run)) for run in (1, 2)],
+                    'motion': [str(tmp_dir / ('{subject}_%d_motion.txt' % run)) for run in (1, 2)],
+                    'output_dir': str(tmp_dir / noise_model / 'sub-{subject}'),
+                    'noise_model': noise_model}
+            with open(str(tmp_dir / 'model.json'), 'w') as f:
+                json.dump(spec, f)
+            model = read_model(str(tmp_dir / 'model.json'))
+
+            start = time.perf_counter()
+            assert fit_beta_series(model, subjects, jobs, memory << 20) == subjects
+            elapsed = time.perf_counter() - start
+            assert fit_beta_series(model, subjects, jobs, memory << 20) == []
+
+            for subject in subjects:
+                output_dir = Path(subject_model(model, subject).output_dir)
+                mask = np.asanyarray(nib.load(str(output_dir / MASK_NAME)).dataobj) > 0
+                series = np.asanyarray(nib.load(str(output_dir / BETA_SERIES_NAME)).dataobj)
+                assert series.shape == SHAPE + (2 * num_trials,) and np.all(np.isnan(series[~mask]))
+                with open(str(output_dir / TRIALS_NAME)) as f:
+                    rows = [line.rstrip('\n').split('\t') for line in f][1:]
+                assert [r[:3] for r in rows] == [[str((run - 1) * num_trials + i), str(run), str(i)]
+                                                 for run in (1, 2) for i in range(1, num_trials + 1)]
+                reference = reference_beta_series(model, subject, mask)
+                difference = np.max(np.abs(series[mask].T - reference)) / np.max(np.abs(reference))
+                assert difference < 1e-5, f'{noise_model} beta series of {subject} differs: {difference}'
+            print(f'{noise_model}: beta series match one least squares fit per trial, '
+                  f'{elapsed:.3f} s for {num_subjects} subjects of {2 * num_trials} trials '
+                  f'({jobs} jobs, {memory} MB chunks)')
+
+
+if __name__ == "__main__":
+    description = 'Check beta_series_lss.py against one least squares fit per trial of synthetic subjects'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--subjects', metavar='Number of subjects', action='store',
+                        type=int, required=False, default=2,
+                        help='number of synthetic subjects.',
+                        dest='num_subjects')
+    parser.add_argument('-t', '--scans', metavar='Number of scans', action='store',
+                        type=int, required=False, default=100,
+                        help='number of scans of the first run of each subject; the second has 7 more.',
+                        dest='num_scans')
+    parser.add_argument('-r', '--trials', metavar='Number of trials', action='store',
+                        type=int, required=False, default=20,
+                        help='number of trials of each run.',
+                        dest='num_trials')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=2,
+                        help='number of subjects or chunks of voxels to fit in parallel.',
+                        dest='jobs')
+    parser.add_argument('-m', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1,
+                        help='memory budget of each job, small to split each subject into several chunks.',
+                        dest='memory')
+    args = parser.parse_args()
+
+    main(args.num_subjects, args.num_scans, args.num_trials, args.jobs, args.memory)
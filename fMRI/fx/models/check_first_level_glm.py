@@ -0,0 +1,266 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import nibabel as nib
+import numpy as np
+from scipy.io import loadmat, savemat
+from scipy.stats import gamma
+
+from first_level_glm import BETA_PATTERN, CON_PATTERN, DESIGN_NAME, MASK_NAME, RESIDUAL_PATTERN, RESMS_NAME, \
+    AR1_STEP, GRAND_MEAN, MASK_THRESHOLD, canonical_hrf, fit_models, read_model, read_motion, subject_model
+
+SHAPE = (10, 12, 8)
+TR = 2.0
+CONDITIONS = ['CorrectGo', 'CorrectStop']
+# SPM defaults: 16 microtime bins per scan, the scan sampled at bin 8, and 32 bins before the first scan
+MICROTIME_BINS = 16
+MICROTIME_ONSET = 8
+MICROTIME_PAD = 32
+
+
+def reference_hrf(dt: float) -> np.ndarray:
+    """
+    spm_hrf(dt) with the default parameters, written out from its definition: spm_Gpdf(u, 6, dt) minus
+    spm_Gpdf(u, 16, dt) / 6, at bins u = 0 .. floor(32 / dt), normalized to sum to 1
+    """
+    u = np.arange(int(np.floor(32.0 / dt)) + 1, dtype=np.float64)
+    # spm_Gpdf(x, h, l) is the gamma density of shape h and rate l
+    hrf = gamma.pdf(u, 6.0, scale=1.0 / dt) - gamma.pdf(u, 16.0, scale=1.0 / dt) / 6.0
+    return hrf / hrf.sum()
+
+
+def reference_regressor(onsets: np.ndarray, durations: np.ndarray, num_scans: int) -> np.ndarray:
+    """
+    One condition of one run, as spm_fMRI_design builds it: a stimulus function in microtime bins (events of
+    height 1 / dt, epochs of height 1), directly convolved with the HRF and sampled at the middle bin of each scan
+    """
+    dt = TR / MICROTIME_BINS
+    stimulus = np.zeros(num_scans * MICROTIME_BINS + 4 * MICROTIME_PAD)
+    for onset, duration in zip(onsets, durations):
+        first = int(np.round(onset / dt)) + MICROTIME_PAD
+        bins = max(int(np.round(duration / dt)), 1)
+        stimulus[first:first + bins] += 1.0 if duration > 0 else 1.0 / dt
+    convolved = np.convolve(stimulus, reference_hrf(dt))
+    return convolved[np.arange(num_scans) * MICROTIME_BINS + MICROTIME_ONSET + MICROTIME_PAD - 1]
+
+
+def reference_cosines(num_scans: int, cutoff: float) -> np.ndarray:
+    """Columns 2 .. K of spm_dctmtx(num_scans), K = fix(2 * num_scans * TR / cutoff + 1), as spm_filter uses"""
+    order = int(np.fix(2.0 * num_scans * TR / cutoff + 1.0))
+    return np.column_stack([np.sqrt(2.0 / num_scans) * np.cos(np.pi * (2 * np.arange(num_scans) + 1) * k /
+                                                              (2 * num_scans)) for k in range(1, order)])
+
+
+def reference_conditions(file: Path):
+    """(name, onsets, durations) of each condition of a names/onsets/durations .mat file"""
+    mat = loadmat(str(file))
+    return [(str(name[0]), np.ravel(onsets), np.ravel(durations))
+            for name, onsets, durations in zip(mat['names'][0], mat['onsets'][0], mat['durations'][0])]
+
+
+def reference_design(condition_files: List[Path], motion: List[np.ndarray], scans: List[int]) -> np.ndarray:
+    """SPM's design: the conditions and motion of each run, block diagonal, then the constant of each run"""
+    design = np.zeros((sum(scans), 0))
+    start = 0
+    for f, run_motion, num_scans in zip(condition_files, motion, scans):
+        columns = [reference_regressor(onsets, durations, num_scans) for _, onsets, durations in
+                   reference_conditions(f)]
+        block = np.zeros((sum(scans), len(columns) + run_motion.shape[1]))
+        block[start:start + num_scans] = np.column_stack(columns + [run_motion])
+        design = np.column_stack([design, block])
+        start += num_scans
+    constants = np.zeros((sum(scans), len(scans)))
+    for run, start in enumerate(np.cumsum([0] + scans[:-1])):
+        constants[start:start + scans[run], run] = 1.0
+    return np.column_stack([design, constants])
+
+
+def write_conditions(file: Path, num_scans: int, rng: np.random.Generator):
+    """A names/onsets/durations .mat file, as multiconds writes them, of events and short epochs"""
+    onsets = np.sort(rng.uniform(0.0, (num_scans - 10) * TR, size=(2, 30)), axis=1)
+    durations = [np.zeros(30), rng.uniform(0.5, 1.5, size=30)]
+    cells = {key: np.empty((1, len(CONDITIONS)), dtype=object) for key in ('names', 'onsets', 'durations')}
+    for i, name in enumerate(CONDITIONS):
+        cells['names'][0, i] = name
+        cells['onsets'][0, i] = onsets[i][:, np.newaxis]
+        cells['durations'][0, i] = durations[i][:, np.newaxis]
+    savemat(str(file), cells)
+
+
+def write_motion(file: Path, num_scans: int, rng: np.random.Generator, confounds: bool) -> np.ndarray:
+    """Random walk motion, as an SPM rp_*.txt file or an fMRIPrep confounds file. :return: the motion"""
+    motion = np.cumsum(rng.normal(0.0, 0.02, size=(num_scans, 6)), axis=0)
+    with open(str(file), 'w') as f:
+        if confounds:
+            f.write('\t'.join(['CSF', 'X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']) + '\n')
+            f.writelines('\t'.join(['n/a'] + [f'{v:.8g}' for v in row]) + '\n' for row in motion)
+        else:
+            f.writelines(' '.join(f'{v:.8g}' for v in row) + '\n' for row in motion)
+    return np.array([[float(f'{v:.8g}') for v in row] for row in motion])
+
+
+def synthetic_subject(tmp_dir: Path, subject: str, scans, rng: np.random.Generator, gzipped: bool):
+    """Write the runs, conditions and motion files of one subject, with known betas and AR(1) noise"""
+    brain = np.zeros(SHAPE, dtype=bool)
+    brain[2:8, 2:10, 1:7] = True
+    motion = []
+    for run, num_scans in enumerate(scans, start=1):
+        write_conditions(tmp_dir / f'{subject}_{run}.mat', num_scans, rng)
+        motion.append(write_motion(tmp_dir / f'{subject}_{run}_motion.txt', num_scans, rng, confounds=run == 2))
+    design = reference_design([tmp_dir / f'{subject}_{run}.mat' for run in range(1, len(scans) + 1)], motion,
+                              list(scans))
+    betas = rng.normal(0.0, 20.0, size=(design.shape[1], int(brain.sum())))
+    betas[-len(scans):] = rng.uniform(800.0, 1200.0, size=(len(scans), 1))
+
+    noise = rng.normal(0.0, 5.0, size=(sum(scans), betas.shape[1]))
+    for t in range(1, noise.shape[0]):
+        noise[t] += 0.3 * noise[t - 1]
+    drift = 10.0 * np.cos(np.linspace(0.0, np.pi, sum(scans)))[:, np.newaxis]
+    data = np.zeros(SHAPE + (sum(scans),), dtype=np.float32)
+    data[brain] = (design @ betas + noise + drift).T
+
+    affine = np.diag([3.0, 3.0, 3.5, 1.0])
+    affine[:3, 3] = [-15.0, -18.0, -14.0]
+    start = 0
+    for run, num_scans in enumerate(scans, start=1):
+        image = nib.Nifti1Image(data[..., start:start + num_scans], affine)
+        image.header.set_zooms((3.0, 3.0, 3.5, TR))
+        nib.save(image, str(tmp_dir / f'{subject}_{run}_bold.nii{".gz" if gzipped else ""}'))
+        start += num_scans
+
+
+def reference_fit(model, subject: str, noise_model: str):
+    """
+    Direct fit of every in-mask voxel: grand mean scaling, implicit mask, and least squares on the design with the
+    discrete cosines as extra columns, prewhitened per voxel with an explicit AR(1) matrix
+    """
+    model = subject_model(model, subject)
+    runs = [np.asarray(nib.load(f).dataobj, dtype=np.float64) for f in model.bold]
+    scans = [r.shape[3] for r in runs]
+    mask = np.ones(SHAPE, dtype=bool)
+    scaled = []
+    for r in runs:
+        volumes = r.reshape(-1, r.shape[3])
+        globals_ = np.array([v[v > v.mean() / 8].mean() for v in volumes.T])
+        mask &= np.all(r > MASK_THRESHOLD * globals_, axis=3)
+        scaled.append(r * GRAND_MEAN / globals_.mean())
+    data = np.concatenate(scaled, axis=3)[mask].T
+
+    motion = [read_motion(f, n) for f, n in zip(model.motion, scans)]
+    design = reference_design([Path(f) for f in model.conditions], motion, scans)
+    cosines = np.zeros((sum(scans), 0))
+    start = 0
+    for num_scans in scans:
+        block = np.zeros((sum(scans), reference_cosines(num_scans, model.high_pass).shape[1]))
+        block[start:start + num_scans] = reference_cosines(num_scans, model.high_pass)
+        cosines = np.column_stack([cosines, block])
+        start += num_scans
+    full = np.column_stack([design, cosines])
+    betas = np.linalg.lstsq(full, data, rcond=None)[0]
+    if noise_model == 'ar1':
+        residuals = data - full @ betas
+        starts = np.cumsum([0] + scans[:-1])
+        for v in range(data.shape[1]):
+            r = residuals[:, v]
+            lagged = r[1:] * r[:-1]
+            lagged[starts[1:] - 1] = 0.0
+            rho = np.round(np.clip(lagged.sum() / (r ** 2).sum(), -0.99, 0.99) / AR1_STEP) * AR1_STEP
+            whitening = np.eye(sum(scans)) - rho * np.eye(sum(scans), k=-1)
+            for s in starts:
+                whitening[s] = 0.0
+                whitening[s, s] = np.sqrt(1.0 - rho ** 2)
+            betas[:, v] = np.linalg.lstsq(whitening @ full, whitening @ data[:, v], rcond=None)[0]
+    return mask, betas[:design.shape[1]]
+
+
+def main(num_subjects: int, num_scans: int, jobs: int, memory: int):
+    # The HRF against spm_hrf, also at a TR whose microtime bins do not divide its 32 s length
+    for tr in (TR, 0.72):
+        dt = tr / MICROTIME_BINS
+        hrf, reference = canonical_hrf(dt), reference_hrf(dt)
+        assert hrf.shape == reference.shape and np.allclose(hrf, reference, rtol=1e-10, atol=1e-14), tr
+        assert 4.5 < np.argmax(hrf) * dt < 5.5
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        subjects = [f'{i:03d}' for i in range(1, num_subjects + 1)]
+        for i, subject in enumerate(subjects):
+            synthetic_subject(tmp_dir, subject, (num_scans, num_scans + 7), rng, gzipped=i == 0)
+
+        for noise_model in ('ols', 'ar1'):
+            spec = {'name': f'check_{noise_model}',
+                    'bold': [str(tmp_dir / ('{subject}_%d_bold.nii' % run)) for run in (1, 2)],
+                    'conditions': [str(tmp_dir / ('{subject}_%d.mat' % run)) for run in (1, 2)],
+                    'motion': [str(tmp_dir / ('{subject}_%d_motion.txt' % run)) for run in (1, 2)],
+                    'output_dir': str(tmp_dir / noise_model / 'sub-{subject}'),
+                    'contrasts': {'CorrectStop > CorrectGo': 'CorrectStop - CorrectGo'},
+                    'noise_model': noise_model,
+                    'residuals': True}
+            with open(str(tmp_dir / 'model.json'), 'w') as f:
+                json.dump(spec, f)
+            model = read_model(str(tmp_dir / 'model.json'))
+            # The runs of the first subject are gzipped
+            gz_model = model._replace(bold=[f + '.gz' for f in model.bold])
+
+            start = time.perf_counter()
+            fitted = fit_models(gz_model, subjects[:1], jobs, memory << 20) + \
+                fit_models(model, subjects[1:], jobs, memory << 20)
+            elapsed = time.perf_counter() - start
+            assert fitted == subjects, fitted
+            assert fit_models(model, subjects[1:], jobs, memory << 20) == []
+
+            for i, subject in enumerate(subjects):
+                output_dir = Path(subject_model(model, subject).output_dir)
+                names = open(str(output_dir / DESIGN_NAME)).readline().rstrip('\n').split('\t')
+                assert names[0] == 'Sn(1) CorrectGo*bf(1)' and names[-1] == 'Sn(2) constant', names
+                mask, reference = reference_fit(gz_model if i == 0 else model, subject, noise_model)
+                assert np.array_equal(np.asanyarray(nib.load(str(output_dir / MASK_NAME)).dataobj) > 0, mask)
+                betas = np.stack([np.asanyarray(nib.load(str(output_dir / BETA_PATTERN.format(j))).dataobj)
+                                  for j in range(1, len(names) + 1)])
+                assert np.all(np.isnan(betas[:, ~mask]))
+                difference = np.max(np.abs(betas[:, mask] - reference) / (np.abs(reference) + 1.0))
+                assert difference < 1e-4, f'{noise_model} betas of {subject} differ from the reference: {difference}'
+
+                con = np.asanyarray(nib.load(str(output_dir / CON_PATTERN.format(1))).dataobj)[mask]
+                expected = (betas[1] - betas[0] + betas[9] - betas[8])[mask] / 2.0
+                assert np.allclose(con, expected, atol=1e-5 * np.max(np.abs(expected)))
+                residuals = np.stack([np.asanyarray(nib.load(str(output_dir / RESIDUAL_PATTERN.format(t))).dataobj)
+                                      for t in range(1, 2 * num_scans + 8)], axis=-1)[mask]
+                resms = np.asanyarray(nib.load(str(output_dir / RESMS_NAME)).dataobj)[mask]
+                cosines = sum(reference_cosines(n, model.high_pass).shape[1] for n in (num_scans, num_scans + 7))
+                dof = 2 * num_scans + 7 - len(names) - cosines
+                assert np.allclose((residuals.astype(np.float64) ** 2).sum(axis=1) / dof, resms, rtol=1e-3)
+            print(f'{noise_model}: betas, contrasts, residuals and mask match the reference fit, '
+                  f'{elapsed:.3f} s for {num_subjects} subjects ({jobs} jobs, {memory} MB chunks)')
+
+
+if __name__ == "__main__":
+    description = 'Check first_level_glm.py against a direct least squares fit of synthetic subjects'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--subjects', metavar='Number of subjects', action='store',
+                        type=int, required=False, default=3,
+                        help='number of synthetic subjects.',
+                        dest='num_subjects')
+    parser.add_argument('-t', '--scans', metavar='Number of scans', action='store',
+                        type=int, required=False, default=120,
+                        help='number of scans of the first run of each subject; the second has 7 more.',
+                        dest='num_scans')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=2,
+                        help='number of subjects or chunks of voxels to fit in parallel.',
+                        dest='jobs')
+    parser.add_argument('-m', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1,
+                        help='memory budget of each job, small to split each subject into several chunks.',
+                        dest='memory')
+    args = parser.parse_args()
+
+    main(args.num_subjects, args.num_scans, args.jobs, args.memory)
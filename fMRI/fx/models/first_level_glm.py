@@ -0,0 +1,608 @@
+"""
+First level GLM of preprocessed (smoothed) BOLD runs in NumPy, in place of the SPM model specification and
+estimation batch of make_sid_matlabbatch.m, so a cohort runs on one multi-core node without MATLAB.
+
+For each subject, as SPM does by default:
+  - conditions are read from the names/onsets/durations .mat files of multiconds (onsets in seconds), one file
+    per run, and their stimulus functions are built at a microtime resolution of TR/16 and convolved with the
+    canonical HRF (the double gamma of spm_hrf), then sampled at the 8th microtime bin of each scan. Events of
+    zero duration are one microtime bin of unit area; epochs are boxcars of height 1
+  - motion regressors (SPM rp_*.txt files, or fMRIPrep confounds .tsv files) are added to each run
+  - each run has a constant, and the design is block diagonal over runs
+  - data and design are high-pass filtered with the discrete cosine basis of spm_filter (128 s cutoff)
+  - each run is scaled to a grand mean of 100, and voxels are in the mask when they are above 0.8 of the global
+    mean of every volume (spm_global), and within an explicit mask if given
+The noise model is either OLS, or AR(1): the lag-1 autocorrelation of the OLS residuals of each voxel is
+rounded to steps of 0.01, and voxels that share a value are prewhitened and refit together, with the discrete
+cosines as regressors. Degrees of freedom are the scans less the regressors and the cosines.
+
+The BOLD runs are memory-mapped, and fit in chunks of voxels that fit a memory budget: each chunk is one
+matrix product with the pseudo-inverse of the design (per autocorrelation value for AR(1)). Subjects are
+prepared (design, global means and mask) and their chunks fit in one process pool, and each worker writes its
+voxels directly into the output images of the model directory:
+    beta_####.nii       one per design column, NaN outside the mask
+    con_####.nii        one per contrast, with spmT_####.nii
+    ResMS.nii           residual mean square
+    Res_####.nii        (with residuals) residual volumes, numbered consecutively over runs, for residual_acf.py
+    mask.nii
+    contrasts.tsv       name, weights and images of each contrast
+    design_matrix.tsv   the design before filtering, one column per beta image, written last
+Contrasts are given by condition name, e.g. "CorrectStop - CorrectGo", and are replicated over the runs that
+have each condition and scaled by their number, as SPM's "replicate and scale".
+
+With more than one job, set OMP_NUM_THREADS=1 so the workers' BLAS threads do not compete.
+"""
+import argparse
+import functools
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from nibabel.volumeutils import native_code
+from scipy.io import loadmat
+from scipy.signal import fftconvolve
+from scipy.stats import gamma
+
+# SPM defaults: stats.fmri.t, stats.fmri.t0, mask threshold and grand mean scaling
+MICROTIME_RESOLUTION = 16
+MICROTIME_ONSET = 8
+MASK_THRESHOLD = 0.8
+GRAND_MEAN = 100.0
+HIGH_PASS_CUTOFF = 128.0
+# Step of the AR(1) coefficients that are prewhitened together
+AR1_STEP = 0.01
+MAX_AR1 = 0.99
+
+# Motion columns of fMRIPrep 1.x and later confounds files, in order of preference
+MOTION_COLUMNS = [['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ'],
+                  ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']]
+DESIGN_NAME = 'design_matrix.tsv'
+CONTRASTS_NAME = 'contrasts.tsv'
+MASK_NAME = 'mask.nii'
+RESMS_NAME = 'ResMS.nii'
+BETA_PATTERN = 'beta_{:04d}.nii'
+CON_PATTERN = 'con_{:04d}.nii'
+SPMT_PATTERN = 'spmT_{:04d}.nii'
+RESIDUAL_PATTERN = 'Res_{:04d}.nii'
+
+
+class Condition(NamedTuple):
+    name: str
+    onsets: np.ndarray  # seconds
+    durations: np.ndarray  # seconds
+
+
+class Model(NamedTuple):
+    """Specification of a model, with {subject} in paths replaced by each subject ID"""
+    name: str
+    bold: List[str]  # one file per run
+    conditions: List[str]  # one .mat file per run
+    motion: List[str]  # one file per run, or none
+    output_dir: str
+    contrasts: Dict[str, str]  # name: weights by condition, e.g. "CorrectStop - CorrectGo"
+    tr: Optional[float] = None  # seconds, by default from the header of the first run
+    high_pass: float = HIGH_PASS_CUTOFF
+    noise_model: str = 'ar1'  # 'ar1' or 'ols'
+    mask: Optional[str] = None  # explicit mask, in the space of the BOLD runs
+    residuals: bool = False
+
+
+class Subject(NamedTuple):
+    """A subject prepared for fitting: everything the workers need besides the data"""
+    subject: str
+    output_dir: Path
+    runs: List[Path]  # uncompressed BOLD files, memory-mapped by the workers
+    temporary: List[bool]  # whether each run was decompressed for this model, and should be removed
+    shape: Tuple[int, int, int]
+    scans: List[int]
+    scale: List[float]  # grand mean scaling of each run
+    design: np.ndarray  # design before filtering, scans x regressors
+    names: List[str]  # of each regressor
+    filter_basis: np.ndarray  # orthonormal discrete cosine basis of all runs, scans x cosines
+    contrasts: np.ndarray  # contrasts x regressors
+    noise_model: str
+    residuals: bool
+    data_offset: int  # of every float32 output image
+
+
+def read_model(file: str) -> Model:
+    with open(file, 'r') as f:
+        spec = json.load(f)
+    return Model(**spec)
+
+
+def subject_model(model: Model, subject: str) -> Model:
+    def replace(path):
+        return path.format(subject=subject) if path else path
+    return model._replace(bold=[replace(f) for f in model.bold],
+                          conditions=[replace(f) for f in model.conditions],
+                          motion=[replace(f) for f in model.motion],
+                          output_dir=replace(model.output_dir),
+                          mask=replace(model.mask))
+
+
+def read_conditions(file: str) -> List[Condition]:
+    """Conditions of a names/onsets/durations .mat file. Conditions without onsets are left out, as SPM requires."""
+    mat = loadmat(str(file))
+    # Names are text, or numbers for the trials of betaseries files
+    names = [str(np.squeeze(name)) if np.asarray(name).dtype.kind in 'US' else f'{float(np.squeeze(name)):g}'
+             for name in np.ravel(mat['names'])]
+    onsets = [np.ravel(o).astype(np.float64) for o in np.ravel(mat['onsets'])]
+    durations = [np.ravel(d).astype(np.float64) for d in np.ravel(mat['durations'])]
+    if not len(names) == len(onsets) == len(durations):
+        # Pairing the cells in order would model some trials under another condition's name, so SPM rejects them
+        raise ValueError(f'{file} has {len(names)} names, {len(onsets)} onsets and {len(durations)} durations')
+    conditions = []
+    for name, condition_onsets, condition_durations in zip(names, onsets, durations):
+        if condition_onsets.size == 0:
+            continue
+        if condition_durations.size == 1:
+            condition_durations = np.full(condition_onsets.shape, condition_durations[0])
+        conditions.append(Condition(name, condition_onsets, condition_durations))
+    return conditions
+
+
+def read_motion(file: str, num_scans: int) -> np.ndarray:
+    """
+    Motion regressors of one run, scans x 6: the columns of an SPM rp_*.txt file, or the motion columns of an
+    fMRIPrep confounds .tsv file, with n/a as 0
+    """
+    with open(str(file), 'r') as f:
+        first_line = f.readline().split()
+    columns = next((c for c in MOTION_COLUMNS if all(name in first_line for name in c)), None)
+    if columns is None:
+        motion = np.loadtxt(str(file), ndmin=2)
+    else:
+        motion = np.genfromtxt(str(file), delimiter='\t', names=True, usecols=columns, missing_values='n/a',
+                               filling_values=0.0)
+        motion = np.column_stack([motion[c] for c in columns])
+    if motion.shape[0] != num_scans:
+        raise ValueError(f'{file} has {motion.shape[0]} rows, the run has {num_scans} scans')
+    return np.nan_to_num(motion)
+
+
+@functools.lru_cache(maxsize=None)
+def canonical_hrf(dt: float) -> np.ndarray:
+    """Canonical HRF of SPM (peak at 6 s, undershoot at 16 s, ratio 6, 32 s long) at :param dt:, summing to 1"""
+    # Bins 0 .. floor(32 / dt), as spm_hrf
+    t = np.arange(int(np.floor(32.0 / dt)) + 1) * dt
+    hrf = gamma.pdf(t, 6.0) - gamma.pdf(t, 16.0) / 6.0
+    hrf /= hrf.sum()
+    hrf.setflags(write=False)
+    return hrf
+
+
+def condition_regressors(conditions: List[Condition], num_scans: int, tr: float) -> np.ndarray:
+    """Stimulus functions of :param conditions: convolved with the canonical HRF, scans x conditions"""
+    dt = tr / MICROTIME_RESOLUTION
+    # 32 bins before the first scan, as spm_get_ons
+    length = num_scans * MICROTIME_RESOLUTION + 128
+    stimulus = np.zeros((length + 1, len(conditions)))
+    for i, condition in enumerate(conditions):
+        on = np.round(condition.onsets / dt).astype(np.int64) + 32
+        bins = np.maximum(np.round(condition.durations / dt).astype(np.int64), 1)
+        height = np.where(condition.durations > 0, 1.0, 1.0 / dt)
+        np.add.at(stimulus[:, i], np.clip(on, 0, length), height)
+        np.add.at(stimulus[:, i], np.clip(on + bins, 0, length), -height)
+    stimulus = np.cumsum(stimulus[:length], axis=0)
+    convolved = fftconvolve(stimulus, canonical_hrf(dt)[:, np.newaxis], axes=0)[:length]
+    return convolved[np.arange(num_scans) * MICROTIME_RESOLUTION + MICROTIME_ONSET + 31]
+
+
+def dct_basis(num_scans: int, tr: float, cutoff: float) -> np.ndarray:
+    """Discrete cosines with periods longer than :param cutoff: seconds, without the constant, as spm_filter"""
+    order = int(2.0 * num_scans * tr / cutoff + 1.0)
+    n = np.arange(num_scans)[:, np.newaxis]
+    k = np.arange(1, order)[np.newaxis, :]
+    return np.sqrt(2.0 / num_scans) * np.cos(np.pi * (2 * n + 1) * k / (2 * num_scans))
+
+
+def design_matrix(conditions: List[List[Condition]], motion: List[Optional[np.ndarray]], scans: List[int],
+                  tr: float) -> Tuple[np.ndarray, List[str]]:
+    """
+    Block diagonal design over runs, with the columns in SPM's order: the conditions and motion regressors
+    of each run, then the constant of each run. :return: the design and the name of each column
+    """
+    blocks, names = [], []
+    for run, (run_conditions, run_motion, num_scans) in enumerate(zip(conditions, motion, scans), start=1):
+        columns = [condition_regressors(run_conditions, num_scans, tr)]
+        names += [f'Sn({run}) {c.name}*bf(1)' for c in run_conditions]
+        if run_motion is not None:
+            columns.append(run_motion)
+            names += [f'Sn({run}) R{i}' for i in range(1, run_motion.shape[1] + 1)]
+        blocks.append(np.column_stack(columns))
+    num_columns = sum(b.shape[1] for b in blocks) + len(scans)
+    design = np.zeros((sum(scans), num_columns))
+    row = column = 0
+    for block, num_scans in zip(blocks, scans):
+        design[row:row + num_scans, column:column + block.shape[1]] = block
+        row += num_scans
+        column += block.shape[1]
+    row = 0
+    for run, num_scans in enumerate(scans, start=1):
+        design[row:row + num_scans, column] = 1.0
+        names.append(f'Sn({run}) constant')
+        row += num_scans
+        column += 1
+    return design, names
+
+
+def filter_basis(scans: List[int], tr: float, cutoff: float) -> np.ndarray:
+    """Discrete cosine basis of each run, block diagonal, scans x cosines"""
+    bases = [dct_basis(num_scans, tr, cutoff) for num_scans in scans]
+    basis = np.zeros((sum(scans), sum(b.shape[1] for b in bases)))
+    row = column = 0
+    for b in bases:
+        basis[row:row + b.shape[0], column:column + b.shape[1]] = b
+        row += b.shape[0]
+        column += b.shape[1]
+    return basis
+
+
+def contrast_weights(expression: str, names: List[str]) -> np.ndarray:
+    """
+    Weights over the design columns of a contrast such as "CorrectStop - CorrectGo" or "0.5*A + 0.5*B - C".
+    Each condition is replicated over the runs that have it, and its weight divided by their number.
+    """
+    weights = np.zeros(len(names))
+    terms = re.findall(r'([+-]?)\s*(\d*\.?\d*)\s*\*?\s*([A-Za-z_]\w*)', expression)
+    if not terms:
+        raise ValueError(f'no conditions in contrast "{expression}"')
+    for sign, factor, condition in terms:
+        columns = [i for i, name in enumerate(names) if re.fullmatch(rf'Sn\(\d+\) {condition}\*bf\(1\)', name)]
+        if not columns:
+            raise ValueError(f'contrast "{expression}": no condition {condition} in the design')
+        weight = (-1.0 if sign == '-' else 1.0) * (float(factor) if factor else 1.0)
+        weights[columns] += weight / len(columns)
+    return weights
+
+
+def whiten(data: np.ndarray, rho: float, run_starts: List[int]) -> np.ndarray:
+    """AR(1) prewhitening of the rows (scans) of :param data:, restarting at each run"""
+    whitened = data.copy()
+    whitened[1:] -= rho * data[:-1]
+    for start in run_starts:
+        whitened[start] = np.sqrt(1.0 - rho ** 2) * data[start]
+    return whitened
+
+
+def bold_data(file: Path) -> Tuple[np.ndarray, float, float]:
+    """Memory-mapped data of a 4D run as voxels x scans, and its scale factor and intercept"""
+    image = nib.load(str(file), mmap=True)
+    data = image.dataobj.get_unscaled()
+    data = data.reshape(-1, data.shape[3] if data.ndim > 3 else 1, order='F')
+    slope, inter = image.dataobj.slope, image.dataobj.inter
+    return data, float(slope), float(inter)
+
+
+def decompress(file: Path, output_dir: Path) -> Path:
+    """Decompress a .nii.gz file to output_dir, so it can be memory-mapped"""
+    output = output_dir / f'{file.name[:-len(".gz")]}.{os.getpid()}.tmp.nii'
+    with gzip.open(str(file), 'rb') as source, open(str(output), 'wb') as destination:
+        shutil.copyfileobj(source, destination, 1 << 24)
+    return output
+
+
+def global_means(file: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Global mean of each volume of a run, the mean of the voxels above 1/8 of its mean (spm_global),
+    and the voxels above MASK_THRESHOLD of the global mean in every volume
+    """
+    data, slope, inter = bold_data(file)
+    means = np.empty(data.shape[1])
+    mask = np.ones(data.shape[0], dtype=bool)
+    for t in range(data.shape[1]):
+        volume = np.asarray(data[:, t], dtype=np.float64) * slope + inter
+        means[t] = volume[volume > volume.mean() / 8.0].mean()
+        mask &= volume > MASK_THRESHOLD * means[t]
+    return means, mask
+
+
+def create_image(file: Path, header: nib.Nifti1Header) -> int:
+    """Write :param header: and make room for its data, which workers write voxel by voxel. :return: data offset"""
+    with open(str(file), 'wb') as f:
+        header.write_to(f)
+        data_offset = header.get_data_offset()
+        f.truncate(data_offset + int(np.prod(header.get_data_shape())) * header.get_data_dtype().itemsize)
+    return data_offset
+
+
+def output_header(image: nib.Nifti1Image, shape: Tuple[int, ...]) -> nib.Nifti1Header:
+    """
+    Header of the float32 output images of :param shape: in the space of :param image:, without data offset.
+    Workers write native float32, so it is in native byte order. Dimensions past the third (beta series volumes)
+    have unit zooms, not the TR of :param image:.
+    """
+    header = image.header.as_byteswapped(native_code) if image.header.endianness != native_code else \
+        image.header.copy()
+    header.set_data_shape(shape[:3])
+    header.set_data_shape(shape)
+    header.set_slope_inter(1.0, 0.0)
+    header.set_data_dtype(np.float32)
+    header['vox_offset'] = 0
+    return header
+
+
+def save_mask(file: Path, mask: np.ndarray, image: nib.Nifti1Image, shape: Tuple[int, int, int]):
+    """Save :param mask:, voxels in Fortran order, as a uint8 image of :param shape: in the space of :param image:"""
+    header = output_header(image, shape)
+    header.set_data_dtype(np.uint8)
+    nib.save(nib.Nifti1Image(mask.reshape(shape, order='F').astype(np.uint8), image.affine, header), str(file))
+
+
+def output_images(subject: Subject, num_betas: int, num_contrasts: int) -> List[Path]:
+    """Every float32 image of a model: betas, cons, spmTs, ResMS, then residuals"""
+    files = [subject.output_dir / BETA_PATTERN.format(i) for i in range(1, num_betas + 1)]
+    files += [subject.output_dir / CON_PATTERN.format(i) for i in range(1, num_contrasts + 1)]
+    files += [subject.output_dir / SPMT_PATTERN.format(i) for i in range(1, num_contrasts + 1)]
+    files.append(subject.output_dir / RESMS_NAME)
+    if subject.residuals:
+        files += [subject.output_dir / RESIDUAL_PATTERN.format(i) for i in range(1, sum(subject.scans) + 1)]
+    return files
+
+
+def write_tsv(file: Path, rows: List[List[str]]):
+    """Write to a temporary file first, so a file that exists is complete"""
+    tmp_file = file.with_name(f'{file.name}.{os.getpid()}.tmp')
+    with open(str(tmp_file), 'w') as f:
+        f.writelines('\t'.join(row) + '\n' for row in rows)
+    os.replace(str(tmp_file), str(file))
+
+
+def prepare_subject(model: Model, subject: str) -> Subject:
+    """
+    Build the design of one subject, compute the global means and mask from its runs, and create its output
+    images. Gzipped runs are decompressed into the output directory first.
+    """
+    model = subject_model(model, subject)
+    output_dir = Path(model.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if (model.motion and len(model.motion) != len(model.bold)) or len(model.conditions) != len(model.bold):
+        raise ValueError(f'{model.name} needs one conditions file (and motion file, if any) per BOLD run')
+
+    files = [Path(f) for f in model.bold]
+    temporary = [f.name.endswith('.gz') for f in files]
+    runs = [decompress(f, output_dir) if t else f for f, t in zip(files, temporary)]
+    try:
+        image = nib.load(str(runs[0]))
+        shape = tuple(image.shape[:3])
+        tr = model.tr or float(image.header.get_zooms()[3])
+        scans, scale = [], []
+        mask = np.ones(int(np.prod(shape)), dtype=bool)
+        for run in runs:
+            run_image = nib.load(str(run))
+            if tuple(run_image.shape[:3]) != shape:
+                raise ValueError(f'{run} is {run_image.shape[:3]}, the first run is {shape}')
+            means, run_mask = global_means(run)
+            scans.append(means.size)
+            scale.append(GRAND_MEAN / means.mean())
+            mask &= run_mask
+        if model.mask:
+            explicit = nib.load(model.mask)
+            mask &= np.asanyarray(explicit.dataobj).reshape(-1, order='F') > 0
+
+        conditions = [read_conditions(f) for f in model.conditions]
+        motion = [read_motion(f, n) for f, n in zip(model.motion, scans)] if model.motion else [None] * len(runs)
+        design, names = design_matrix(conditions, motion, scans, tr)
+        basis = filter_basis(scans, tr, model.high_pass)
+        contrast_names = list(model.contrasts)
+        contrasts = np.array([contrast_weights(model.contrasts[c], names) for c in contrast_names]).reshape(
+            len(contrast_names), len(names))
+
+        save_mask(output_dir / MASK_NAME, mask, image, shape)
+        header = output_header(image, shape)
+        prepared = Subject(subject, output_dir, runs, temporary, shape, scans, scale, design, names, basis,
+                           contrasts, model.noise_model, model.residuals, 0)
+        offsets = {create_image(f, header) for f in output_images(prepared, len(names), len(contrast_names))}
+        prepared = prepared._replace(data_offset=offsets.pop())
+
+        write_tsv(output_dir / CONTRASTS_NAME,
+                  [['name', 'con', 'spmT', 'weights']] +
+                  [[name, CON_PATTERN.format(i), SPMT_PATTERN.format(i), ' '.join(f'{w:g}' for w in weights)]
+                   for i, (name, weights) in enumerate(zip(contrast_names, contrasts), start=1)])
+        return prepared
+    except Exception:
+        remove_temporary(runs, temporary)
+        raise
+
+
+def fit_chunk(subject: Subject, start: int, stop: int):
+    """Fit voxels start..stop - 1 of :param subject: and write them into its output images"""
+    mask_image = nib.load(str(subject.output_dir / MASK_NAME), mmap=True)
+    in_mask = np.asanyarray(mask_image.dataobj).reshape(-1, order='F')[start:stop] > 0
+    num_betas = subject.design.shape[1]
+    num_contrasts = subject.contrasts.shape[0]
+    num_scans = sum(subject.scans)
+    num_voxels = stop - start
+    outputs = np.full((num_betas + 2 * num_contrasts + 1 + (num_scans if subject.residuals else 0), num_voxels),
+                      np.nan, dtype=np.float32)
+
+    if np.any(in_mask):
+        data = np.empty((num_scans, np.count_nonzero(in_mask)))
+        row = 0
+        for run, num_scans_run, scale in zip(subject.runs, subject.scans, subject.scale):
+            run_data, slope, inter = bold_data(run)
+            values = np.asarray(run_data[start:stop], dtype=np.float64)[in_mask].T
+            data[row:row + num_scans_run] = (values * slope + inter) * scale
+            row += num_scans_run
+        data -= subject.filter_basis @ (subject.filter_basis.T @ data)
+
+        design = subject.design - subject.filter_basis @ (subject.filter_basis.T @ subject.design)
+        pinv = np.linalg.pinv(design)
+        betas = pinv @ data
+        residuals = data - design @ betas
+        covariance = np.broadcast_to(np.einsum('ij,jk,ik->i', subject.contrasts, pinv @ pinv.T,
+                                               subject.contrasts)[:, np.newaxis], (num_contrasts, data.shape[1]))
+        if subject.noise_model == 'ar1':
+            run_starts = list(np.cumsum([0] + subject.scans[:-1]))
+            lagged = residuals[1:] * residuals[:-1]
+            lagged[np.array(run_starts[1:], dtype=np.int64) - 1] = 0.0
+            rho = lagged.sum(axis=0) / np.maximum((residuals ** 2).sum(axis=0), np.finfo(float).tiny)
+            steps = np.round(np.clip(rho, -MAX_AR1, MAX_AR1) / AR1_STEP).astype(np.int64)
+            # Whitening does not commute with the filter, so the cosines are whitened and fit with the design
+            full_design = np.column_stack([design, subject.filter_basis])
+            contrasts = np.column_stack([subject.contrasts, np.zeros((num_contrasts, subject.filter_basis.shape[1]))])
+            covariance = np.empty((num_contrasts, data.shape[1]))
+            for step in np.unique(steps):
+                voxels = np.flatnonzero(steps == step)
+                whitened_design = whiten(full_design, step * AR1_STEP, run_starts)
+                whitened_pinv = np.linalg.pinv(whitened_design)
+                whitened_data = whiten(data[:, voxels], step * AR1_STEP, run_starts)
+                full_betas = whitened_pinv @ whitened_data
+                betas[:, voxels] = full_betas[:num_betas]
+                residuals[:, voxels] = whitened_data - whitened_design @ full_betas
+                covariance[:, voxels] = np.einsum('ij,jk,ik->i', contrasts, whitened_pinv @ whitened_pinv.T,
+                                                  contrasts)[:, np.newaxis]
+
+        dof = num_scans - np.linalg.matrix_rank(design) - subject.filter_basis.shape[1]
+        resms = (residuals ** 2).sum(axis=0) / dof
+        cons = subject.contrasts @ betas
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = cons / np.sqrt(resms * covariance)
+        values = [betas, cons, t, resms[np.newaxis]] + ([residuals] if subject.residuals else [])
+        outputs[:, in_mask] = np.concatenate(values, axis=0)
+
+    for file, image in zip(output_images(subject, num_betas, num_contrasts), outputs):
+        fd = os.open(str(file), os.O_WRONLY)
+        try:
+            os.pwrite(fd, image.tobytes(), subject.data_offset + start * image.itemsize)
+        finally:
+            os.close(fd)
+
+
+def remove_temporary(runs: List[Path], temporary: List[bool]):
+    for run, is_temporary in zip(runs, temporary):
+        if is_temporary and run.exists():
+            run.unlink()
+
+
+def remove_runs(subject: Subject):
+    remove_temporary(subject.runs, subject.temporary)
+
+
+def finish_subject(subject: Subject):
+    """Write the design matrix, last, as the sign that the model is complete"""
+    write_tsv(subject.output_dir / DESIGN_NAME,
+              [subject.names] + [[f'{v:.6g}' for v in row] for row in subject.design])
+
+
+def voxel_ranges(num_voxels: int, voxel_bytes: int, memory_budget: int) -> List[Tuple[int, int]]:
+    """Consecutive ranges of :param num_voxels: voxels of :param voxel_bytes: each that fit :param memory_budget:"""
+    voxels = max(1, memory_budget // voxel_bytes)
+    return [(start, min(start + voxels, num_voxels)) for start in range(0, num_voxels, voxels)]
+
+
+def chunks(subject: Subject, memory_budget: int) -> List[Tuple[int, int]]:
+    """
+    Voxel ranges of :param subject: whose working memory fits :param memory_budget: bytes:
+    about four float64 copies of each voxel time series, and its float32 outputs
+    """
+    num_scans = sum(subject.scans)
+    voxel_bytes = num_scans * (4 * 8 + (4 if subject.residuals else 0)) + subject.design.shape[1] * 12
+    return voxel_ranges(int(np.prod(subject.shape)), voxel_bytes, memory_budget)
+
+
+def fit_subjects(model: Model, subjects: List[str], prepare: Callable, fit: Callable, ranges: Callable,
+                 finish: Callable, cleanup: Callable, done_name: str, jobs: int = 1, memory_budget: int = 1 << 30,
+                 overwrite: bool = False) -> List[str]:
+    """
+    Fit :param model: (a Model or any specification with a name and an output_dir) for each subject in one
+    process pool, skipping subjects whose output directory has :param done_name: unless :param overwrite:.
+    Each subject is prepared by prepare(model, subject) in a worker, and its voxel ranges
+    ranges(prepared, memory_budget) are fit by fit(prepared, start, stop) in workers. Then finish(prepared)
+    writes :param done_name:, and cleanup(prepared) runs whether the fit succeeded or not.
+    A subject that fails is reported and left out. :return: subjects whose model was fit
+    """
+    if not overwrite:
+        subjects = [s for s in subjects if not (Path(subject_model(model, s).output_dir) / done_name).exists()]
+    fitted = []
+    limit = max(jobs, 1)
+    waiting = deque(subjects)
+    # At most :param jobs: subjects are prepared or being fit at a time, so only their decompressed runs are on
+    # disk together. The next subjects are prepared while the chunks of the earlier ones are fit.
+    preparing, fitting = deque(), deque()
+    with ProcessPoolExecutor(max_workers=limit) as executor:
+        while waiting or preparing or fitting:
+            while waiting and len(preparing) + len(fitting) < limit:
+                subject = waiting.popleft()
+                preparing.append((subject, executor.submit(prepare, model, subject)))
+            if preparing:
+                subject, future = preparing.popleft()
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    print(f'{subject}: {type(e).__name__}: {e}', file=sys.stderr)
+                    continue
+                fitting.append((prepared, [executor.submit(fit, prepared, start, stop)
+                                           for start, stop in ranges(prepared, memory_budget)]))
+                continue
+            prepared, futures = fitting.popleft()
+            try:
+                for future in futures:
+                    future.result()
+                finish(prepared)
+                fitted.append(prepared.subject)
+                print(f'Fit {model.name} for {prepared.subject} in {prepared.output_dir}')
+            except Exception as e:
+                print(f'{prepared.subject}: {type(e).__name__}: {e}', file=sys.stderr)
+            finally:
+                cleanup(prepared)
+    return fitted
+
+
+def fit_models(model: Model, subjects: List[str], jobs: int = 1, memory_budget: int = 1 << 30,
+               overwrite: bool = False) -> List[str]:
+    """
+    Fit :param model: for each subject, skipping subjects whose model is complete unless :param overwrite:.
+    A subject that fails is reported and left out. :return: subjects whose model was fit
+    """
+    return fit_subjects(model, subjects, prepare_subject, fit_chunk, chunks, finish_subject, remove_runs,
+                        DESIGN_NAME, jobs, memory_budget, overwrite)
+
+
+def read_subject_list(file: str) -> List[str]:
+    with open(file, 'r') as f:
+        return f.read().split()
+
+
+if __name__ == "__main__":
+    description = 'Fit first level GLMs of a cohort from multiconds condition files, as SPM model estimation does'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--model', metavar='Model file', action='store',
+                        type=str, required=True,
+                        help='JSON model specification: name, bold, conditions, motion, output_dir and contrasts, '
+                             'with {subject} in paths, and optionally tr, high_pass, noise_model, mask and '
+                             'residuals.',
+                        dest='model_file')
+    parser.add_argument('-s', '--subjects', metavar='Subject list', action='store',
+                        type=str, required=True,
+                        help='file listing subject IDs, separated by whitespace.',
+                        dest='subject_list')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of subjects or chunks of voxels to process in parallel.',
+                        dest='jobs')
+    parser.add_argument('-M', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1024,
+                        help='memory budget of each job for a chunk of voxels.',
+                        dest='memory')
+    parser.add_argument('--overwrite', action='store_true',
+                        help=f'fit subjects whose model directory has {DESIGN_NAME} again.',
+                        dest='overwrite')
+    args = parser.parse_args()
+
+    subjects = read_subject_list(args.subject_list)
+    fitted = fit_models(read_model(args.model_file), subjects, args.jobs, args.memory << 20, args.overwrite)
+    print(f'Fit {len(fitted)} of {len(subjects)} subjects')
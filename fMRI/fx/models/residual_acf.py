@@ -0,0 +1,246 @@
+"""
+Estimate the spatial autocorrelation function (ACF) of first level model residuals, as 3dFWHMx -acf does,
+without merging the residual volumes of each run into a 4D file first.
+
+The Res_####.nii volumes of each run are memory-mapped one at a time, twice:
+  1. project each voxel time series on orthonormal polynomials of time, to detrend it
+  2. accumulate the power spectrum of each detrended volume within mask.nii
+Since the autocovariance is the inverse Fourier transform of the power spectrum, summing power spectra over
+volumes and transforming once per run gives the autocovariance summed over volumes. It is normalized by the
+number of voxel pairs within the mask at each lag, and the model of 3dFWHMx,
+    acf(r) = a exp(-r^2 / (2 b^2)) + (1 - a) exp(-r / c),
+is fit to it, with c at most the extent of the image. The effective FWHM is twice the radius at which the fitted
+ACF is 0.5.
+
+The subject command writes ACFparameters.1D (a b c FWHM of each run) and ACFparameters_average.1D (one value
+per line, like 3dTstat -mean). The group command averages the a b c parameters of all subjects into
+ACFparameters_group_average.txt, as calculate_group_average.R does, for 3dClustSim -acf.
+"""
+import argparse
+import sys
+from pathlib import Path
+from typing import List, Tuple
+
+import nibabel as nib
+import numpy as np
+from scipy.optimize import brentq, curve_fit
+
+RESIDUAL_PATTERN = 'Res_{:04d}.nii'
+RUN_PARAMETERS_NAME = 'ACFparameters.1D'
+AVERAGE_NAME = 'ACFparameters_average.1D'
+GROUP_AVERAGE_NAME = 'ACFparameters_group_average.txt'
+
+# Lags are fit up to the radius where the ACF first falls below this value
+MIN_ACF = 0.01
+
+
+def load_volume(file: Path) -> np.ndarray:
+    """Memory-mapped data of one 3D volume"""
+    image = nib.load(str(file), mmap=True)
+    return np.asanyarray(image.dataobj).reshape(image.shape[:3])
+
+
+def polynomial_basis(num_volumes: int, order: int) -> np.ndarray:
+    """Orthonormal polynomials of time up to :param order:, volumes x (order + 1)"""
+    t = np.linspace(-1.0, 1.0, num_volumes)
+    q, _ = np.linalg.qr(np.vander(t, min(order, num_volumes - 1) + 1, increasing=True))
+    return q
+
+
+def acf_model(r: np.ndarray, a: float, b: float, c: float) -> np.ndarray:
+    return a * np.exp(-r ** 2 / (2.0 * b ** 2)) + (1.0 - a) * np.exp(-r / c)
+
+
+def lag_distances(shape: Tuple[int, ...], voxel_size: np.ndarray) -> np.ndarray:
+    """Distance in mm of every lag of an (inverse) real FFT of :param shape:, with negative lags wrapped"""
+    axes = [np.fft.fftfreq(n, 1.0 / n) * size for n, size in zip(shape[:2], voxel_size[:2])]
+    axes.append(np.arange(shape[2] // 2 + 1) * voxel_size[2])
+    x, y, z = np.meshgrid(*axes, indexing='ij', sparse=True)
+    return np.sqrt(x ** 2 + y ** 2 + z ** 2)
+
+
+def run_autocorrelation(files: List[Path], mask: np.ndarray, voxel_size: np.ndarray,
+                        detrend_order: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spatial autocorrelation of the residuals of one run, streamed over its volumes.
+    :return: distance (mm) and ACF of each lag with a nonzero number of voxel pairs in the mask
+    """
+    basis = polynomial_basis(len(files), detrend_order)
+
+    # Pass 1: polynomial coefficients of every voxel within the mask
+    coefficients = np.zeros((basis.shape[1], np.count_nonzero(mask)))
+    for t, file in enumerate(files):
+        values = np.nan_to_num(np.asarray(load_volume(file)[mask], dtype=np.float64))
+        coefficients += np.outer(basis[t], values)
+
+    # Pass 2: power spectrum of each detrended volume, zero-padded so lags do not wrap around
+    padded_shape = tuple(2 * n for n in mask.shape)
+    power = None
+    volume = np.zeros(mask.shape)
+    for t, file in enumerate(files):
+        values = np.nan_to_num(np.asarray(load_volume(file)[mask], dtype=np.float64))
+        volume[mask] = values - basis[t] @ coefficients
+        spectrum = np.fft.rfftn(volume, s=padded_shape)
+        spectrum_power = spectrum.real ** 2 + spectrum.imag ** 2
+        if power is None:
+            power = spectrum_power
+        else:
+            power += spectrum_power
+
+    mask_spectrum = np.fft.rfftn(mask.astype(np.float64), s=padded_shape)
+    pairs = np.rint(np.fft.irfftn(mask_spectrum.real ** 2 + mask_spectrum.imag ** 2, s=padded_shape))
+    covariance = np.fft.irfftn(power, s=padded_shape)
+
+    # Keep the lags of the half-space returned by the real FFT, which covers every lag up to its sign
+    half = (slice(None), slice(None), slice(0, padded_shape[2] // 2 + 1))
+    pairs, covariance = pairs[half], covariance[half]
+    distances = lag_distances(padded_shape, voxel_size)
+    valid = pairs > 0
+    acf = covariance[valid] / pairs[valid] / (covariance[0, 0, 0] / pairs[0, 0, 0])
+    return distances[valid], acf
+
+
+def radial_profile(distances: np.ndarray, acf: np.ndarray, bin_width: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean ACF in bins of distance, up to the first bin where it falls below MIN_ACF"""
+    bins = np.rint(distances / bin_width).astype(np.int64)
+    counts = np.bincount(bins)
+    sums = np.bincount(bins, weights=acf)
+    occupied = counts > 0
+    radius = np.bincount(bins, weights=distances)[occupied] / counts[occupied]
+    profile = sums[occupied] / counts[occupied]
+    below = np.flatnonzero(profile < MIN_ACF)
+    end = below[0] if below.size else profile.size
+    return radius[:end], profile[:end]
+
+
+def fit_acf(radius: np.ndarray, profile: np.ndarray, max_c: float) -> Tuple[float, float, float, float]:
+    """
+    :return: the a, b, c parameters of acf_model() fit to the radial profile, and the effective FWHM.
+    On residuals that are close to Gaussian, c is unconstrained by the profile, so it is bounded by :param max_c:
+    """
+    half_width = radius[np.argmax(profile < 0.5)] if np.any(profile < 0.5) else radius[-1]
+    p0 = (0.5, half_width, min(2.0 * half_width, max_c / 2.0))
+    (a, b, c), _ = curve_fit(acf_model, radius, profile, p0=p0,
+                             bounds=([0.0, 1e-3, 1e-3], [1.0, np.inf, max_c]), maxfev=10000)
+    fwhm = 2.0 * brentq(lambda r: acf_model(r, a, b, c) - 0.5, 0.0, 100.0 * max(b, c))
+    return a, b, c, fwhm
+
+
+def run_volume_counts(bold_files: List[str]) -> List[int]:
+    """Number of volumes of each run, from the NIfTI headers of its BOLD files, like 3dinfo -nv"""
+    counts = []
+    for file in bold_files:
+        shape = nib.load(file).shape
+        counts.append(shape[3] if len(shape) > 3 else 1)
+    return counts
+
+
+def write_values(file: Path, rows: List[List[float]]):
+    with open(str(file), mode='w') as f:
+        f.write(''.join(' '.join(f'{v:.6g}' for v in row) + '\n' for row in rows))
+
+
+def subject(residual_dir: str, volumes: List[int], detrend_order: int = 2, remove: bool = False):
+    """
+    Estimate the ACF parameters of each run of one subject and their average.
+    Residual volumes are numbered consecutively over runs, :param volumes: per run.
+    """
+    residual_dir = Path(residual_dir)
+    mask_image = nib.load(str(residual_dir / 'mask.nii'))
+    mask = np.asanyarray(mask_image.dataobj).reshape(mask_image.shape[:3]) > 0
+    voxel_size = np.asarray(mask_image.header.get_zooms()[:3], dtype=np.float64)
+    bin_width = voxel_size.min() / 4.0
+    # c is at most the extent of the image
+    max_c = float(np.max(np.asarray(mask.shape) * voxel_size))
+
+    parameters = []
+    start = 1
+    for i, num_volumes in enumerate(volumes, start=1):
+        files = [residual_dir / RESIDUAL_PATTERN.format(j) for j in range(start, start + num_volumes)]
+        start += num_volumes
+        print(f'calculating ACF parameters for run{i}')
+        distances, acf = run_autocorrelation(files, mask, voxel_size, detrend_order)
+        parameters.append(list(fit_acf(*radial_profile(distances, acf, bin_width), max_c)))
+        if parameters[-1][2] > max_c * (1.0 - 1e-6):
+            print(f'run{i}: c is at its bound of {max_c:g} mm, the residuals are close to Gaussian and their ACF '
+                  f'parameters will make the noise fields of cluster_simulation.py wider than the mask',
+                  file=sys.stderr)
+        if remove:
+            for file in files:
+                file.unlink()
+
+    write_values(residual_dir / RUN_PARAMETERS_NAME, parameters)
+    write_values(residual_dir / AVERAGE_NAME, [[v] for v in np.mean(parameters, axis=0)])
+
+
+def read_average(file: Path) -> np.ndarray:
+    """:return: a, b, c and FWHM from an ACFparameters_average.1D file, or NaN if it cannot be read"""
+    try:
+        values = np.loadtxt(str(file), ndmin=1)
+    except ValueError:
+        values = np.empty(0)
+    if values.size != 4:
+        return np.full(4, np.nan)
+    return values
+
+
+def group(model_dir: str, output_dir: str):
+    """
+    Average the a, b and c parameters of every ACFparameters_average.1D file under :param model_dir:,
+    skipping files that cannot be read, and write them on one line for 3dClustSim -acf.
+    """
+    files = sorted(Path(model_dir).rglob(AVERAGE_NAME))
+    parameters = np.array([read_average(f) for f in files]).reshape(-1, 4)
+    average = np.nanmean(parameters, axis=0)
+    print(f'Averaged ACF parameters of {np.count_nonzero(~np.isnan(parameters[:, 0]))} of {len(files)} subjects')
+    write_values(Path(output_dir) / GROUP_AVERAGE_NAME, [list(average[:3])])
+
+
+if __name__ == "__main__":
+    description = 'Estimate ACF parameters of first level model residuals, and average them over subjects'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subject_parser = subparsers.add_parser('subject', help='ACF parameters of each run of one subject, and their average',
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subject_parser.add_argument('-r', '--residuals', metavar='Residual directory', action='store',
+                                type=str, required=True,
+                                help='directory of the first level model, containing mask.nii and Res_####.nii.',
+                                dest='residual_dir')
+    volumes = subject_parser.add_mutually_exclusive_group(required=True)
+    volumes.add_argument('-b', '--bold', metavar='BOLD file', action='store', nargs='+',
+                         type=str,
+                         help='BOLD files of each run, in order, to count the volumes of each run.',
+                         dest='bold_files')
+    volumes.add_argument('-v', '--volumes', metavar='Number of volumes', action='store', nargs='+',
+                         type=int,
+                         help='number of volumes of each run, in order.',
+                         dest='volumes')
+    subject_parser.add_argument('-d', '--detrend', metavar='Order', action='store',
+                                type=int, required=False, default=2,
+                                help='order of the polynomial removed from each voxel time series.',
+                                dest='detrend_order')
+    subject_parser.add_argument('--remove', action='store_true',
+                                help='remove the residual volumes of each run once its ACF is estimated.',
+                                dest='remove')
+
+    group_parser = subparsers.add_parser('group', help='average ACF parameters of all subjects',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    group_parser.add_argument('-m', '--model-dir', metavar='Model directory', action='store',
+                              type=str, required=True,
+                              help=f'directory searched recursively for {AVERAGE_NAME} files.',
+                              dest='model_dir')
+    group_parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                              type=str, required=True,
+                              help=f'directory for {GROUP_AVERAGE_NAME}.',
+                              dest='output_dir')
+    args = parser.parse_args()
+
+    if args.command == 'subject':
+        subject(args.residual_dir, args.volumes or run_volume_counts(args.bold_files), args.detrend_order, args.remove)
+    else:
+        group(args.model_dir, args.output_dir)
@@ -4,9 +4,8 @@
 #	* Creates a batch job for $SUB
 #	* Batch jobs are saved to the path defined in MATLAB script
 #	* Executes batch job
-#	* Merges residuals for each run separately
-#	* Calculates ACF parameters for each run separately
-#	* Averages ACF parameters and saves in ACRRVarameters_average.1D
+#	* Calculates ACF parameters for each run separately from its residuals
+#	* Averages ACF parameters and saves in ACFparameters_average.1D
 #
 # D.Cos 2018.11.06
 #--------------------------------------------------------------
@@ -28,54 +27,22 @@ echo ---------------------------------------------------------------------------
 module load matlab
 matlab -nosplash -nodisplay -nodesktop ${ADDITIONALOPTIONS} -r "clear; addpath('$SPM_PATH'); spm_jobman('initcfg'); sub='$SUB'; script_file='$SCRIPT'; replacesid='$REPLACESID'; run('make_sid_matlabbatch.m'); spm_jobman('run',matlabbatch); exit"
 
-# specify residuals
+# calculate ACF parameters
 echo -------------------------------------------------------------------------------
-echo "Specifying residuals"
+echo "Calculating ACF parameters"
 echo -------------------------------------------------------------------------------
-module load afni
+# residual_acf.py reads the Res_####.nii volumes of each run directly, instead of merging them
+# with fslmerge and running 3dFWHMx -acf and 3dTstat, and writes ACFparameters_average.1D
+# sbatch does not run this script from its directory, so the Python scripts are called by absolute path
+SCRIPTS_DIR=${SCRIPTS_DIR:-/projects/${LAB}/shared/${STUDY}/${STUDY}_scripts}
 sub_bids_dir=/projects/${LAB}/shared/${STUDY}/bids_data/sub-${SUB}/${SES}/func
 RUNS=$(ls *${TASK}*.nii.gz | wc -l)
-start=1
-stop=0
-
+bold_files=()
 for i in $(seq 1 $RUNS); do 
-	file=${sub_bids_dir}/sub-${SUB}_${SES}_task-${TASK}${i}_bold.nii.gz
-	nvols=`3dinfo -nv ${file}`
-	stop=$(($stop + $nvols))
-	for j in $(seq $start $stop); do 
-		printf "Res_%04d.nii\n" $j >> ${RES_DIR}/residuals_run${i}.txt 
-	done
-	start=$(($start + $nvols))
+	bold_files+=(${sub_bids_dir}/sub-${SUB}_${SES}_task-${TASK}${i}_bold.nii.gz)
 done
 
-# merge residual files
-echo -------------------------------------------------------------------------------
-echo "Merging residuals"
-echo -------------------------------------------------------------------------------
-
-module load fsl
-cd ${RES_DIR}
-
-for i in $(seq 1 $RUNS)
-	do echo "merging residuals for run${i}"
-	residual_files=`cat ${RES_DIR}/residuals_run${i}.txt`
-	fslmerge -t residuals_run${i} ${residual_files}
-	rm ${residual_files}
-done
+# number of volumes of each run, from the header index of the BIDS tree (see fMRI/utils/nifti_index.py)
+volumes=$(python3 ${SCRIPTS_DIR}/fMRI/utils/nifti_index.py query -x /projects/${LAB}/shared/${STUDY}/bids_data/.nifti_index.json -f nv ${bold_files[@]})
 
-# run 3dFWHMx
-echo -------------------------------------------------------------------------------
-echo "Calculating ACF parameters"
-echo -------------------------------------------------------------------------------
-
-module load afni
-for i in $(seq 1 $RUNS)
-	do echo "calculating ACF parameters for run${i}"
-	3dFWHMx -acf -mask mask.nii residuals_run${i}.nii.gz >> ACFparameters.1D
-done
-
-# average ACF parameters
-echo -------------------------------------------------------------------------------
-echo "Averaging ACF parameters"
-echo -------------------------------------------------------------------------------
-3dTstat -mean -prefix - ACFparameters.1D'{1..$(2)}'\' >> ACFparameters_average.1D
+python3 ${SCRIPTS_DIR}/fMRI/fx/models/residual_acf.py subject --residuals ${RES_DIR} --volumes ${volumes} --remove
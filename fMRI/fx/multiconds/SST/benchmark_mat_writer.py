@@ -0,0 +1,104 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.io
+
+from mat_writer import write_multiple_conditions
+
+
+def synthetic_conditions(num_conditions: int, num_onsets: int, seed: int = 0):
+    """
+    Conditions with random onsets and durations. Every fifth condition is empty,
+    like a condition that a subject has no trials of.
+    """
+    rng = np.random.default_rng(seed)
+    names = [f'condition{i}' for i in range(1, num_conditions + 1)]
+    counts = [0 if i % 5 == 4 else num_onsets for i in range(num_conditions)]
+    onsets = [np.sort(rng.uniform(0, 600, size=n)) for n in counts]
+    durations = [rng.uniform(0.5, 1.5, size=n) for n in counts]
+    pmod = [[('rt', rng.uniform(0.3, 1.0, size=n), 1)] if n else [] for n in counts]
+    return names, onsets, durations, pmod
+
+
+def savemat_conditions(file: Path, names, onsets, durations):
+    """scipy.io.savemat with object arrays of Nx1 arrays, as multiconds.py used to write conditions"""
+    names = np.asarray(names, dtype=object)
+    onset_cells = np.zeros((len(names),), dtype=object)
+    duration_cells = np.zeros((len(names),), dtype=object)
+    for i, (onset, duration) in enumerate(zip(onsets, durations)):
+        onset_cells[i] = onset.reshape(len(onset), 1)
+        duration_cells[i] = duration.reshape(len(duration), 1)
+    scipy.io.savemat(str(file), {'names': names, 'onsets': onset_cells, 'durations': duration_cells})
+
+
+def check_round_trip(file: Path, names, onsets, durations, pmod):
+    """Read :param file: back with scipy.io.loadmat and compare every cell"""
+    data = scipy.io.loadmat(str(file))
+    for i, name in enumerate(names):
+        if data['names'][0, i][0] != name:
+            raise AssertionError(f'names{{{i + 1}}} differs')
+        for variable, values in (('onsets', onsets), ('durations', durations)):
+            cell = data[variable][0, i]
+            if cell.shape != (len(values[i]), 1) or not np.array_equal(cell[:, 0], values[i]):
+                raise AssertionError(f'{variable}{{{i + 1}}} differs')
+        for j, (pmod_name, param, poly) in enumerate(pmod[i]):
+            element = data['pmod'][0, i]
+            if (element['name'][0, j][0] != pmod_name or element['poly'][0, j][0, 0] != poly or
+                    not np.array_equal(element['param'][0, j][:, 0], param)):
+                raise AssertionError(f'pmod({i + 1}) differs')
+
+
+def time_writer(writer, num_files: int) -> float:
+    """:return: wall time in seconds to write :param num_files: files"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        for i in range(num_files):
+            writer(Path(tmp_dir) / f'conditions{i}.mat')
+        return time.perf_counter() - start
+
+
+def main(num_files: int, num_conditions: int, num_onsets: int):
+    names, onsets, durations, pmod = synthetic_conditions(num_conditions, num_onsets)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file = Path(tmp_dir) / 'conditions.mat'
+        write_multiple_conditions(file, names, onsets, durations, pmod)
+        check_round_trip(file, names, onsets, durations, pmod)
+    print('Round trip through scipy.io.loadmat: OK')
+
+    savemat_time = time_writer(lambda f: savemat_conditions(f, names, onsets, durations), num_files)
+    writer_time = time_writer(lambda f: write_multiple_conditions(f, names, onsets, durations), num_files)
+    print(f'{num_files} files x {num_conditions} conditions x {num_onsets} onsets')
+    print(f'scipy.io.savemat: {savemat_time:8.3f} s ({num_files / savemat_time:8.1f} files/s)')
+    print(f'mat_writer:       {writer_time:8.3f} s ({num_files / writer_time:8.1f} files/s), '
+          f'speedup {savemat_time / writer_time:5.1f}x')
+
+
+if __name__ == "__main__":
+    description = 'Check the SPM multiple conditions writer against scipy.io.loadmat and benchmark it'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-n', '--files', metavar='Number of files', action='store',
+                        type=int, required=False, default=500,
+                        help='number of files to write.',
+                        dest='num_files'
+                        )
+    parser.add_argument('-c', '--conditions', metavar='Number of conditions', action='store',
+                        type=int, required=False, default=250,
+                        help='number of conditions per file.',
+                        dest='num_conditions'
+                        )
+    parser.add_argument('-o', '--onsets', metavar='Number of onsets', action='store',
+                        type=int, required=False, default=5,
+                        help='number of onsets per condition.',
+                        dest='num_onsets'
+                        )
+    args = parser.parse_args()
+
+    main(args.num_files, args.num_conditions, args.num_onsets)
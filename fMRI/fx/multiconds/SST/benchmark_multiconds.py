@@ -0,0 +1,280 @@
+"""
+Benchmark each stage of the SST multiconds pipeline, and multiconds.main() end to end, on synthetic cohorts
+(see synthetic_cohort.py) of several sizes.
+
+For each stage, the wall time (best of --repeat runs over every subject of the cohort), the peak resident set
+size during the stage, and the number of files it writes are recorded. Results are compared to a JSON baseline:
+a stage regresses if it is slower or uses more memory than its baseline by more than --threshold (and by more
+than --min-time seconds, so that very fast stages do not fail on timer noise), or writes a different number
+of files. The benchmark exits with status 1 if any stage regresses.
+
+The baseline is written when it does not exist yet, or with --update. Baselines are only comparable on the
+same machine; the Python and numpy versions and the number of jobs they were recorded with are stored with them.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+import multiconds
+import multiconds_latent_class
+import multiconds_rescorla_wagner
+from synthetic_cohort import STUDY_ID, write_synthetic_cohort
+
+DEFAULT_COHORTS = ['20x256', '100x256']
+BASELINE_NAME = 'benchmark_multiconds_baseline.json'
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS, where Linux allows it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """:return: peak resident set size in bytes, of this process and of its largest child process"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return max(int(line.split()[1]) * 1024, children)
+    except OSError:
+        pass
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, children)
+
+
+def count_files(directory: Path) -> int:
+    return sum(len(files) for _, _, files in os.walk(str(directory)))
+
+
+def measure(stage: Callable[[Path], None], work_dir: Path, repeat: int) -> Dict:
+    """
+    Run :param stage: :param repeat: times, each in a new empty output directory under :param work_dir:
+    :return: best wall time in seconds, peak RSS in bytes, and number of files written by one run
+    """
+    best = float('inf')
+    peak = 0
+    files_written = 0
+    for i in range(repeat):
+        output_dir = work_dir / f'output{i}'
+        output_dir.mkdir()
+        reset_peak_rss()
+        start = time.perf_counter()
+        stage(output_dir)
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, peak_rss())
+        files_written = count_files(output_dir)
+        shutil.rmtree(str(output_dir))
+    return {'wall_time': best, 'peak_rss': peak, 'files_written': files_written}
+
+
+def cohort_stages(input_dir: Path, jobs: int) -> Dict[str, Callable[[Path], None]]:
+    """
+    Each stage of the pipeline as a function of an output directory, on the cohort in :param input_dir:.
+    Inputs of each stage are computed beforehand, so only the stage itself is timed.
+    """
+    csv_files = sorted(input_dir.glob(f'{STUDY_ID}*_stopsignal_fMRI_clean.csv'))
+    tsv_files = sorted(input_dir.glob('*_task-SST_acq-1_events.tsv'))
+    data = [multiconds.csv_data_read(f, f'{i + 1:03d}') for i, f in enumerate(csv_files)]
+    conditions = [multiconds.create_conditions(events) for events in data]
+    moving_average = [multiconds.create_moving_average_conditions(events) for events in data]
+
+    def csv_data_read(_: Path):
+        for i, f in enumerate(csv_files):
+            multiconds.csv_data_read(f, f'{i + 1:03d}')
+
+    def group_conditions(_: Path):
+        for events in data:
+            events.conditions()
+            events.go_no_go()
+
+    def create_conditions(_: Path):
+        for events in data:
+            multiconds.create_conditions(events)
+
+    def create_moving_average_conditions(_: Path):
+        for events in data:
+            multiconds.create_moving_average_conditions(events)
+
+    def write_mat(output_dir: Path):
+        for i, f in enumerate(csv_files):
+            multiconds.write_conditions(output_dir, f'{f.stem}_SST1.mat', conditions[i])
+            multiconds.write_conditions(output_dir, f'{f.stem}_moving_average.mat', moving_average[i])
+
+    def write_tsv(output_dir: Path):
+        for events in data:
+            multiconds.write_text_events(output_dir, '1', events)
+
+    def read_tsv_latent_class(_: Path):
+        for f in tsv_files:
+            multiconds_latent_class.tsv_data_read_for_latent_class(f)
+
+    def read_tsv_rescorla_wagner(_: Path):
+        for f in tsv_files:
+            multiconds_rescorla_wagner.tsv_data_read_for_rescorla_wagner(f)
+            multiconds_rescorla_wagner.tsv_data_read_go_no_go(f)
+
+    def end_to_end(output_dir: Path):
+        # main() writes next to its inputs, so each run gets a fresh copy of the .csv files. Copying is not
+        # part of the pipeline, but it is small next to it.
+        for f in csv_files:
+            shutil.copy(str(f), str(output_dir / f.name))
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = multiconds.main(str(output_dir), jobs=jobs, force=True)
+        failed = [result.subject_id for result in results if result.error is not None]
+        if failed:
+            raise RuntimeError(f'multiconds.main() failed for subjects {failed}')
+        for f in csv_files:
+            (output_dir / f.name).unlink()
+
+    return {'csv_data_read': csv_data_read,
+            'group_conditions': group_conditions,
+            'create_conditions': create_conditions,
+            'create_moving_average_conditions': create_moving_average_conditions,
+            'write_mat': write_mat,
+            'write_tsv': write_tsv,
+            'read_tsv_latent_class': read_tsv_latent_class,
+            'read_tsv_rescorla_wagner': read_tsv_rescorla_wagner,
+            'main': end_to_end}
+
+
+def parse_cohort(cohort: str) -> Tuple[int, int]:
+    """:return: number of subjects and trials of a cohort size written as <subjects>x<trials>"""
+    num_subjects, num_trials = (int(v) for v in cohort.lower().split('x'))
+    return num_subjects, num_trials
+
+
+def benchmark_cohort(cohort: str, repeat: int, jobs: int, seed: int) -> Dict[str, Dict]:
+    num_subjects, num_trials = parse_cohort(cohort)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = Path(tmp_dir) / 'input'
+        write_synthetic_cohort(input_dir, num_subjects, num_trials, seed)
+        work_dir = Path(tmp_dir) / 'work'
+        work_dir.mkdir()
+        return {name: measure(stage, work_dir, repeat) for name, stage in cohort_stages(input_dir, jobs).items()}
+
+
+def environment(jobs: int) -> Dict:
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'jobs': jobs}
+
+
+def compare(results: Dict[str, Dict[str, Dict]], baseline: Dict[str, Dict[str, Dict]],
+            threshold: float, min_time: float) -> List[str]:
+    """:return: a description of each regression of :param results: relative to :param baseline:"""
+    regressions = []
+    for cohort, stages in results.items():
+        for name, result in stages.items():
+            reference = baseline.get(cohort, {}).get(name)
+            if reference is None:
+                continue
+            time_limit = max(reference['wall_time'] * (1.0 + threshold), reference['wall_time'] + min_time)
+            if result['wall_time'] > time_limit:
+                regressions.append(f'{cohort} {name}: {result["wall_time"]:.3f} s, '
+                                   f'baseline {reference["wall_time"]:.3f} s')
+            if result['peak_rss'] > reference['peak_rss'] * (1.0 + threshold):
+                regressions.append(f'{cohort} {name}: peak RSS {result["peak_rss"] >> 20} MB, '
+                                   f'baseline {reference["peak_rss"] >> 20} MB')
+            if result['files_written'] != reference['files_written']:
+                regressions.append(f'{cohort} {name}: {result["files_written"]} files written, '
+                                   f'baseline {reference["files_written"]}')
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, Dict]], baseline: Dict[str, Dict[str, Dict]]):
+    for cohort, stages in results.items():
+        print(f'{cohort} (subjects x trials)')
+        for name, result in stages.items():
+            reference = baseline.get(cohort, {}).get(name)
+            change = f' ({result["wall_time"] / reference["wall_time"]:5.2f}x baseline)' \
+                if reference and reference['wall_time'] > 0 else ''
+            print(f'  {name:>32}: {result["wall_time"]:8.3f} s{change}, peak RSS {result["peak_rss"] >> 20:6d} MB, '
+                  f'{result["files_written"]:6d} files')
+
+
+def main(cohorts: List[str], repeat: int, jobs: int, seed: int, baseline_file: str, threshold: float,
+         min_time: float, update: bool) -> int:
+    results = {cohort: benchmark_cohort(cohort, repeat, jobs, seed) for cohort in cohorts}
+
+    baseline = {'environment': {}, 'results': {}}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment(jobs):
+            print(f'Baseline was recorded with {baseline["environment"]}, this run uses {environment(jobs)}')
+    print_results(results, baseline['results'])
+
+    regressions = compare(results, baseline['results'], threshold, min_time)
+    if update or not os.path.exists(baseline_file):
+        baseline['environment'] = environment(jobs)
+        baseline['results'].update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f'Wrote baseline {baseline_file}')
+        return 0
+
+    if regressions:
+        print(f'{len(regressions)} regressions beyond {threshold:.0%} of {baseline_file}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print(f'No regressions beyond {threshold:.0%} of {baseline_file}')
+    return 0
+
+
+if __name__ == "__main__":
+    description = 'Benchmark the stages of the SST multiconds pipeline on synthetic cohorts against a baseline'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-c', '--cohorts', metavar='Cohort size', action='store', nargs='+',
+                        type=str, required=False, default=DEFAULT_COHORTS,
+                        help='cohort sizes to benchmark, as <subjects>x<trials>.',
+                        dest='cohorts')
+    parser.add_argument('-r', '--repeat', metavar='Repeats', action='store',
+                        type=int, required=False, default=3,
+                        help='number of times to repeat each measurement.',
+                        dest='repeat')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of jobs of multiconds.main().',
+                        dest='jobs')
+    parser.add_argument('--seed', metavar='Seed', action='store',
+                        type=int, required=False, default=0,
+                        help='seed of the synthetic cohorts.',
+                        dest='seed')
+    parser.add_argument('-b', '--baseline', metavar='Baseline', action='store',
+                        type=str, required=False, default=BASELINE_NAME,
+                        help='JSON baseline to compare with, written if it does not exist.',
+                        dest='baseline_file')
+    parser.add_argument('-t', '--threshold', metavar='Threshold', action='store',
+                        type=float, required=False, default=0.25,
+                        help='relative increase of wall time or peak RSS over the baseline that fails the benchmark.',
+                        dest='threshold')
+    parser.add_argument('--min-time', metavar='Seconds', action='store',
+                        type=float, required=False, default=0.01,
+                        help='smallest increase of wall time over the baseline that fails the benchmark.',
+                        dest='min_time')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='record the results as the new baseline, instead of comparing.',
+                        dest='update')
+    args = parser.parse_args()
+
+    sys.exit(main(args.cohorts, args.repeat, args.jobs, args.seed, args.baseline_file, args.threshold,
+                  args.min_time, args.update))
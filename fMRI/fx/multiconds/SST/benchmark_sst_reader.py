@@ -0,0 +1,108 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Callable
+
+import numpy as np
+
+from sst_reader import read_sst_csv, read_events_tsv, TRIAL_TYPE_NAMES
+from synthetic_cohort import STUDY_ID, write_synthetic_cohort
+
+
+def legacy_image_name_converter(s: bytes) -> int:
+    if s.startswith(b'healthy') or s.startswith(b'p3healthy') or s.startswith(b'bird'):
+        return 1
+    else:
+        return 0
+
+
+def legacy_csv_data_read(file: Path):
+    """np.loadtxt with a Python converter per row, as multiconds.csv_data_read used to do"""
+    trial_number, start_time, duration, reaction_time, is_go_trial = np.loadtxt(str(file),
+                                                                                delimiter=',',
+                                                                                skiprows=1,
+                                                                                usecols=(7, 9, 10, 13, 23),
+                                                                                converters={23: legacy_image_name_converter},
+                                                                                unpack=True)
+    return trial_number, start_time, duration, reaction_time, is_go_trial
+
+
+def legacy_trial_type_converter(s: bytes) -> int:
+    for code, name in enumerate(TRIAL_TYPE_NAMES):
+        if s.startswith(name.encode()):
+            return code
+    return -1
+
+
+def legacy_tsv_data_read(file: Path):
+    """np.loadtxt with a Python converter per row, as the downstream readers used to do"""
+    return np.loadtxt(str(file),
+                      delimiter='\t',
+                      skiprows=1,
+                      converters={2: legacy_trial_type_converter},
+                      unpack=True)
+
+
+def time_reader(reader: Callable, files: List[Path], repeat: int) -> float:
+    """:return: best wall time in seconds to read all :param files: out of :param repeat: runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for f in files:
+            reader(f)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_equal(legacy_reader: Callable, reader: Callable, files: List[Path]):
+    for f in files:
+        for legacy, new in zip(legacy_reader(f), reader(f)):
+            if not np.array_equal(legacy, new):
+                raise AssertionError(f'Readers disagree on {f}')
+
+
+def main(num_subjects: int, num_trials: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = Path(tmp_dir)
+        write_synthetic_cohort(output_dir, num_subjects, num_trials)
+        csv_files = sorted(output_dir.glob(f'{STUDY_ID}*stopsignal_fMRI_clean.csv'))
+        tsv_files = sorted(output_dir.glob('*_task-SST_acq-1_events.tsv'))
+
+        check_equal(legacy_csv_data_read, read_sst_csv, csv_files)
+        check_equal(legacy_tsv_data_read, read_events_tsv, tsv_files)
+
+        print(f'{num_subjects} subjects x {num_trials} trials, best of {repeat}')
+        for name, legacy_reader, reader, files in (('csv', legacy_csv_data_read, read_sst_csv, csv_files),
+                                                   ('events.tsv', legacy_tsv_data_read, read_events_tsv, tsv_files)):
+            legacy_time = time_reader(legacy_reader, files, repeat)
+            new_time = time_reader(reader, files, repeat)
+            print(f'{name:>10}: loadtxt+converters {legacy_time:8.3f} s, '
+                  f'columnar {new_time:8.3f} s, speedup {legacy_time / new_time:5.1f}x')
+
+
+if __name__ == "__main__":
+    description = 'Benchmark the columnar SST readers against np.loadtxt with Python converters'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-n', '--subjects', metavar='Number of subjects', action='store',
+                        type=int, required=False, default=300,
+                        help='number of synthetic subjects.',
+                        dest='num_subjects'
+                        )
+    parser.add_argument('-t', '--trials', metavar='Number of trials', action='store',
+                        type=int, required=False, default=256,
+                        help='number of trials per subject.',
+                        dest='num_trials'
+                        )
+    parser.add_argument('-r', '--repeat', metavar='Repeats', action='store',
+                        type=int, required=False, default=3,
+                        help='number of times to repeat each measurement.',
+                        dest='repeat'
+                        )
+    args = parser.parse_args()
+
+    main(args.num_subjects, args.num_trials, args.repeat)
@@ -0,0 +1,158 @@
+"""
+Cohort-level columnar store of SST events, written by multiconds.py and read by the downstream scripts.
+
+The store is a directory holding one raw binary file per column and an index:
+
+    onset.bin       float64  onset of each event (seconds)
+    duration.bin    float64  duration of each event (seconds)
+    trial_type.bin  int8     trial type code (see sst_reader.TRIAL_TYPE_NAMES)
+    subject.bin     int32    position of the subject in the index
+    index.json      subject IDs, the offset of each subject's first event in the column files, and their generation
+
+Events of a subject are contiguous, so the whole cohort is loaded with one memory map per column
+and a subject's events are a slice. New subjects are appended to the end of the column files.
+
+Onsets and durations are stored rounded to the 5 decimals of the events.tsv files, so that reading the store
+gives the same values as reading the events.tsv files.
+
+When subjects are replaced, the store is rewritten to column files of the next generation (onset.1.bin, ...),
+and the index is swapped to them last. Until then, the index and the column files of the old generation are
+left untouched, so the old store stays valid during a rewrite.
+"""
+import json
+import os
+from os import PathLike
+from pathlib import Path
+from typing import Union, Dict, List, Tuple, NamedTuple
+
+import numpy as np
+
+STORE_NAME = 'events_store'
+INDEX_NAME = 'index.json'
+COLUMNS = {'onset': np.float64,
+           'duration': np.float64,
+           'trial_type': np.int8,
+           'subject': np.int32}
+# Decimals of the onsets and durations of events.tsv files
+DECIMALS = 5
+
+
+class EventStore(NamedTuple):
+    subjects: List[str]
+    offsets: np.ndarray
+    onset: np.ndarray
+    duration: np.ndarray
+    trial_type: np.ndarray
+    subject: np.ndarray
+
+
+def store_path(input_dir: Union[PathLike, str]) -> Path:
+    return Path(input_dir) / STORE_NAME
+
+
+def read_index(store_dir: Path) -> Dict:
+    path = store_dir / INDEX_NAME
+    if not path.exists():
+        return {'subjects': [], 'offsets': [0], 'generation': 0}
+    with open(str(path), 'r') as f:
+        index = json.load(f)
+    # Stores written before column files had generations are generation 0
+    index.setdefault('generation', 0)
+    return index
+
+
+def column_path(store_dir: Path, name: str, generation: int) -> Path:
+    if generation == 0:
+        return store_dir / f'{name}.bin'
+    return store_dir / f'{name}.{generation}.bin'
+
+
+def tsv_precision(values: np.ndarray) -> np.ndarray:
+    """:return: :param values: as they are read back from an events.tsv file, formatted with DECIMALS decimals"""
+    if len(values) == 0:
+        return np.asarray(values, dtype=np.float64)
+    return np.char.mod(f'%.{DECIMALS}f', values).astype(np.float64)
+
+
+def write_index(store_dir: Path, index: Dict):
+    path = store_dir / INDEX_NAME
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(str(tmp_path), 'w') as f:
+        json.dump(index, f)
+    os.replace(str(tmp_path), str(path))
+
+
+def load_event_store(store_dir: Union[PathLike, str]) -> EventStore:
+    """
+    Memory map every column of the store in :param store_dir:
+    """
+    store_dir = Path(store_dir)
+    index = read_index(store_dir)
+    num_events = index['offsets'][-1]
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        if num_events == 0:
+            # np.memmap cannot map an empty file
+            columns[name] = np.empty((0,), dtype=dtype)
+        else:
+            columns[name] = np.memmap(str(column_path(store_dir, name, index['generation'])),
+                                      dtype=dtype, mode='r', shape=(num_events,))
+    return EventStore(subjects=index['subjects'], offsets=np.asarray(index['offsets'], dtype=np.int64), **columns)
+
+
+def subject_events(store: EventStore, subject_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :return: onset, duration and trial type codes of :param subject_id:, as views into the store
+    """
+    i = store.subjects.index(subject_id)
+    events = slice(store.offsets[i], store.offsets[i + 1])
+    return store.onset[events], store.duration[events], store.trial_type[events]
+
+
+def write_event_store(store_dir: Union[PathLike, str],
+                      events: List[Tuple[str, np.ndarray, np.ndarray, np.ndarray]]):
+    """
+    Add the events of subjects to the store in :param store_dir:
+    :param events: list of (subject ID, onset, duration, trial type codes)
+
+    New subjects are appended. If a subject is already in the store, the store is rewritten
+    without its old events to the next generation of column files.
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    index = read_index(store_dir)
+
+    old_generation = index['generation']
+    replaced = {subject_id for subject_id, *_ in events} & set(index['subjects'])
+    if replaced:
+        store = load_event_store(store_dir)
+        kept = [(subject_id, *(np.array(column) for column in subject_events(store, subject_id)))
+                for subject_id in store.subjects if subject_id not in replaced]
+        del store
+        index = {'subjects': [], 'offsets': [0], 'generation': old_generation + 1}
+        events = kept + list(events)
+
+    subjects = list(index['subjects'])
+    offsets = list(index['offsets'])
+    new_columns = {name: [] for name in COLUMNS}
+    for subject_id, onset, duration, trial_type in events:
+        new_columns['onset'].append(tsv_precision(onset))
+        new_columns['duration'].append(tsv_precision(duration))
+        new_columns['trial_type'].append(trial_type)
+        new_columns['subject'].append(np.full(len(onset), len(subjects)))
+        subjects.append(subject_id)
+        offsets.append(offsets[-1] + len(onset))
+
+    for name, dtype in COLUMNS.items():
+        # A rewrite goes to new files, which the old index does not refer to. Appends only add events past the
+        # end of the old index, after dropping anything written after it, e.g. by an interrupted run.
+        with open(str(column_path(store_dir, name, index['generation'])), 'wb' if replaced else 'ab') as f:
+            f.truncate(index['offsets'][-1] * np.dtype(dtype).itemsize)
+            for column in new_columns[name]:
+                f.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+
+    # The index is swapped last, and atomically, so readers see either the old or the new store
+    write_index(store_dir, {'subjects': subjects, 'offsets': offsets, 'generation': index['generation']})
+    if replaced:
+        for name in COLUMNS:
+            column_path(store_dir, name, old_generation).unlink(missing_ok=True)
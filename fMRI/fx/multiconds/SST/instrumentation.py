@@ -0,0 +1,231 @@
+"""
+Opt-in timing and I/O instrumentation of the stages of the multiconds tools.
+
+Instrumentation is enabled by the --profile option of multiconds.py, multiconds_rescorla_wagner.py and
+multiconds_latent_class.py, or by setting the environment variable SST_PROFILE to the path of a trace file
+(or to 1, for sst_profile.jsonl in the working directory). Worker processes inherit the variable, so
+subjects processed in parallel are traced too.
+
+Each stage (a function decorated with @timed, or a block in a stage() context) is written to the trace as one
+JSON line, an event in the Chrome trace format:
+    {"name": "csv_data_read", "ph": "X", "ts": ..., "dur": ..., "pid": ..., "tid": ...,
+     "args": {"subject": "001", "read_bytes": ..., "write_bytes": ..., "opens": ...}}
+Bytes are counted by the read and write system calls of the process (/proc/self/io, Linux only), and opens by
+the "open" audit event of Python, which open(), os.open() and numpy's readers raise. Counts of a stage include
+its nested stages.
+At exit, a summary of every stage over all processes is printed to stderr. Run this module on a trace to print
+the summary again, or to convert the trace into a JSON array that chrome://tracing and Perfetto open.
+
+When instrumentation is off, a stage costs a single flag check.
+"""
+import argparse
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+ENV_VAR = 'SST_PROFILE'
+# Process that enabled instrumentation, the only one that prints the summary
+ROOT_ENV_VAR = 'SST_PROFILE_ROOT'
+DEFAULT_TRACE_NAME = 'sst_profile.jsonl'
+
+_enabled = False
+_trace_file = None
+_trace_fd = None
+_open_count = 0
+_subjects = threading.local()
+IO_FILE = '/proc/self/io'
+
+
+def _count_opens(event: str, args: Tuple):
+    global _open_count
+    if event == 'open' and args[0] != IO_FILE:
+        _open_count += 1
+
+
+def io_counters() -> Tuple[int, int, int]:
+    """
+    :return: bytes read and written by this process, or zeros where /proc/self/io is not available,
+    and the bytes read to get them, which the counters do not include yet
+    """
+    try:
+        fd = os.open(IO_FILE, os.O_RDONLY)
+        try:
+            data = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+        counters = dict(line.split(b':') for line in data.splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar']), len(data)
+    except (OSError, KeyError, ValueError):
+        return 0, 0, 0
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(trace_file: str = DEFAULT_TRACE_NAME):
+    """Trace the stages of this process, and of worker processes started after this, to :param trace_file:"""
+    global _enabled, _trace_file, _trace_fd
+    if _enabled:
+        return
+    if trace_file in ('1', ''):
+        trace_file = DEFAULT_TRACE_NAME
+    _trace_file = os.path.abspath(trace_file)
+    os.environ[ENV_VAR] = _trace_file
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    if ROOT_ENV_VAR not in os.environ:
+        os.environ[ROOT_ENV_VAR] = str(os.getpid())
+        flags |= os.O_TRUNC
+        atexit.register(print_summary)
+    # Every event is a single write to a file opened for appending, so processes do not interleave lines
+    _trace_fd = os.open(_trace_file, flags, 0o644)
+    sys.addaudithook(_count_opens)
+    _enabled = True
+
+
+class Stage:
+    """Context of one stage. Nested stages without a subject are attributed to the subject of the enclosing one."""
+    __slots__ = ('name', 'subject', 'previous_subject', 'timestamp', 'start', 'read_bytes', 'write_bytes', 'opens')
+
+    def __init__(self, name: str, subject: Optional[str]):
+        self.name = name
+        self.subject = subject
+
+    def __enter__(self):
+        self.previous_subject = getattr(_subjects, 'current', None)
+        if self.subject is None:
+            self.subject = self.previous_subject
+        _subjects.current = self.subject
+        read_bytes, self.write_bytes, own_bytes = io_counters()
+        self.read_bytes = read_bytes + own_bytes
+        self.opens = _open_count
+        self.timestamp = time.time_ns() // 1000
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = (time.perf_counter() - self.start) * 1e6
+        read_bytes, write_bytes, _ = io_counters()
+        _subjects.current = self.previous_subject
+        event = {'name': self.name, 'ph': 'X', 'ts': self.timestamp, 'dur': round(duration, 1),
+                 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'args': {'subject': self.subject,
+                          'read_bytes': read_bytes - self.read_bytes,
+                          'write_bytes': write_bytes - self.write_bytes,
+                          'opens': _open_count - self.opens,
+                          'error': exc_type is not None}}
+        os.write(_trace_fd, (json.dumps(event) + '\n').encode())
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str, subject: Optional[str] = None):
+    """
+    Context of a stage named :param name:, of :param subject: if given
+        with instrumentation.stage('event_store'):
+            ...
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return Stage(name, subject)
+
+
+def timed(function: Callable = None, *, name: str = None):
+    """Decorator that traces every call of a function as a stage, named after the function by default"""
+    if function is None:
+        return functools.partial(timed, name=name)
+    stage_name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with Stage(stage_name, None):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def read_trace(trace_file: str) -> List[Dict]:
+    with open(trace_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(events: List[Dict]) -> Dict[str, Dict]:
+    """:return: per stage, the number of calls and subjects, and total and largest time, bytes and opens"""
+    summary = {}
+    for event in events:
+        entry = summary.setdefault(event['name'], {'calls': 0, 'subjects': set(), 'errors': 0, 'total_ms': 0.0,
+                                                   'max_ms': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'opens': 0})
+        args = event['args']
+        entry['calls'] += 1
+        entry['subjects'].add(args['subject'])
+        entry['errors'] += int(args['error'])
+        entry['total_ms'] += event['dur'] / 1000.0
+        entry['max_ms'] = max(entry['max_ms'], event['dur'] / 1000.0)
+        for counter in ('read_bytes', 'write_bytes', 'opens'):
+            entry[counter] += args[counter]
+    for entry in summary.values():
+        entry['subjects'] = len(entry['subjects'] - {None})
+    return summary
+
+
+def print_summary(trace_file: str = None, file=None):
+    """Print the summary of every stage in :param trace_file:, by default the trace of this run"""
+    trace_file = trace_file or _trace_file
+    file = file or sys.stderr
+    if trace_file is None or not os.path.exists(trace_file):
+        return
+    summary = summarize(read_trace(trace_file))
+    print(f'Stages traced in {trace_file}, by total time:', file=file)
+    print(f'{"stage":>34} {"calls":>7} {"subjects":>8} {"total ms":>10} {"mean ms":>9} {"max ms":>9} '
+          f'{"read KB":>9} {"written KB":>10} {"opens":>6} {"errors":>6}', file=file)
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+        print(f'{name:>34} {entry["calls"]:7d} {entry["subjects"]:8d} {entry["total_ms"]:10.1f} '
+              f'{entry["total_ms"] / entry["calls"]:9.3f} {entry["max_ms"]:9.3f} {entry["read_bytes"] >> 10:9d} '
+              f'{entry["write_bytes"] >> 10:10d} {entry["opens"]:6d} {entry["errors"]:6d}', file=file)
+
+
+def write_chrome_trace(trace_file: str, output_file: str):
+    with open(output_file, 'w') as f:
+        json.dump({'traceEvents': read_trace(trace_file), 'displayTimeUnit': 'ms'}, f)
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
+
+
+if __name__ == "__main__":
+    description = 'Summarize a trace of the multiconds tools, or convert it for chrome://tracing'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('trace_file', metavar='Trace',
+                        type=str,
+                        help='trace written with --profile or SST_PROFILE.')
+    parser.add_argument('-c', '--chrome', metavar='Chrome trace', action='store',
+                        type=str, required=False, default=None,
+                        help='write the trace as a JSON object for chrome://tracing or Perfetto.',
+                        dest='chrome_file')
+    args = parser.parse_args()
+
+    print_summary(args.trace_file, sys.stdout)
+    if args.chrome_file:
+        write_chrome_trace(args.trace_file, args.chrome_file)
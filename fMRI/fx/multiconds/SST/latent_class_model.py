@@ -0,0 +1,274 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Covariance families, named as in mclust. The volume, shape and orientation of each component's
+# covariance is Equal, Variable or the Identity:
+#   EII: spherical, equal volume        lambda I
+#   VVI: diagonal, varying              lambda_k A_k
+#   VEI: diagonal, equal shape          lambda_k A
+#   VVV: ellipsoidal, varying           Sigma_k
+MODEL_NAMES = ('EII', 'VVI', 'VEI', 'VVV')
+NUM_COMPONENTS = range(1, 10)
+
+FEATURES = ('failed_go', 'mean_rt', 'std_dev_rt')
+
+# A fit whose covariances have a larger condition number than this is treated as singular
+MAX_CONDITION_NUMBER = 1e12
+
+
+def read_latent_class_analysis(file: Path) -> Tuple[List[str], np.ndarray]:
+    """
+    Read latent_class_analysis.tsv written by multiconds_latent_class.py.
+    :return: subject IDs, and the features of each subject (subjects x FEATURES)
+    """
+    subject_ids = []
+    rows = []
+    with open(str(file), 'r') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if values[0] == 'subject_id':
+                continue
+            subject_ids.append(values[0])
+            rows.append([float(v) for v in values[1:1 + len(FEATURES)]])
+    return subject_ids, np.asarray(rows, dtype=np.float64).reshape(-1, len(FEATURES))
+
+
+def num_parameters(model: str, num_components: int, num_dimensions: int) -> int:
+    """Number of free parameters, as counted by mclust"""
+    g, d = num_components, num_dimensions
+    covariance = {'EII': 1,
+                  'VVI': g * d,
+                  'VEI': g + d - 1,
+                  'VVV': g * d * (d + 1) // 2}[model]
+    return (g - 1) + g * d + covariance
+
+
+def log_densities(x: np.ndarray, means: np.ndarray, covariances: np.ndarray) -> np.ndarray:
+    """
+    :return: log density of every point under every component (points x components)
+    """
+    cholesky = np.linalg.cholesky(covariances)
+    # Whitened differences, components x points x dimensions
+    diff = x[np.newaxis, :, :] - means[:, np.newaxis, :]
+    whitened = np.linalg.solve(cholesky[:, np.newaxis, :, :], diff[..., np.newaxis])[..., 0]
+    log_det = 2.0 * np.sum(np.log(np.diagonal(cholesky, axis1=1, axis2=2)), axis=1)
+    d = x.shape[1]
+    return (-0.5 * (np.sum(whitened ** 2, axis=2) + log_det[:, np.newaxis] + d * np.log(2.0 * np.pi))).T
+
+
+def e_step(x: np.ndarray, weights: np.ndarray, means: np.ndarray,
+           covariances: np.ndarray) -> Tuple[np.ndarray, float]:
+    """:return: responsibilities (points x components) and log likelihood"""
+    log_joint = np.log(weights) + log_densities(x, means, covariances)
+    log_total = np.logaddexp.reduce(log_joint, axis=1)
+    return np.exp(log_joint - log_total[:, np.newaxis]), float(np.sum(log_total))
+
+
+def m_step(x: np.ndarray, responsibilities: np.ndarray, model: str,
+           vei_iterations: int = 20) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """:return: weights, means and covariances (components x dimensions x dimensions) of :param model:"""
+    n, d = x.shape
+    counts = responsibilities.sum(axis=0)
+    weights = counts / n
+    means = (responsibilities.T @ x) / counts[:, np.newaxis]
+    diff = x[np.newaxis, :, :] - means[:, np.newaxis, :]
+    # Weighted scatter matrix of each component
+    scatter = np.einsum('ng,gni,gnj->gij', responsibilities, diff, diff)
+    scatter_diagonal = np.diagonal(scatter, axis1=1, axis2=2)
+
+    if model == 'EII':
+        variance = np.trace(scatter, axis1=1, axis2=2).sum() / (n * d)
+        covariances = np.broadcast_to(variance * np.eye(d), scatter.shape).copy()
+    elif model == 'VVI':
+        covariances = np.stack([np.diag(v) for v in scatter_diagonal / counts[:, np.newaxis]])
+    elif model == 'VEI':
+        # Alternate between the volume of each component and the shared shape, whose determinant is 1
+        shape = np.ones(d)
+        for _ in range(vei_iterations):
+            volume = np.sum(scatter_diagonal / shape, axis=1) / (d * counts)
+            shape = np.sum(scatter_diagonal / volume[:, np.newaxis], axis=0)
+            shape /= np.prod(shape) ** (1.0 / d)
+        covariances = np.stack([np.diag(v * shape) for v in volume])
+    elif model == 'VVV':
+        covariances = scatter / counts[:, np.newaxis, np.newaxis]
+    else:
+        raise ValueError(f'Unknown model {model}')
+    return weights, means, covariances
+
+
+def run_em(x: np.ndarray, responsibilities: np.ndarray, model: str, max_iterations: int,
+           tolerance: float) -> Tuple[float, np.ndarray]:
+    """
+    Run EM from initial :param responsibilities: until the relative change of the log likelihood is below
+    :param tolerance:. Raises LinAlgError if a component empties or its covariance becomes singular.
+    :return: log likelihood and responsibilities
+    """
+    d = x.shape[1]
+    log_likelihood = -np.inf
+    for _ in range(max_iterations):
+        if np.any(responsibilities.sum(axis=0) < 1.0):
+            raise np.linalg.LinAlgError('empty component')
+        weights, means, covariances = m_step(x, responsibilities, model)
+        if not np.all(np.linalg.cond(covariances) < MAX_CONDITION_NUMBER):
+            raise np.linalg.LinAlgError('singular covariance')
+        responsibilities, new_log_likelihood = e_step(x, weights, means, covariances)
+        converged = abs(new_log_likelihood - log_likelihood) <= tolerance * abs(new_log_likelihood)
+        log_likelihood = new_log_likelihood
+        if converged:
+            break
+    return log_likelihood, responsibilities
+
+
+def fit_mixture(x: np.ndarray, model: str, num_components: int, seed: int, num_starts: int = 10,
+                max_iterations: int = 500, tolerance: float = 1e-8) -> Dict:
+    """
+    Fit a Gaussian mixture by EM from :param num_starts: random starts, and keep the best.
+    Each start assigns every point to the nearest of num_components randomly chosen points.
+    :return: dict with log likelihood, BIC, ICL and classification; BIC and ICL are NaN if every start
+    ended with an empty component or a singular covariance
+    """
+    n, d = x.shape
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(num_starts):
+        centers = x[rng.choice(n, size=num_components, replace=False)]
+        nearest = np.argmin(np.sum((x[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2, axis=2), axis=1)
+        try:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_likelihood, responsibilities = run_em(x, np.eye(num_components)[nearest], model,
+                                                          max_iterations, tolerance)
+        except np.linalg.LinAlgError:
+            continue
+        if np.isfinite(log_likelihood) and (best is None or log_likelihood > best['log_likelihood']):
+            best = {'log_likelihood': log_likelihood, 'responsibilities': responsibilities}
+
+    if best is None:
+        return {'model': model, 'num_components': num_components, 'log_likelihood': np.nan,
+                'bic': np.nan, 'icl': np.nan, 'classification': None, 'uncertainty': None}
+
+    responsibilities = best['responsibilities']
+    bic = 2.0 * best['log_likelihood'] - num_parameters(model, num_components, d) * np.log(n)
+    # ICL penalizes the BIC by the entropy of the hard classification
+    icl = bic + 2.0 * np.sum(np.log(np.maximum(responsibilities.max(axis=1), np.finfo(float).tiny)))
+    return {'model': model,
+            'num_components': num_components,
+            'log_likelihood': best['log_likelihood'],
+            'bic': bic,
+            'icl': icl,
+            'classification': np.argmax(responsibilities, axis=1) + 1,
+            'uncertainty': 1.0 - responsibilities.max(axis=1)}
+
+
+def fit_grid(x: np.ndarray, models=MODEL_NAMES, components=NUM_COMPONENTS, num_starts: int = 10,
+             seed: int = 0, jobs: int = 1) -> List[Dict]:
+    """
+    Fit every (model, number of components) pair of the grid, in a process pool if :param jobs: > 1.
+    Each pair gets its own seed derived from :param seed:, so results do not depend on :param jobs:
+    """
+    grid = [(model, g) for model in models for g in components if g <= len(x)]
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(len(grid))]
+    arguments = ([x] * len(grid), [model for model, _ in grid], [g for _, g in grid], seeds, [num_starts] * len(grid))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(fit_mixture, *arguments))
+    return list(map(fit_mixture, *arguments))
+
+
+def write_criterion_table(file: Path, fits: List[Dict], criterion: str):
+    """Write a components x models table of :param criterion: ('bic' or 'icl'), like mclustBIC"""
+    models = list(dict.fromkeys(fit['model'] for fit in fits))
+    components = sorted({fit['num_components'] for fit in fits})
+    values = {(fit['model'], fit['num_components']): fit[criterion] for fit in fits}
+    with open(str(file), mode='w') as f:
+        f.write('\t'.join(['G'] + models) + '\n')
+        for g in components:
+            row = [values.get((model, g), np.nan) for model in models]
+            f.write('\t'.join([str(g)] + ['NA' if np.isnan(v) else f'{v:.4f}' for v in row]) + '\n')
+
+
+def write_classification(file: Path, subject_ids: List[str], fit: Dict):
+    with open(str(file), mode='w') as f:
+        f.write('subject_id\tclassification\tuncertainty\n')
+        for subject_id, classification, uncertainty in zip(subject_ids, fit['classification'], fit['uncertainty']):
+            f.write(f'{subject_id}\t{classification}\t{uncertainty:.6f}\n')
+
+
+def main(input_file: str, model: str = None, num_components: int = None, num_starts: int = 10,
+         seed: int = 0, jobs: int = 1):
+    if model is not None and (model not in MODEL_NAMES or num_components not in NUM_COMPONENTS):
+        raise ValueError(f'{model},{num_components} is not in the grid of models {", ".join(MODEL_NAMES)} '
+                         f'with {NUM_COMPONENTS[0]} to {NUM_COMPONENTS[-1]} components')
+    input_file = Path(input_file)
+    subject_ids, x = read_latent_class_analysis(input_file)
+
+    fits = fit_grid(x, num_starts=num_starts, seed=seed, jobs=jobs)
+    write_criterion_table(input_file.with_name('latent_class_bic.tsv'), fits, 'bic')
+    write_criterion_table(input_file.with_name('latent_class_icl.tsv'), fits, 'icl')
+
+    # Classify by the requested model, or by the model with the best BIC. Without a classification, an older
+    # classification file is removed, so it is not taken for one of this model.
+    classification_file = input_file.with_name('latent_class_classification.tsv')
+    if model is not None:
+        selected = [fit for fit in fits if fit['model'] == model and fit['num_components'] == num_components]
+        if not selected or selected[0]['classification'] is None:
+            classification_file.unlink(missing_ok=True)
+            reason = f'it has more components than the {len(x)} subjects' if not selected else 'its BIC is NaN'
+            raise ValueError(f'{model},{num_components} could not be fit to {input_file}: {reason}')
+        selected = selected[0]
+    else:
+        fitted = [fit for fit in fits if not np.isnan(fit['bic'])]
+        if not fitted:
+            classification_file.unlink(missing_ok=True)
+            raise ValueError(f'No model could be fit to {input_file}: every BIC is NaN')
+        selected = max(fitted, key=lambda fit: fit['bic'])
+    print(f'Classification by {selected["model"]},{selected["num_components"]}: BIC {selected["bic"]:.4f}')
+    write_classification(classification_file, subject_ids, selected)
+
+
+if __name__ == "__main__":
+    description = 'Fit Gaussian mixture models to the latent class analysis features of the SST task'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-i', '--input', metavar='Input file', action='store',
+                        type=str, required=True,
+                        help='absolute path to latent_class_analysis.tsv written by multiconds_latent_class.py.',
+                        dest='input_file'
+                        )
+    parser.add_argument('-m', '--model', action='store',
+                        choices=MODEL_NAMES, required=False, default=None,
+                        help='covariance model to classify subjects by. By default, the model with the best BIC.',
+                        dest='model'
+                        )
+    parser.add_argument('-g', '--components', metavar='Number of components', action='store',
+                        type=int, required=False, default=None,
+                        help='number of components of --model.',
+                        dest='num_components'
+                        )
+    parser.add_argument('-r', '--starts', metavar='Random starts', action='store',
+                        type=int, required=False, default=10,
+                        help='number of random starts of each model.',
+                        dest='num_starts'
+                        )
+    parser.add_argument('--seed', metavar='Seed', action='store',
+                        type=int, required=False, default=0,
+                        help='seed of the random starts.',
+                        dest='seed'
+                        )
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of models to fit in parallel.',
+                        dest='jobs'
+                        )
+    args = parser.parse_args()
+
+    if (args.model is None) != (args.num_components is None):
+        parser.error('--model and --components must be given together')
+
+    main(args.input_file, args.model, args.num_components, args.num_starts, args.seed, args.jobs)
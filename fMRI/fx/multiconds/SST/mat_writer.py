@@ -0,0 +1,135 @@
+"""
+Writer for SPM multiple condition files in MAT-file version 5 format.
+
+SPM reads the cell arrays names, onsets and durations (and optionally the struct array pmod) from these files.
+Inputs are plain sequences of strings, numbers and typed numpy arrays. Each variable is encoded directly
+into MAT v5 data elements and streamed to the file, instead of going through object arrays and the generic
+conversion in scipy.io.savemat. Files written here are read back by scipy.io.loadmat and by MATLAB.
+
+See "MAT-File Format", MathWorks, for the layout of data elements.
+"""
+import os
+import struct
+import time
+from os import PathLike
+from typing import Union, Sequence, List, Tuple, Dict
+
+import numpy as np
+
+# Data types
+MI_INT8 = 1
+MI_INT32 = 5
+MI_UINT32 = 6
+MI_DOUBLE = 9
+MI_MATRIX = 14
+MI_UTF8 = 16
+
+# Array classes
+MX_CELL_CLASS = 1
+MX_STRUCT_CLASS = 2
+MX_CHAR_CLASS = 4
+MX_DOUBLE_CLASS = 6
+
+# Longest field name written in struct arrays, including the terminating null
+FIELD_NAME_LENGTH = 32
+
+# A parametric modulation of one condition: (name, one value per onset, polynomial order)
+ParametricModulation = Tuple[str, np.ndarray, int]
+
+
+def header() -> bytes:
+    """128-byte MAT v5 file header, little endian"""
+    text = f'MATLAB 5.0 MAT-file Platform: {os.name}, Created on: {time.asctime()}'.encode('ascii')
+    return text[:116].ljust(116, b' ') + b'\x00' * 8 + struct.pack('<H', 0x0100) + b'IM'
+
+
+def padding(num_bytes: int) -> bytes:
+    return b'\x00' * (-num_bytes % 8)
+
+
+def data_element(data_type: int, data: bytes) -> List[bytes]:
+    return [struct.pack('<II', data_type, len(data)), data, padding(len(data))]
+
+
+def matrix(array_class: int, shape: Tuple[int, ...], name: str, contents: List[bytes]) -> List[bytes]:
+    """
+    Wrap the data subelements :param contents: of a matrix in a miMATRIX data element,
+    preceded by the array flags, dimensions and name subelements.
+    """
+    chunks = (data_element(MI_UINT32, struct.pack('<II', array_class, 0)) +
+              data_element(MI_INT32, struct.pack(f'<{len(shape)}i', *shape)) +
+              data_element(MI_INT8, name.encode('ascii')) +
+              contents)
+    return [struct.pack('<II', MI_MATRIX, sum(len(chunk) for chunk in chunks))] + chunks
+
+
+def char_matrix(value: str, name: str = '') -> List[bytes]:
+    """Character array, a 1xN row. An empty string is 0x0."""
+    data = value.encode('utf-8')
+    shape = (1, len(value)) if value else (0, 0)
+    return matrix(MX_CHAR_CLASS, shape, name, data_element(MI_UTF8, data))
+
+
+def double_matrix(value: Union[np.ndarray, float], name: str = '') -> List[bytes]:
+    """Double array, written as an Nx1 column. A scalar is 1x1."""
+    data = np.asarray(value, dtype='<f8').reshape(-1)
+    return matrix(MX_DOUBLE_CLASS, (data.size, 1), name, data_element(MI_DOUBLE, data.tobytes()))
+
+
+def value_matrix(value, name: str = '') -> List[bytes]:
+    if isinstance(value, str):
+        return char_matrix(value, name)
+    return double_matrix(value, name)
+
+
+def cell_matrix(values: Sequence, name: str = '') -> List[bytes]:
+    """1xN cell array of strings or numeric arrays"""
+    contents = []
+    for value in values:
+        contents += value_matrix(value)
+    return matrix(MX_CELL_CLASS, (1, len(values)), name, contents)
+
+
+def struct_matrix(elements: Sequence[Dict], field_names: Sequence[str], name: str = '') -> List[bytes]:
+    """1xN struct array. Each element is a dict of field name to already encoded miMATRIX chunks."""
+    names = b''.join(field.encode('ascii').ljust(FIELD_NAME_LENGTH, b'\x00') for field in field_names)
+    # The field name length is written in the small data element format
+    contents = [struct.pack('<HHi', MI_INT32, 4, FIELD_NAME_LENGTH)] + data_element(MI_INT8, names)
+    for element in elements:
+        for field in field_names:
+            contents += element[field]
+    return matrix(MX_STRUCT_CLASS, (1, len(elements)), name, contents)
+
+
+def pmod_matrix(pmod: Sequence[Sequence[ParametricModulation]]) -> List[bytes]:
+    """
+    SPM pmod struct array, one element per condition with fields name, param and poly.
+    A condition without parametric modulations has empty fields.
+    """
+    elements = []
+    for modulations in pmod:
+        elements.append({'name': cell_matrix([m[0] for m in modulations]),
+                         'param': cell_matrix([m[1] for m in modulations]),
+                         'poly': cell_matrix([float(m[2]) for m in modulations])})
+    return struct_matrix(elements, ('name', 'param', 'poly'), 'pmod')
+
+
+def write_multiple_conditions(file: Union[PathLike, str],
+                              names: Sequence,
+                              onsets: Sequence,
+                              durations: Sequence,
+                              pmod: Sequence[Sequence[ParametricModulation]] = None):
+    """
+    Write an SPM multiple conditions file.
+    :param names: one name per condition. Strings are written as char arrays, numbers as 1x1 doubles.
+    :param onsets: one number or 1-d array of onsets per condition, each written as an Nx1 double cell
+    :param durations: one number or 1-d array of durations per condition, each written as an Nx1 double cell
+    :param pmod: optional, one sequence of (name, values, polynomial order) per condition
+    """
+    with open(str(file), 'wb') as f:
+        f.write(header())
+        f.writelines(cell_matrix(names, 'names'))
+        f.writelines(cell_matrix(onsets, 'onsets'))
+        f.writelines(cell_matrix(durations, 'durations'))
+        if pmod is not None:
+            f.writelines(pmod_matrix(pmod))
@@ -1,33 +1,36 @@
 import argparse
 import json
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from os import PathLike
 from pathlib import Path
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, NamedTuple
 
 import numpy as np
-import scipy.io
+from numpy.lib.stride_tricks import sliding_window_view
 
-GO_TRIAL = 1
-NO_GO_TRIAL = 0
+import event_store
+import instrumentation
+import rebuild_manifest
+from mat_writer import write_multiple_conditions
+from sst_reader import EVENTS_TSV_TRIAL_TYPES
+from sst_stream import SubjectEvents, read_subject
 
 STUDY_ID = 'CC'
 
+# Names of the groups of trials that moving average windows can be created for,
+# in the order of SubjectEvents.go_no_go() and SubjectEvents.conditions()
+MOVING_WINDOW_GROUPINGS = {'go-no-go': ('go', 'nogo'),
+                           'conditions': ('CorrectGo', 'CorrectStop', 'FailedStop', 'FailedGo')}
 
-def image_name_converter(s: bytes) -> int:
-    """
-    Converter to translate :param s: containing an image name into 1 or 0.
-    :param s: Image name. Image names that start with 'healthy', 'p3healthy', or 'bird' indicate 'go' trials.
-    Image names that start with 'unhealthy', 'p2unhealthy', or 'flower', indicate 'no-go' trials.
-    :return: 1 for go trials, 0 for no-go trials
-    """
-    if s.startswith(b'healthy') or s.startswith(b'p3healthy') or s.startswith(b'bird'):
-        return 1
-    else:
-        return 0
+# Change VERSION whenever a change to this script changes its output files,
+# so that the rebuild manifest regenerates every subject.
+VERSION = '3'
 
 
-def csv_data_read(file: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+@instrumentation.timed
+def csv_data_read(file: Path, subject_id: str = '') -> SubjectEvents:
     """
     Read behavioral data out of .csv files. The data is interpreted as follows:
 
@@ -36,35 +39,21 @@ def csv_data_read(file: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.nd
     column 10 - trial duration (milliseconds)
     column 13 - reaction time (milliseconds)
     column 23 - trial type. 0=NoGo, 1=Go
-    """
-    trial_number, start_time, duration, reaction_time, is_go_trial = np.loadtxt(str(file),
-                                                                                delimiter=',',
-                                                                                skiprows=1,
-                                                                                usecols=(7, 9, 10, 13, 23),
-                                                                                converters={23: image_name_converter},
-                                                                                unpack=True)
 
-    # Divide reaction time, duration, start time by 1000 to convert from millisecond to second.
-    return trial_number, is_go_trial, reaction_time / 1000.0, duration / 1000.0, start_time / 1000.0
-
-
-def create_masks(condition: np.ndarray, response: np.ndarray) -> List:
-    """Create masks of conditions"""
-    go_correct = np.logical_and(condition == GO_TRIAL, response > 0.0)
-    go_incorrect = np.logical_and(condition == GO_TRIAL, response == 0.0)
-    no_go_correct = np.logical_and(condition == NO_GO_TRIAL, response == 0.0)
-    no_go_incorrect = np.logical_and(condition == NO_GO_TRIAL, response > 0.0)
-
-    return list((go_correct, no_go_correct, no_go_incorrect, go_incorrect))
+    Times are converted to seconds, and each trial is given its trial type code (see sst_stream.trial_type_codes()).
+    """
+    return read_subject(file, subject_id)
 
 
-def create_trials(trial_number: np.ndarray, trial_start_time: np.ndarray, trial_duration: np.ndarray):
+@instrumentation.timed
+def create_trials(events: SubjectEvents):
     # Output names (trial number or condition name (GoFail, GoSuccess, NoGoFail, NoGoSuccess)),
     # onsets (when the thing started),
     # durations (how long the thing lasted)
-    names = np.asarray(trial_number, dtype=np.object)
-    onsets = np.asarray(trial_start_time, dtype=np.object)
-    durations = np.asarray(trial_duration, dtype=np.object)
+    # One condition per trial: each name, onset and duration is a single number
+    names = events.trial_number
+    onsets = events.onset
+    durations = events.duration
 
     trials = {'names': names,
               'onsets': onsets,
@@ -72,18 +61,14 @@ def create_trials(trial_number: np.ndarray, trial_start_time: np.ndarray, trial_
     return trials
 
 
-def create_first_last_trials(trial_start_time: np.ndarray, trial_duration: np.ndarray, first: int, last: int):
+@instrumentation.timed
+def create_first_last_trials(events: SubjectEvents, first: int, last: int):
     # Output names (trial number or condition name (GoFail, GoSuccess, NoGoFail, NoGoSuccess)),
     # onsets (when the thing started),
     # durations (how long the thing lasted)
-    names_list = [f'First{first}Events', f'Last{last}Events']
-    names = np.asarray(names_list, dtype=np.object)
-    onsets = np.zeros((len(names_list),), dtype=np.object)
-    durations = np.zeros((len(names_list),), dtype=np.object)
-    onsets[0] = trial_start_time[:first].reshape(first, 1)
-    onsets[1] = trial_start_time[-last:].reshape(last, 1)
-    durations[0] = trial_duration[:first].reshape(first, 1)
-    durations[1] = trial_duration[-last:].reshape(last, 1)
+    names = [f'First{first}Events', f'Last{last}Events']
+    onsets = [events.onset[:first], events.onset[-last:]]
+    durations = [events.duration[:first], events.duration[-last:]]
 
     trials = {'names': names,
               'onsets': onsets,
@@ -91,15 +76,12 @@ def create_first_last_trials(trial_start_time: np.ndarray, trial_duration: np.nd
     return trials
 
 
-def create_conditions(start_time: np.ndarray, duration: np.ndarray, masks: List):
-    names = np.asarray(['CorrectGo', 'CorrectStop', 'FailedStop', 'Cue', 'FailedGo'], dtype=np.object)
-    onsets = np.zeros((len(masks),), dtype=np.object)
-    durations = np.zeros((len(masks),), dtype=np.object)
-    # onsets and durations have to be reshaped from 1-d np arrays to Nx1 arrays so when written
-    # by scipy.io.savemat, the correct cell array is created in matlab
-    for i, mask in enumerate(masks):
-        onsets[i] = start_time[mask].reshape(np.count_nonzero(mask), 1)
-        durations[i] = duration[mask].reshape(np.count_nonzero(mask), 1)
+@instrumentation.timed
+def create_conditions(events: SubjectEvents):
+    names = ['CorrectGo', 'CorrectStop', 'FailedStop', 'FailedGo']
+    conditions = events.conditions()
+    onsets = [onset for onset, _ in conditions]
+    durations = [duration for _, duration in conditions]
 
     conditions = {'names': names,
                   'onsets': onsets,
@@ -107,62 +89,90 @@ def create_conditions(start_time: np.ndarray, duration: np.ndarray, masks: List)
     return conditions
 
 
-def create_go_no_gomasks(condition: np.ndarray) -> List:
-    """Create masks of conditions"""
-    go = condition == GO_TRIAL
-    no_go = condition == NO_GO_TRIAL
-
-    return list((go, no_go))
-
-
 def moving_average(a, window=5):
     ret = np.cumsum(a, dtype=float)
     ret[window:] = ret[window:] - ret[:-window]
     return ret[window - 1:] / window
 
 
-def create_moving_average_conditions(start_time: np.ndarray, duration: np.ndarray, masks: List):
-    window = 5
-    go_len = len(start_time[masks[0]]) - window + 1
-    no_go_len = len(start_time[masks[1]]) - window + 1
-    names_list = [f'go{i}' for i in range(1, go_len + 1)] + [f'nogo{i}' for i in range(1, no_go_len + 1)]
-
-    names = np.asarray(names_list, dtype=np.object)
-    onsets = np.zeros((len(names_list),), dtype=np.object)
-    durations = np.zeros((len(names_list),), dtype=np.object)
-    # onsets and durations have to be reshaped from 1-d np arrays to Nx1 arrays so when written
-    # by scipy.io.savemat, the correct cell array is created in matlab
+def sliding_windows(a: np.ndarray, window: int, stride: int = 1) -> np.ndarray:
+    """
+    :return: windows of :param window: consecutive elements of :param a:, starting every :param stride: elements,
+    as rows of a read-only strided view into :param a: (no data is copied)
+    """
+    if len(a) < window:
+        return np.empty((0, window), dtype=a.dtype)
+    return sliding_window_view(a, window)[::stride]
 
-    for j in range(go_len):
-        onsets[j] = start_time[masks[0]][j:j+window].reshape(window, 1)
-        durations[j] = duration[masks[0]][j:j+window].reshape(window, 1)
-    for i in range(no_go_len):
-        onsets[i + go_len] = start_time[masks[1]][i:i+window].reshape(window, 1)
-        durations[i + go_len] = duration[masks[1]][i:i+window].reshape(window, 1)
 
-    conditions = {'names': names,
-                  'onsets': onsets,
-                  'durations': durations}
+@instrumentation.timed
+def create_moving_average_conditions(events: SubjectEvents, window: int = 5, stride: int = 1,
+                                     grouping: str = 'go-no-go'):
+    """
+    Create one condition per window of :param window: consecutive trials of each group,
+    with a new window starting every :param stride: trials.
+    :param grouping: key of MOVING_WINDOW_GROUPINGS, the go and no-go trials or the four conditions
+    """
+    groups = events.go_no_go() if grouping == 'go-no-go' else events.conditions()
+    names_list = []
+    onset_windows = []
+    duration_windows = []
+    for group_name, (onset, duration) in zip(MOVING_WINDOW_GROUPINGS[grouping], groups):
+        # Group the trials once, then take every window as a view.
+        # The windows are only copied when they are written to the .mat file.
+        group_onsets = sliding_windows(onset, window, stride)
+        group_durations = sliding_windows(duration, window, stride)
+        names_list += [f'{group_name}{i}' for i in range(1, len(group_onsets) + 1)]
+        onset_windows += list(group_onsets)
+        duration_windows += list(group_durations)
+
+    conditions = {'names': names_list,
+                  'onsets': onset_windows,
+                  'durations': duration_windows}
     return conditions
 
 
-def write_betaseries(input_dir: Union[PathLike, str], subject_id: str, wave: str, trials):
+def moving_average_file_name(subject_id: str, window: int = 5, stride: int = 1, grouping: str = 'go-no-go') -> str:
+    """
+    The default window keeps the original file name, other windows get their parameters in the name.
+    """
+    if (window, stride, grouping) == (5, 1, 'go-no-go'):
+        return f'{STUDY_ID}{subject_id}_moving_average.mat'
+    return f'{STUDY_ID}{subject_id}_moving_average_{grouping}_window{window}_stride{stride}.mat'
+
+
+@instrumentation.timed
+def write_betaseries(input_dir: Union[PathLike, str], subject_id: str, wave: str, trials) -> List[Path]:
     path = Path(input_dir) / 'betaseries'
     path.mkdir(parents=True, exist_ok=True)
     file_name = f'{STUDY_ID}{subject_id}_{wave}_SST1.mat'
 
-    scipy.io.savemat(str(path / file_name), trials)
+    write_multiple_conditions(path / file_name, **trials)
+    return [path / file_name]
 
 
-def write_conditions(input_dir: Union[PathLike, str], file_name: str, trials):
+@instrumentation.timed
+def write_conditions(input_dir: Union[PathLike, str], file_name: str, trials) -> List[Path]:
     path = Path(input_dir) / 'conditions'
     path.mkdir(parents=True, exist_ok=True)
 
-    scipy.io.savemat(str(path / file_name), trials)
+    write_multiple_conditions(path / file_name, **trials)
+    return [path / file_name]
+
 
+def write_events_tsv(file: Path, events: SubjectEvents):
+    """Write onset, duration and trial type name of every trial, formatted row by row without an object array"""
+    names = [EVENTS_TSV_TRIAL_TYPES[code] for code in events.trial_type.tolist()]
+    with open(str(file), 'w') as f:
+        f.write('onset\tduration\ttrial_type\n')
+        f.writelines(f'{onset:10.5f}\t{duration:10.5f}\t{name}\n'
+                     for onset, duration, name in zip(events.onset.tolist(), events.duration.tolist(), names))
 
-def write_bids_events(input_dir: Union[PathLike, str], subject_id: str, wave: str, trials):
+
+@instrumentation.timed
+def write_bids_events(input_dir: Union[PathLike, str], wave: str, events: SubjectEvents) -> List[Path]:
     # Write the events.tsv to BIDS only if the BIDS structure already exists
+    subject_id = events.subject_id
     subject_path = Path(input_dir) / f'sub-{STUDY_ID}{subject_id}'
     if subject_path.exists():
         path = Path(input_dir) / f'sub-{STUDY_ID}{subject_id}' / f'ses-wave{wave}'
@@ -173,28 +183,21 @@ def write_bids_events(input_dir: Union[PathLike, str], subject_id: str, wave: st
 
         path.mkdir(parents=True, exist_ok=True)
         file_name = Path(f'sub-{STUDY_ID}{subject_id}_ses-wave{wave}_task-SST_acq-1_events.tsv')
+        write_events_tsv(path / file_name, events)
 
-        np.savetxt(str(path / file_name),
-                   trials,
-                   delimiter='\t',
-                   header='onset\tduration\ttrial_type',
-                   comments='',
-                   fmt=['%10.5f', '%10.5f', '%s'])
-
-        file_name = Path(f'sub-{STUDY_ID}{subject_id}_ses-wave{wave}_task-SST_acq-1_events.json')
-        write_events_description(path, file_name)
+        json_file_name = Path(f'sub-{STUDY_ID}{subject_id}_ses-wave{wave}_task-SST_acq-1_events.json')
+        write_events_description(path, json_file_name)
+        return [path / file_name, path / json_file_name]
+    return []
 
 
-def write_text_events(input_dir: Union[PathLike, str], subject_id: str, wave: str, trials):
+@instrumentation.timed
+def write_text_events(input_dir: Union[PathLike, str], wave: str, events: SubjectEvents) -> List[Path]:
     path = Path(input_dir)
-    file_name = Path(f'sub-{STUDY_ID}{subject_id}_ses-wave{wave}_task-SST_acq-1_events.tsv')
+    file_name = Path(f'sub-{STUDY_ID}{events.subject_id}_ses-wave{wave}_task-SST_acq-1_events.tsv')
 
-    np.savetxt(str(path / file_name),
-               trials,
-               delimiter='\t',
-               header='onset\tduration\ttrial_type',
-               comments='',
-               fmt=['%10.5f', '%10.5f', '%s'])
+    write_events_tsv(path / file_name, events)
+    return [path / file_name]
 
 
 def write_events_description(path: Path,
@@ -227,52 +230,135 @@ def write_events_description(path: Path,
         json.dump(desc, f, indent=4)
 
 
-def main(input_dir: str, bids_dir: str = None):
-    files = sorted(Path(input_dir).glob(f'{STUDY_ID}*stopsignal_fMRI_clean.csv'))
-    pattern = f'{STUDY_ID}' + '(\\d{3})_stopsignal_fMRI_clean.csv'
-    for f in files:
-        match = re.search(pattern, str(f.name))
-        if match:
-            subject_id, = match.groups()
-            wave_number = '1'
+class SubjectResult(NamedTuple):
+    subject_id: str
+    # Error message, or None if the subject was processed successfully
+    error: Union[str, None]
+    # Output files written
+    outputs: List[str]
+    # (onset, duration, trial type codes) for the cohort event store
+    events: Union[Tuple[np.ndarray, np.ndarray, np.ndarray], None]
 
-            # Read data out of .csv file
-            trial_number, is_go_trial, reaction_time, trial_duration, trial_start_time = csv_data_read(f)
 
-            # Create masks for the various conditions
-            masks = create_masks(is_go_trial, reaction_time)
+def process_subject(file: Path, input_dir: str, bids_dir: str = None,
+                    window: int = 5, stride: int = 1, grouping: str = 'go-no-go') -> SubjectResult:
+    """
+    Read a single subject's .csv file and write all of its output files.
+    Any exception is caught and returned, so that one bad file does not abort a cohort run.
+    :param window, stride, grouping: see create_moving_average_conditions()
+    """
+    pattern = f'{STUDY_ID}' + '(\\d{3})_stopsignal_fMRI_clean.csv'
+    match = re.search(pattern, str(file.name))
+    subject_id, = match.groups()
+    wave_number = '1'
+    outputs = []
 
-            trial_type = np.empty_like(trial_number, dtype=np.object)
-            trial_type_names = ['correct-go', 'correct-stop', 'failed-stop', 'failed-go', 'null']
-            for mask, name in zip(masks, trial_type_names):
-                np.putmask(trial_type, mask, name)
+    with instrumentation.stage('subject', subject_id):
+        try:
+            # Read data out of .csv file, with the trial type of each trial
+            events = csv_data_read(file, subject_id)
 
             if bids_dir:
-                write_bids_events(bids_dir, subject_id, wave_number,
-                                  np.stack((trial_start_time, trial_duration, trial_type), axis=1))
+                outputs += write_bids_events(bids_dir, wave_number, events)
             else:
-                trials = create_trials(trial_number, trial_start_time, trial_duration)
+                trials = create_trials(events)
 
                 # Create paths and file names
-                write_betaseries(input_dir, subject_id, wave_number, trials)
+                outputs += write_betaseries(input_dir, subject_id, wave_number, trials)
 
-                trials = create_first_last_trials(trial_start_time, trial_duration, 10, 10)
+                trials = create_first_last_trials(events, 10, 10)
                 file_name = f'{STUDY_ID}{subject_id}_blocks.mat'
-                write_conditions(input_dir, file_name, trials)
+                outputs += write_conditions(input_dir, file_name, trials)
 
-                conditions = create_conditions(trial_start_time, trial_duration, masks)
+                conditions = create_conditions(events)
                 file_name = f'{STUDY_ID}{subject_id}_{wave_number}_SST1.mat'
-                write_conditions(input_dir, file_name, conditions)
+                outputs += write_conditions(input_dir, file_name, conditions)
+
+                conditions = create_moving_average_conditions(events, window, stride, grouping)
+                file_name = moving_average_file_name(subject_id, window, stride, grouping)
+                outputs += write_conditions(input_dir, file_name, conditions)
 
-                # Create masks for the various conditions
-                masks = create_go_no_gomasks(is_go_trial)
+                outputs += write_text_events(input_dir, wave_number, events)
+        except Exception as e:
+            return SubjectResult(subject_id, f'{type(e).__name__}: {e}', [], None)
 
-                conditions = create_moving_average_conditions(trial_start_time, trial_duration, masks)
-                file_name = f'{STUDY_ID}{subject_id}_moving_average.mat'
-                write_conditions(input_dir, file_name, conditions)
+    return SubjectResult(subject_id, None, [str(output.resolve()) for output in outputs],
+                         (events.onset, events.duration, events.trial_type))
 
-                write_text_events(input_dir, subject_id, wave_number,
-                                  np.stack((trial_start_time, trial_duration, trial_type), axis=1))
+
+def print_summary(results: List[SubjectResult], num_skipped: int = 0):
+    """
+    Print a summary of a cohort run. Results are reported in subject order,
+    so the summary is the same regardless of the number of jobs.
+    """
+    failed = [(result.subject_id, result.error) for result in results if result.error is not None]
+    print(f'Processed {len(results)} subjects: {len(results) - len(failed)} succeeded, {len(failed)} failed, '
+          f'{num_skipped} up to date')
+    for subject_id, error in failed:
+        print(f'  {STUDY_ID}{subject_id}: {error}')
+
+
+def main(input_dir: str, bids_dir: str = None, jobs: int = 1, force: bool = False, dry_run: bool = False,
+         window: int = 5, stride: int = 1, grouping: str = 'go-no-go'):
+    files = sorted(Path(input_dir).glob(f'{STUDY_ID}*stopsignal_fMRI_clean.csv'))
+    pattern = f'{STUDY_ID}' + '(\\d{3})_stopsignal_fMRI_clean.csv'
+    subject_ids = {}
+    for f in files:
+        match = re.search(pattern, str(f.name))
+        if match:
+            subject_ids[f] = match.group(1)
+    files = list(subject_ids)
+
+    # Only rebuild subjects whose input, version or parameters changed since the last run
+    manifest = rebuild_manifest.read_manifest(input_dir)
+    parameters = {'bids_dir': bids_dir,
+                  'window': window,
+                  'stride': stride,
+                  'grouping': grouping}
+    signatures = {}
+    with instrumentation.stage('signatures'):
+        for f in files:
+            entry = manifest['subjects'].get(subject_ids[f])
+            signatures[f] = rebuild_manifest.file_signature(f, entry['input'] if entry else None)
+    # Subjects missing from the cohort event store are rebuilt too
+    store_dir = event_store.store_path(input_dir)
+    stored_subjects = set(event_store.read_index(store_dir)['subjects'])
+    stale_files = [f for f in files
+                   if force or subject_ids[f] not in stored_subjects
+                   or rebuild_manifest.is_stale(manifest['subjects'].get(subject_ids[f]),
+                                                signatures[f], VERSION, parameters)]
+
+    if dry_run:
+        print(f'{len(stale_files)} of {len(files)} subjects would be rebuilt')
+        for f in stale_files:
+            print(f'  {f.name}')
+        return []
+
+    if jobs > 1:
+        # Each subject is independent and writes only its own files, so subjects can be
+        # processed in any order. executor.map returns results in input order.
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(process_subject, stale_files,
+                                        repeat(input_dir), repeat(bids_dir),
+                                        repeat(window), repeat(stride), repeat(grouping)))
+    else:
+        results = [process_subject(f, input_dir, bids_dir, window, stride, grouping) for f in stale_files]
+
+    with instrumentation.stage('event_store'):
+        event_store.write_event_store(store_dir, [(result.subject_id, *result.events)
+                                                  for result in results if result.error is None])
+
+    with instrumentation.stage('manifest'):
+        for f, result in zip(stale_files, results):
+            if result.error is None:
+                rebuild_manifest.record(manifest, result.subject_id, signatures[f], VERSION, parameters,
+                                        result.outputs)
+            else:
+                manifest['subjects'].pop(result.subject_id, None)
+        rebuild_manifest.write_manifest(input_dir, manifest)
+
+    print_summary(results, len(files) - len(stale_files))
+    return results
 
 
 if __name__ == "__main__":
@@ -292,6 +378,48 @@ if __name__ == "__main__":
                         help='absolute path to your top level bids folder.',
                         dest='bids_dir'
                         )
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of subjects to process in parallel.',
+                        dest='jobs'
+                        )
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild every subject, even if its outputs are up to date.',
+                        dest='force'
+                        )
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='list the subjects that would be rebuilt, without writing any files.',
+                        dest='dry_run'
+                        )
+    parser.add_argument('-w', '--window', metavar='Window size', action='store',
+                        type=int, required=False, default=5,
+                        help='number of consecutive trials in each moving average condition.',
+                        dest='window'
+                        )
+    parser.add_argument('-s', '--stride', metavar='Window stride', action='store',
+                        type=int, required=False, default=1,
+                        help='number of trials between the starts of consecutive moving average conditions.',
+                        dest='stride'
+                        )
+    parser.add_argument('-g', '--grouping', action='store',
+                        choices=list(MOVING_WINDOW_GROUPINGS), required=False, default='go-no-go',
+                        help='groups of trials to create moving average conditions for: go and no-go trials, '
+                             'or the correct/failed go/stop conditions.',
+                        dest='grouping'
+                        )
+    parser.add_argument('-p', '--profile', metavar='Trace file', action='store', nargs='?',
+                        type=str, required=False, default=None, const=instrumentation.DEFAULT_TRACE_NAME,
+                        help='time each stage of each subject, count its reads, writes and opened files, '
+                             'and write the trace to this file (see instrumentation.py).',
+                        dest='profile'
+                        )
     args = parser.parse_args()
-
-    main(args.input_dir, args.bids_dir)
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+    if args.stride < 1:
+        parser.error('--stride must be at least 1')
+
+    if args.profile:
+        instrumentation.enable(args.profile)
+    main(args.input_dir, args.bids_dir, args.jobs, args.force, args.dry_run,
+         args.window, args.stride, args.grouping)
@@ -4,43 +4,35 @@ import numpy as np
 from typing import Tuple, List
 import re
 
+import instrumentation
+from event_store import load_event_store, store_path, subject_events
+from sst_reader import read_events_tsv, CORRECT_GO, FAILED_GO
+
 STUDY_ID = 'CC'
 wave = '1'
 
 
-def go_trial_success_converter(s: bytes) -> int:
+@instrumentation.timed
+def latent_class_features(duration: np.ndarray, trial_type: np.ndarray) -> Tuple[int, float, float]:
     """
-    Converter to translate :param s: containing a trial type into 1 or 0.
-    :param s: Trial type. Trial type containing 'correct-go' indicates successful 'go' trials.
-    Trial type containing 'failed-go' indicates unsuccessful 'go' trials.
-    :return: 1 for successful go trials, 0 for failure go trials
+    Return a tuple of (number of failed go trials, mean and standard deviation of successful go trial duration)
     """
-    if s.startswith(b'correct-go'):
-        return 1
-    elif s.startswith(b'failed-go'):
-        return 0
-    else:
-        return -1
+    num_failed_go = np.count_nonzero(trial_type == FAILED_GO)
+    successful_go_duration = np.ma.masked_where(trial_type != CORRECT_GO, duration)
+    mean = successful_go_duration.mean()
+    std_deviation = successful_go_duration.std()
 
+    return num_failed_go, mean, std_deviation
 
+
+@instrumentation.timed
 def tsv_data_read_for_latent_class(file: Path) -> Tuple[int, float, float]:
     """
     Read behavioral data out of events.tsv files.
-    Return a list of tuples of (duration, go trial success or failure)
+    Return a tuple of (number of failed go trials, mean and standard deviation of successful go trial duration)
     """
-    converters = {2: go_trial_success_converter}
-
-    _, duration, trial_type = np.loadtxt(str(file),
-                                         delimiter='\t',
-                                         skiprows=1,
-                                         converters=converters,
-                                         unpack=True)
-    num_failed_go = trial_type.size - np.count_nonzero(trial_type)
-    successful_go_duration = np.ma.masked_where(trial_type != 1, duration)
-    mean = successful_go_duration.mean()
-    std_deviation = successful_go_duration.std()
-
-    return num_failed_go, mean, std_deviation
+    _, duration, trial_type = read_events_tsv(file)
+    return latent_class_features(duration, trial_type)
 
 
 def write_for_rescorla_wagner(file: Path, events: List[Tuple], is_go: bool = True):
@@ -56,23 +48,45 @@ def write_for_rescorla_wagner(file: Path, events: List[Tuple], is_go: bool = Tru
             f.write(f'{e[0]}\t{int(e[1])}\n')
 
 
+def write_latent_class_analysis_header(file):
+    # Column names read by latent_class_analysis.R and latent_class_model.py
+    file.write('subject_id\tfailed_go\tmean_rt\tstd_dev_rt\n')
+
+
+@instrumentation.timed
 def write_for_latent_class_analysis(file, subject_id: str, event: Tuple[int, float, float]):
     file.write(f'{subject_id}\t{event[0]}\t{event[1]}\t{event[2]}\n')
 
 
-def main(input_dir: str):
+def main(input_dir: str, use_store: bool = False):
+    if use_store:
+        # Read every subject's events out of the cohort event store written by multiconds.py
+        with instrumentation.stage('load_event_store'):
+            store = load_event_store(store_path(input_dir))
+        new_file_name = Path(input_dir) / 'latent_class_analysis.tsv'
+        with open(str(new_file_name), mode='w') as outfile:
+            write_latent_class_analysis_header(outfile)
+            for subject_id in sorted(store.subjects):
+                with instrumentation.stage('subject', subject_id):
+                    _, duration, trial_type = subject_events(store, subject_id)
+                    events = latent_class_features(duration, trial_type)
+                    write_for_latent_class_analysis(outfile, f'{STUDY_ID}{subject_id}', events)
+        return
+
     files = sorted(Path(input_dir).glob('*_task-SST_acq-1_events.tsv'))
 
     pattern = f'({STUDY_ID}' + '\\d{3})_ses-wave1_task-SST_acq-1_events.tsv'
     new_file_name = files[0].with_name('latent_class_analysis' + str(files[0].suffix))
     with open(str(new_file_name), mode='w') as outfile:
+        write_latent_class_analysis_header(outfile)
         for f in files:
             match = re.search(pattern, str(f.name))
             subject_id = ''
             if match:
                 subject_id, = match.groups()
-            events = tsv_data_read_for_latent_class(f)
-            write_for_latent_class_analysis(outfile, subject_id, events)
+            with instrumentation.stage('subject', subject_id or f.name):
+                events = tsv_data_read_for_latent_class(f)
+                write_for_latent_class_analysis(outfile, subject_id, events)
 
 
 if __name__ == "__main__":
@@ -87,6 +101,19 @@ if __name__ == "__main__":
                         help='absolute path to directory containing events.tsv files from the SST task.',
                         dest='input_dir'
                         )
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='read events from the cohort event store written by multiconds.py, '
+                             'instead of the events.tsv files.',
+                        dest='use_store'
+                        )
+    parser.add_argument('-p', '--profile', metavar='Trace file', action='store', nargs='?',
+                        type=str, required=False, default=None, const=instrumentation.DEFAULT_TRACE_NAME,
+                        help='time each stage of each subject, count its reads, writes and opened files, '
+                             'and write the trace to this file (see instrumentation.py).',
+                        dest='profile'
+                        )
     args = parser.parse_args()
 
-    main(args.input_dir)
+    if args.profile:
+        instrumentation.enable(args.profile)
+    main(args.input_dir, args.use_store)
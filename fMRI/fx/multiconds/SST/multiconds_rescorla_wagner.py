@@ -3,99 +3,87 @@ from pathlib import Path
 import numpy as np
 from typing import Tuple, List
 
+import instrumentation
+from event_store import load_event_store, store_path, subject_events
+from sst_reader import read_events_tsv, CORRECT_GO, FAILED_GO, CORRECT_STOP, FAILED_STOP
+
 STUDY_ID = 'CC'
 wave = '1'
 
 
-def go_trial_success_converter(s: bytes) -> int:
+def go_trial_success(trial_type: np.ndarray) -> np.ndarray:
     """
-    Converter to translate :param s: containing a trial type into 1 or 0.
-    :param s: Trial type. Trial type containing 'correct-go' indicates successful 'go' trials.
-    Trial type containing 'failed-go' indicates unsuccessful 'go' trials.
-    :return: 1 for successful go trials, 0 for failure go trials
+    Translate trial type codes into 1 or 0.
+    :param trial_type: Trial type codes. 'correct-go' indicates successful 'go' trials.
+    'failed-go' indicates unsuccessful 'go' trials.
+    :return: 1 for successful go trials, 0 for failure go trials, -1 for all other trials
     """
-    if s.startswith(b'correct-go'):
-        return 1
-    elif s.startswith(b'failed-go'):
-        return 0
-    else:
-        return -1
+    success = np.full(trial_type.shape, -1, dtype=np.int8)
+    success[trial_type == CORRECT_GO] = 1
+    success[trial_type == FAILED_GO] = 0
+    return success
 
 
-def stop_trial_success_converter(s: bytes) -> int:
+def go_no_go_trial(trial_type: np.ndarray) -> np.ndarray:
     """
-    Converter to translate :param s: containing a trial type into 1 or 0.
-    :param s: Trial type. Trial type containing 'correct-stop' indicates successful 'no-go' trials.
-    Trial type containing 'failed-stop' indicates unsuccessful 'no-go' trials.
-    :return: 1 for successful go trials, 0 for failure go trials
+    Translate trial type codes into 1 or 0.
+    :param trial_type: Trial type codes. 'correct-go' or 'failed-go' indicates 'go' trials.
+    'correct-stop' or 'failed-stop' indicates 'no-go' trials.
+    :return: 1 for go trials, 0 for no-go trials, -1 for all other trials
     """
-    if s.startswith(b'correct-stop'):
-        return 1
-    elif s.startswith(b'failed-stop'):
-        return 0
-    else:
-        return -1
+    go_no_go = np.full(trial_type.shape, -1, dtype=np.int8)
+    go_no_go[(trial_type == CORRECT_GO) | (trial_type == FAILED_GO)] = 1
+    go_no_go[(trial_type == CORRECT_STOP) | (trial_type == FAILED_STOP)] = 0
+    return go_no_go
 
 
-def go_no_go_trial_converter(s: bytes) -> int:
+@instrumentation.timed
+def rescorla_wagner_events(duration: np.ndarray, trial_type: np.ndarray) -> List[Tuple]:
     """
-    Converter to translate :param s: containing a trial type into 1 or 0.
-    :param s: Trial type. Trial type containing 'correct-go' or 'failed-go' indicates 'ngo' trials.
-    Trial type containing 'correct-stop' or 'failed-stop' indicates 'no-go' trials.
-    :return: 1 for go trials, 0 for no-go trials
+    Return a list of tuples of (duration, go trial success or failure)
     """
-    if s.endswith(b'-go'):
-        return 1
-    elif s.endswith(b'-stop'):
-        return 0
-    else:
-        return -1
+    success = go_trial_success(trial_type)
+
+    is_go = success >= 0
+    return list(zip(duration[is_go], success[is_go]))
 
 
+@instrumentation.timed
+def go_no_go_events(duration: np.ndarray, trial_type: np.ndarray) -> List[Tuple]:
+    """
+    Return a list of tuples of (duration, go trial following a no-go trial)
+    """
+    go_no_go = go_no_go_trial(trial_type)
+
+    # Set the event value to one if the trial is a go-trial type following a no-go-trial type,
+    # and set the event value to zero if the trial is a go-trial type following a go-trial type
+    event_value = go_no_go.copy()
+    event_value[1:][(go_no_go[1:] == 1) & (go_no_go[:-1] == 0)] = 1
+    event_value[:1] = 0
+    return list(zip(duration, event_value))
+
+
+@instrumentation.timed
 def tsv_data_read_for_rescorla_wagner(file: Path) -> List[Tuple]:
     """
     Read behavioral data out of events.tsv files.
     Return a list of tuples of (duration, go trial success or failure)
     """
-    converters = {2: go_trial_success_converter}
-
-    _, duration, trial_type = np.loadtxt(str(file),
-                                         delimiter='\t',
-                                         skiprows=1,
-                                         converters=converters,
-                                         unpack=True)
-    events = []
-    for d, g in zip(duration, trial_type):
-        if g == 0 or g == 1:
-            events.append((d, g))
-    return events
+    _, duration, trial_type = read_events_tsv(file)
+    return rescorla_wagner_events(duration, trial_type)
 
 
+@instrumentation.timed
 def tsv_data_read_go_no_go(file: Path) -> List[Tuple]:
     """
     Read behavioral data out of events.tsv files.
-    Return a list of tuples of (duration, go trial success or failure)
+    Return a list of tuples of (duration, go trial following a no-go trial)
     """
-    converters = {2: go_no_go_trial_converter}
-
-    _, duration, trial_type = np.loadtxt(str(file),
-                                         delimiter='\t',
-                                         skiprows=1,
-                                         converters=converters,
-                                         unpack=True)
-    events = []
-    # Set the event value to one if the trial is a go-trial type following a no-go-trial type,
-    # and set the event value to zero if the trial is a go-trial type following a go-trial type
-    for i, (d, g) in enumerate(zip(duration, trial_type)):
-        event_value = g
-        if i == 0:
-            event_value = 0
-        elif trial_type[i] == 1 and trial_type[i-1] == 0:
-            event_value = 1
-        events.append((d, event_value))
-    return events
+    _, duration, trial_type = read_events_tsv(file)
+    return go_no_go_events(duration, trial_type)
 
 
+@instrumentation.timed
 def write_for_rescorla_wagner(file: Path, events: List[Tuple], is_go: bool = True):
     """
     Write a new file containing only the go-trial success or failure
@@ -109,14 +97,27 @@ def write_for_rescorla_wagner(file: Path, events: List[Tuple], is_go: bool = Tru
             f.write(f'{e[0]}\t{int(e[1])}\n')
 
 
-def main(input_dir: str):
+def main(input_dir: str, use_store: bool = False):
+    if use_store:
+        # Read every subject's events out of the cohort event store written by multiconds.py
+        with instrumentation.stage('load_event_store'):
+            store = load_event_store(store_path(input_dir))
+        for subject_id in sorted(store.subjects):
+            with instrumentation.stage('subject', subject_id):
+                _, duration, trial_type = subject_events(store, subject_id)
+                f = Path(input_dir) / f'sub-{STUDY_ID}{subject_id}_ses-wave{wave}_task-SST_acq-1_events.tsv'
+                write_for_rescorla_wagner(f, rescorla_wagner_events(duration, trial_type))
+                write_for_rescorla_wagner(f, go_no_go_events(duration, trial_type), is_go=False)
+        return
+
     files = sorted(Path(input_dir).glob('*_task-SST_acq-1_events.tsv'))
 
     for f in files:
-        events = tsv_data_read_for_rescorla_wagner(f)
-        write_for_rescorla_wagner(f, events)
-        events = tsv_data_read_go_no_go(f)
-        write_for_rescorla_wagner(f, events, is_go=False)
+        with instrumentation.stage('subject', f.name):
+            events = tsv_data_read_for_rescorla_wagner(f)
+            write_for_rescorla_wagner(f, events)
+            events = tsv_data_read_go_no_go(f)
+            write_for_rescorla_wagner(f, events, is_go=False)
 
 
 if __name__ == "__main__":
@@ -131,6 +132,19 @@ if __name__ == "__main__":
                         help='absolute path to directory containing events.tsv files from the SST task.',
                         dest='input_dir'
                         )
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='read events from the cohort event store written by multiconds.py, '
+                             'instead of the events.tsv files.',
+                        dest='use_store'
+                        )
+    parser.add_argument('-p', '--profile', metavar='Trace file', action='store', nargs='?',
+                        type=str, required=False, default=None, const=instrumentation.DEFAULT_TRACE_NAME,
+                        help='time each stage of each subject, count its reads, writes and opened files, '
+                             'and write the trace to this file (see instrumentation.py).',
+                        dest='profile'
+                        )
     args = parser.parse_args()
 
-    main(args.input_dir)
+    if args.profile:
+        instrumentation.enable(args.profile)
+    main(args.input_dir, args.use_store)
@@ -0,0 +1,254 @@
+import argparse
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+from event_store import load_event_store, store_path, subject_events
+from sst_reader import read_events_tsv, CORRECT_GO, CORRECT_STOP, FAILED_GO, FAILED_STOP
+from sst_stream import stream_subjects
+
+STUDY_ID = 'CC'
+
+# Fixed effects of the model fit by multilevel_model.R:
+# rt ~ time + condition + time * conditioncorrect_stop + time * conditionfailed_go + is_treatment +
+#      time * is_treatment + time * is_treatment * conditioncorrect_stop +
+#      time * is_treatment * conditionfailed_go + (1 | subject)
+# with correct-go as the reference condition. Terms are named as lme4 names them.
+TERMS = ('(Intercept)',
+         'time',
+         'conditioncorrect-stop',
+         'conditionfailed-go',
+         'conditionfailed-stop',
+         'is_treatment',
+         'time:conditioncorrect_stop',
+         'time:conditionfailed_go',
+         'time:is_treatment',
+         'conditioncorrect_stop:is_treatment',
+         'conditionfailed_go:is_treatment',
+         'time:conditioncorrect_stop:is_treatment',
+         'time:conditionfailed_go:is_treatment')
+
+COEFFICIENTS_FILE_NAME = 'multilevel_model_coefficients.tsv'
+
+
+def read_groups(file: Path) -> Dict[str, int]:
+    """
+    Read is_control.tsv, with a header and subject_id and is_treatment columns.
+    :return: dict of subject ID to is_treatment
+    """
+    groups = {}
+    with open(str(file), 'r') as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        subject_column, group_column = columns.index('subject_id'), columns.index('is_treatment')
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if len(values) > max(subject_column, group_column):
+                groups[values[subject_column].strip('"')] = int(values[group_column])
+    return groups
+
+
+def read_subjects(input_dir: str, use_store: bool = False,
+                  use_csv: bool = False) -> List[Tuple[str, np.ndarray, np.ndarray]]:
+    """
+    :param use_csv: stream events from the behavioral .csv files, without events.tsv files (see sst_stream.py)
+    :return: list of (subject ID, duration, trial type codes) for every subject
+    """
+    subjects = []
+    if use_csv:
+        for record in stream_subjects(input_dir):
+            subjects.append((f'{STUDY_ID}{record.subject_id}', record.duration, record.trial_type))
+    elif use_store:
+        store = load_event_store(store_path(input_dir))
+        for subject_id in sorted(store.subjects):
+            _, duration, trial_type = subject_events(store, subject_id)
+            subjects.append((f'{STUDY_ID}{subject_id}', duration, trial_type))
+    else:
+        pattern = f'({STUDY_ID}' + '\\d{3})'
+        for f in sorted(Path(input_dir).glob('sub*_task-SST_acq-1_events.tsv')):
+            match = re.search(pattern, str(f.name))
+            if match:
+                _, duration, trial_type = read_events_tsv(f)
+                subjects.append((match.group(1), duration, trial_type))
+    return subjects
+
+
+def create_design(subjects: List[Tuple[str, np.ndarray, np.ndarray]],
+                  groups: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    """
+    Build the long-format design of all subjects into preallocated arrays.
+    time is the trial number within each subject, counting from 1 over all trials.
+    Trials that are not correct/failed go/stop trials, and subjects without a group, are left out.
+    :return: response (rows), fixed effects design (rows x TERMS), subject index of each row, subject IDs
+    """
+    subjects = [s for s in subjects if s[0] in groups]
+    kept = [np.isin(trial_type, (CORRECT_GO, CORRECT_STOP, FAILED_GO, FAILED_STOP)) for _, _, trial_type in subjects]
+    num_rows = sum(np.count_nonzero(k) for k in kept)
+
+    response = np.empty(num_rows)
+    design = np.empty((num_rows, len(TERMS)))
+    subject_index = np.empty(num_rows, dtype=np.int64)
+    start = 0
+    for i, ((subject_id, duration, trial_type), keep) in enumerate(zip(subjects, kept)):
+        rows = slice(start, start + np.count_nonzero(keep))
+        time = np.arange(1, len(duration) + 1, dtype=np.float64)[keep]
+        trial_type = trial_type[keep]
+        correct_stop = (trial_type == CORRECT_STOP).astype(np.float64)
+        failed_go = (trial_type == FAILED_GO).astype(np.float64)
+        failed_stop = (trial_type == FAILED_STOP).astype(np.float64)
+        is_treatment = float(groups[subject_id])
+
+        response[rows] = duration[keep]
+        design[rows] = np.column_stack((np.ones_like(time),
+                                        time,
+                                        correct_stop,
+                                        failed_go,
+                                        failed_stop,
+                                        np.full_like(time, is_treatment),
+                                        time * correct_stop,
+                                        time * failed_go,
+                                        time * is_treatment,
+                                        correct_stop * is_treatment,
+                                        failed_go * is_treatment,
+                                        time * correct_stop * is_treatment,
+                                        time * failed_go * is_treatment))
+        subject_index[rows] = i
+        start = rows.stop
+    return response, design, subject_index, [s[0] for s in subjects]
+
+
+class RandomInterceptModel:
+    """
+    Linear mixed model y = X b + u[subject] + e, with u ~ N(0, theta * sigma^2) and e ~ N(0, sigma^2),
+    fit by restricted maximum likelihood (REML).
+
+    The covariance of each subject's rows is sigma^2 (I + theta 1 1'), whose inverse is
+    (I - w 1 1') / sigma^2 with w = theta / (1 + n theta). So every quantity of the REML criterion is a
+    per-subject sufficient statistic (X'X, X'y, y'y, X'1, 1'y, n) weighted by w, and the criterion is
+    evaluated for many values of theta at once with batched linear algebra.
+    """
+    def __init__(self, response: np.ndarray, design: np.ndarray, subject_index: np.ndarray):
+        num_subjects = subject_index.max() + 1
+        self.num_rows, self.num_terms = design.shape
+        self.n = np.bincount(subject_index, minlength=num_subjects).astype(np.float64)
+        self.xtx = design.T @ design
+        self.xty = design.T @ response
+        self.yty = response @ response
+        # Per-subject column sums of X and sums of y
+        self.x_sum = np.zeros((num_subjects, self.num_terms))
+        np.add.at(self.x_sum, subject_index, design)
+        self.y_sum = np.bincount(subject_index, weights=response, minlength=num_subjects)
+
+    def profile(self, theta: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param theta: ratio of subject to residual variance, one value per model to evaluate
+        :return: for each theta, X'V^-1 X and the estimates of b and sigma^2 (V scaled by sigma^2),
+        and the REML criterion (-2 log restricted likelihood, without constant terms)
+        """
+        w = theta[:, np.newaxis] / (1.0 + np.outer(theta, self.n))
+        a = self.xtx - np.einsum('ts,si,sj->tij', w, self.x_sum, self.x_sum)
+        b = self.xty - np.einsum('ts,si,s->ti', w, self.x_sum, self.y_sum)
+        c = self.yty - w @ (self.y_sum ** 2)
+        coefficients = np.linalg.solve(a, b[..., np.newaxis])[..., 0]
+        degrees_of_freedom = self.num_rows - self.num_terms
+        sigma2 = (c - np.sum(b * coefficients, axis=1)) / degrees_of_freedom
+        _, log_det_a = np.linalg.slogdet(a)
+        criterion = (degrees_of_freedom * np.log(sigma2) +
+                     np.sum(np.log1p(np.outer(theta, self.n)), axis=1) +
+                     log_det_a)
+        return a, coefficients, sigma2, criterion
+
+    def fit(self, grid_size: int = 200) -> Dict:
+        """
+        Minimize the REML criterion over log theta: a grid over 1e-8..1e4, then a bounded scalar
+        refinement around the best grid point.
+        """
+        log_theta = np.linspace(np.log(1e-8), np.log(1e4), grid_size)
+        criterion = self.profile(np.exp(log_theta))[3]
+        best = int(np.argmin(criterion))
+        low, high = log_theta[max(best - 1, 0)], log_theta[min(best + 1, grid_size - 1)]
+        result = minimize_scalar(lambda x: self.profile(np.exp(np.atleast_1d(x)))[3][0],
+                                 bounds=(low, high), method='bounded')
+        log_theta_hat = result.x if result.fun <= criterion[best] else log_theta[best]
+
+        theta = np.exp(np.atleast_1d(log_theta_hat))
+        a, coefficients, sigma2, criterion = self.profile(theta)
+        covariance = sigma2[0] * np.linalg.inv(a[0])
+        return {'coefficients': coefficients[0],
+                'std_errors': np.sqrt(np.diag(covariance)),
+                'residual_variance': sigma2[0],
+                'subject_variance': theta[0] * sigma2[0],
+                'reml_criterion': criterion[0]}
+
+
+def write_coefficients(file: Path, fit: Dict):
+    """
+    Write a table of the fixed effects with their standard errors and t values,
+    followed by the variance components.
+    """
+    with open(str(file), mode='w') as f:
+        f.write('term\testimate\tstd_error\tt_value\n')
+        for term, estimate, std_error in zip(TERMS, fit['coefficients'], fit['std_errors']):
+            f.write(f'{term}\t{estimate:.6e}\t{std_error:.6e}\t{estimate / std_error:.4f}\n')
+        f.write(f'subject_variance\t{fit["subject_variance"]:.6e}\tNA\tNA\n')
+        f.write(f'residual_variance\t{fit["residual_variance"]:.6e}\tNA\tNA\n')
+
+
+def read_coefficients(file: Path) -> Dict[str, float]:
+    """
+    Read the table written by write_coefficients()
+    :return: dict of term to estimate
+    """
+    coefficients = {}
+    with open(str(file), 'r') as f:
+        f.readline()
+        for line in f:
+            term, estimate, *_ = line.rstrip('\n').split('\t')
+            coefficients[term] = float(estimate)
+    return coefficients
+
+
+def main(input_dir: str, group_file: str, use_store: bool = False, use_csv: bool = False):
+    subjects = read_subjects(input_dir, use_store, use_csv)
+    groups = read_groups(Path(group_file))
+    missing = [subject_id for subject_id, *_ in subjects if subject_id not in groups]
+    if missing:
+        print(f'Leaving out subjects without a group in {group_file}: {", ".join(missing)}')
+
+    response, design, subject_index, _ = create_design(subjects, groups)
+    fit = RandomInterceptModel(response, design, subject_index).fit()
+    write_coefficients(Path(input_dir) / COEFFICIENTS_FILE_NAME, fit)
+
+
+if __name__ == "__main__":
+    description = f'Fit a random intercept model of SST response times in {STUDY_ID} study'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-i', '--input', metavar='Input directory', action='store',
+                        type=str, required=True,
+                        help='absolute path to directory containing events.tsv files from the SST task.',
+                        dest='input_dir'
+                        )
+    parser.add_argument('-g', '--groups', metavar='Group file', action='store',
+                        type=str, required=True,
+                        help='absolute path to is_control.tsv, with subject_id and is_treatment columns.',
+                        dest='group_file'
+                        )
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='read events from the cohort event store written by multiconds.py, '
+                             'instead of the events.tsv files.',
+                        dest='use_store'
+                        )
+    parser.add_argument('-c', '--csv', action='store_true',
+                        help='read events straight from the behavioral .csv files of the SST task, '
+                             'instead of the events.tsv files.',
+                        dest='use_csv'
+                        )
+    args = parser.parse_args()
+
+    main(args.input_dir, args.group_file, args.use_store, args.use_csv)
@@ -1,15 +1,31 @@
+import argparse
+
 import matplotlib.pyplot as plt
 import numpy as np
 
+from multilevel_model import read_coefficients
+
 # Plot model predictions from multilevel_model
 
+parser = argparse.ArgumentParser(description='Plot predicted response times from the multilevel model',
+                                 add_help=True,
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-c', '--coefficients', metavar='Coefficients file', action='store',
+                    type=str, required=True,
+                    help='absolute path to multilevel_model_coefficients.tsv written by multilevel_model.py.',
+                    dest='coefficients_file'
+                    )
+args = parser.parse_args()
+b = read_coefficients(args.coefficients_file)
+
 size = 100
 trial_number = np.arange(0, size)
 correct_stop = np.ones_like(trial_number)
 failed_go = np.ones_like(trial_number)
-y_ref = 6.695e-01 - 1.711e-04 * trial_number
-y_correct_stop = y_ref + 3.241e-01 * correct_stop + 2.330e-04 * trial_number * correct_stop
-y_failed_go = y_ref + 4.395e-01 * failed_go - 1.683e-03 * trial_number * failed_go
+y_ref = b['(Intercept)'] + b['time'] * trial_number
+y_correct_stop = y_ref + b['conditioncorrect-stop'] * correct_stop + \
+                 b['time:conditioncorrect_stop'] * trial_number * correct_stop
+y_failed_go = y_ref + b['conditionfailed-go'] * failed_go + b['time:conditionfailed_go'] * trial_number * failed_go
 
 # Multiply by 1000 to plot milliseconds, instead of seconds
 y_ref *= 1000
@@ -28,11 +44,15 @@ axs[0].legend(title='Non-food')
 
 # create plots for treatment condition, so add terms related to treatment or control condition
 is_treatment = np.ones_like(trial_number)
-y_ref = 6.695e-01 - 1.711e-04 * trial_number + 1.704e-02 * is_treatment + 2.367e-04 * trial_number * is_treatment
-y_correct_stop = y_ref + 3.241e-01 * correct_stop + 2.330e-04 * trial_number * correct_stop - \
-                 1.451e-02 * correct_stop * is_treatment - 2.603e-04 * trial_number * correct_stop * is_treatment
-y_failed_go = y_ref + 4.395e-01 * failed_go - 1.683e-03 * trial_number * failed_go - \
-              1.445e-02 * failed_go * is_treatment + 3.395e-05 * trial_number * failed_go * is_treatment
+y_ref = b['(Intercept)'] + b['time'] * trial_number + b['is_treatment'] * is_treatment + \
+        b['time:is_treatment'] * trial_number * is_treatment
+y_correct_stop = y_ref + b['conditioncorrect-stop'] * correct_stop + \
+                 b['time:conditioncorrect_stop'] * trial_number * correct_stop + \
+                 b['conditioncorrect_stop:is_treatment'] * correct_stop * is_treatment + \
+                 b['time:conditioncorrect_stop:is_treatment'] * trial_number * correct_stop * is_treatment
+y_failed_go = y_ref + b['conditionfailed-go'] * failed_go + b['time:conditionfailed_go'] * trial_number * failed_go + \
+              b['conditionfailed_go:is_treatment'] * failed_go * is_treatment + \
+              b['time:conditionfailed_go:is_treatment'] * trial_number * failed_go * is_treatment
 
 y_ref *= 1000
 y_correct_stop *= 1000
@@ -48,4 +68,3 @@ axs[1].set_ylabel('Predicted RT (ms)')
 axs[1].legend(title='Food')
 
 plt.show()
-
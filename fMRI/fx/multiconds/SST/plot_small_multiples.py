@@ -1,40 +1,187 @@
-import matplotlib.pyplot as plt
-import numpy as np
-from pathlib import Path
+"""
+Small multiples of the go-trial series of each subject (the first column of the *_go.tsv files written by
+multiconds_rescorla_wagner.py), one panel per subject, in pages of 13 x 12 panels by default.
+
+Each page is a single Axes, with every subject's series offset into its panel and drawn as one LineCollection,
+so drawing a page costs about the same for a few subjects or a full grid. Panels share their axes: the limits
+are the same for all, and tick labels are only drawn under the lowest panel of each column and left of the
+first column.
+Values beyond the limits are drawn at the edge of their panel.
+
+Without an output directory, the pages are shown interactively. With one, they are rendered with the
+non-interactive Agg backend in a process pool, one file per page (small_multiples_001.png, ...).
+"""
+import argparse
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import List, Tuple
+
+import matplotlib
+import numpy as np
+from matplotlib import style
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.markers import TICKDOWN
+from matplotlib.transforms import offset_copy
+
+SUBJECT_PATTERN = '(CC\\d{3})'
+PAGE_NAME = 'small_multiples_{:03d}.{}'
+# Space between panels, and above each panel for its title, as fractions of the panel size
+GAP = 0.08
+TITLE_SPACE = 0.18
+
+
+def find_series(input_dir: str) -> List[Tuple[str, Path]]:
+    """:return: (subject ID, file) of every *_go.tsv file in :param input_dir: whose name has a subject ID"""
+    series = []
+    for f in sorted(Path(input_dir).glob('*_go.tsv')):
+        match = re.search(SUBJECT_PATTERN, f.name)
+        if match:
+            series.append((match.group(1), f))
+    return series
+
+
+def read_series(file: Path) -> np.ndarray:
+    """First column of a two-column tab-separated file without a header"""
+    with open(str(file), 'r') as f:
+        return np.array(f.read().split(), dtype=np.float64)[0::2]
+
+
+def pages(series: List[Tuple[str, Path]], nrows: int, ncols: int) -> List[List[Tuple[str, Path]]]:
+    per_page = nrows * ncols
+    return [series[start:start + per_page] for start in range(0, len(series), per_page)]
+
+
+def draw_page(fig: Figure, page: List[Tuple[str, Path]], nrows: int, ncols: int, xlim: float, ylim: float):
+    """Draw the panels of :param page: into one Axes of :param fig:"""
+    width = xlim * (1.0 + GAP)
+    height = ylim * (1.0 + GAP + TITLE_SPACE)
+    ax = fig.add_axes((0.04, 0.04, 0.94, 0.94))
+    colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+
+    segments, panels = [], []
+    for k, (subject_id, f) in enumerate(page):
+        row, col = divmod(k, ncols)
+        x0, y0 = col * width, (nrows - 1 - row) * height
+        y = read_series(f)[:int(xlim) + 1]
+        segments.append(np.column_stack([x0 + np.arange(len(y)), y0 + np.clip(y, 0.0, ylim)]))
+        panels.append([(x0, y0), (x0 + xlim, y0), (x0 + xlim, y0 + ylim), (x0, y0 + ylim)])
+        ax.text(x0 + xlim / 2.0, y0 + ylim * (1.0 + TITLE_SPACE / 4.0), subject_id, fontsize=8,
+                ha='center', va='bottom')
+
+    ax.add_collection(PolyCollection(panels, facecolors='#E5E5E5', edgecolors='none', zorder=0))
+    ax.add_collection(LineCollection(segments, colors=colors[0], linewidths=1.0, zorder=1))
+
+    ax.set_xlim(-xlim * GAP, ncols * width)
+    ax.set_ylim(-ylim * GAP, nrows * height)
+    # Tick labels of the shared axes, under the lowest panel of each column and left of the first column.
+    # On a partly filled last page the columns end at different rows, which the x axis of one Axes cannot
+    # follow, so the x ticks are drawn as markers and text.
+    last_row = min(nrows, (len(page) + ncols - 1) // ncols) - 1
+    # Interior x ticks only, so that labels of neighbouring panels do not run into each other
+    x_ticks = np.linspace(0.0, xlim, 6)[1:-1]
+    tick_color = matplotlib.rcParams['xtick.color']
+    label_offset = offset_copy(ax.transData, fig=fig, y=-3.0, units='points')
+    for col in range(min(ncols, len(page))):
+        lowest_row = (len(page) - 1 - col) // ncols
+        y0 = (nrows - 1 - lowest_row) * height
+        ax.plot(col * width + x_ticks, np.full(len(x_ticks), y0), linestyle='none', marker=TICKDOWN,
+                markersize=2, color=tick_color, clip_on=False)
+        for v in x_ticks:
+            ax.text(col * width + v, y0, f'{v:g}', transform=label_offset, fontsize=7, color=tick_color,
+                    ha='center', va='top')
+    ax.set_xticks([])
+    y_ticks = np.linspace(0.0, ylim, 3)
+    ax.set_yticks([(nrows - 1 - row) * height + v for row in range(last_row + 1) for v in y_ticks])
+    ax.set_yticklabels([f'{v:g}' for _ in range(last_row + 1) for v in y_ticks])
+    ax.tick_params(length=2, pad=1, labelsize=7)
+    for side in ('top', 'right', 'left', 'bottom'):
+        ax.spines[side].set_visible(False)
+    ax.grid(False)
+    ax.set_facecolor('none')
+
+
+def render_page(number: int, page: List[Tuple[str, Path]], output_dir: Path, file_format: str, nrows: int,
+                ncols: int, xlim: float, ylim: float, dpi: int) -> Path:
+    """Render one page to a file, without pyplot, so workers do not need a display"""
+    matplotlib.use('Agg')
+    style.use('ggplot')
+    fig = Figure(figsize=(ncols * 1.2, nrows * 1.0))
+    draw_page(fig, page, nrows, ncols, xlim, ylim)
+    file = output_dir / PAGE_NAME.format(number, file_format)
+    fig.savefig(str(file), dpi=dpi)
+    return file
+
+
+def main(input_dir: str, output_dir: str, file_format: str, nrows: int, ncols: int, xlim: float, ylim: float,
+         dpi: int, jobs: int):
+    series = find_series(input_dir)
+    if not series:
+        print(f'No *_go.tsv files in {input_dir}')
+        return
+    cohort_pages = pages(series, nrows, ncols)
+    if output_dir is None:
+        import matplotlib.pyplot as plt
+        plt.style.use('ggplot')
+        for page in cohort_pages:
+            draw_page(plt.figure(figsize=(ncols * 1.2, nrows * 1.0)), page, nrows, ncols, xlim, ylim)
+        plt.show()
+        return
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    numbers = range(1, len(cohort_pages) + 1)
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        files = list(executor.map(render_page, numbers, cohort_pages, repeat(output_dir), repeat(file_format),
+                                  repeat(nrows), repeat(ncols), repeat(xlim), repeat(ylim), repeat(dpi)))
+    print(f'Plotted {len(series)} subjects on {len(files)} pages in {output_dir}')
+
+
+if __name__ == "__main__":
+    description = 'Plot the go-trial series of every subject as small multiples'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', metavar='Input directory', action='store',
+                        type=str, required=True,
+                        help='directory of the *_go.tsv files written by multiconds_rescorla_wagner.py.',
+                        dest='input_dir')
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory for one file per page. By default, pages are shown interactively.',
+                        dest='output_dir')
+    parser.add_argument('-f', '--format', action='store',
+                        choices=('png', 'pdf'), required=False, default='png',
+                        help='format of the page files.',
+                        dest='file_format')
+    parser.add_argument('-r', '--rows', metavar='Rows', action='store',
+                        type=int, required=False, default=13,
+                        help='rows of panels per page.',
+                        dest='nrows')
+    parser.add_argument('-c', '--columns', metavar='Columns', action='store',
+                        type=int, required=False, default=12,
+                        help='columns of panels per page.',
+                        dest='ncols')
+    parser.add_argument('--xlim', metavar='Trials', action='store',
+                        type=float, required=False, default=50,
+                        help='number of trials shown in each panel.',
+                        dest='xlim')
+    parser.add_argument('--ylim', metavar='Maximum', action='store',
+                        type=float, required=False, default=1.0,
+                        help='upper limit of the y axis of each panel.',
+                        dest='ylim')
+    parser.add_argument('--dpi', metavar='DPI', action='store',
+                        type=int, required=False, default=150,
+                        help='resolution of png pages.',
+                        dest='dpi')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of pages to render in parallel.',
+                        dest='jobs')
+    args = parser.parse_args()
 
-# input_dir is the location of the BIDS-formatted events files
-input_dir = ''
-files = sorted(Path(input_dir).glob(f'*_go.tsv'))
-
-nrows = 13
-ncols = 12
-plt.style.use('ggplot')
-fig, _axs = plt.subplots(nrows=nrows, ncols=ncols)
-axs = _axs.flatten()
-
-for i, f in enumerate(files):
-    pattern = '(CC\\d{3})'
-    match = re.search(pattern, str(f.name))
-    if match:
-        subject_id, = match.groups()
-
-        y, _ = np.loadtxt(str(f),
-                          delimiter='\t',
-                          unpack=True)
-
-        x = list(range(0, len(y)))
-
-        axs[i].plot(x, y)
-        axs[i].set_xlim(0, 50)
-        axs[i].set_ylim(0, 1.0)
-        axs[i].set_title(subject_id, fontsize=8, pad=1.0)
-        axs[i].tick_params(labelbottom=False, labeltop=False, labelleft=False, labelright=False)
-        if axs[i].is_last_row():
-            axs[i].tick_params(labelbottom=True, labelsize=8)
-        if axs[i].is_first_col():
-            axs[i].tick_params(labelleft=True, labelsize=8)
-
-for j in range(len(files), 12 * 13):
-    axs[j].set_visible(False)
-plt.show()
+    main(args.input_dir, args.output_dir, args.file_format, args.nrows, args.ncols, args.xlim, args.ylim, args.dpi,
+         args.jobs)
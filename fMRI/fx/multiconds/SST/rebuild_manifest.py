@@ -0,0 +1,102 @@
+"""
+Manifest of the inputs and outputs of each subject processed by multiconds.py, so that a run
+only regenerates subjects whose input file, tool version or parameters changed.
+
+The manifest is a JSON file stored next to the conditions/ and betaseries/ directories:
+
+{
+    "subjects": {
+        "001": {
+            "input": {"name": ..., "size": ..., "mtime_ns": ..., "sha256": ...},
+            "version": ...,
+            "parameters": {...},
+            "outputs": [...]
+        }
+    }
+}
+"""
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+from typing import Union, Dict, List
+
+MANIFEST_NAME = 'multiconds_manifest.json'
+
+
+def manifest_path(input_dir: Union[PathLike, str]) -> Path:
+    return Path(input_dir) / MANIFEST_NAME
+
+
+def read_manifest(input_dir: Union[PathLike, str]) -> Dict:
+    """
+    :return: the manifest in :param input_dir:, or an empty manifest if there is none
+    """
+    path = manifest_path(input_dir)
+    if not path.exists():
+        return {'subjects': {}}
+    with open(str(path), 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(input_dir: Union[PathLike, str], manifest: Dict):
+    """
+    Write the manifest to a temporary file and rename it, so an interrupted run
+    never leaves a partially written manifest behind.
+    """
+    path = manifest_path(input_dir)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(str(tmp_path), 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(str(tmp_path), str(path))
+
+
+def file_hash(file: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(str(file), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def file_signature(file: Path, previous: Dict = None) -> Dict:
+    """
+    Describe :param file: by its name, size, modification time and content hash.
+    The content hash of :param previous: is reused when size and modification time are unchanged,
+    so unchanged files are not read.
+    """
+    stat = file.stat()
+    signature = {'name': file.name,
+                 'size': stat.st_size,
+                 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == value for key, value in signature.items()):
+        signature['sha256'] = previous['sha256']
+    else:
+        signature['sha256'] = file_hash(file)
+    return signature
+
+
+def is_stale(entry: Union[Dict, None], signature: Dict, version: str, parameters: Dict) -> bool:
+    """
+    A subject is stale if it has no manifest entry, or if its input content, the tool version,
+    or the parameters differ from those that produced its outputs, or if any output is missing.
+    A subject without outputs, e.g. one whose BIDS directory did not exist yet, is always stale.
+    """
+    if entry is None:
+        return True
+    if entry['input']['sha256'] != signature['sha256']:
+        return True
+    if entry['version'] != version or entry['parameters'] != parameters:
+        return True
+    if not entry['outputs']:
+        return True
+    return not all(Path(output).exists() for output in entry['outputs'])
+
+
+def record(manifest: Dict, subject_id: str, signature: Dict, version: str, parameters: Dict,
+           outputs: List[str]):
+    manifest['subjects'][subject_id] = {'input': signature,
+                                        'version': version,
+                                        'parameters': parameters,
+                                        'outputs': outputs}
@@ -0,0 +1,216 @@
+import argparse
+import re
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from event_store import load_event_store, store_path, subject_events
+from multiconds_rescorla_wagner import (rescorla_wagner_events, go_no_go_events,
+                                        tsv_data_read_for_rescorla_wagner, tsv_data_read_go_no_go)
+from sst_stream import stream_subjects, rescorla_wagner_series
+
+STUDY_ID = 'CC'
+
+# Golden ratio, used to shrink the search interval when refining the learning rate
+GOLDEN = (np.sqrt(5.0) - 1.0) / 2.0
+
+
+def pad_series(series: List[List[Tuple]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pack the event series of all subjects into padded arrays.
+    :param series: for each subject, a list of (duration, cue) tuples
+    :return: outcome (subjects x trials), cue (subjects x trials), mask of real (not padded) trials
+    """
+    num_trials = max((len(events) for events in series), default=0)
+    outcome = np.zeros((len(series), num_trials))
+    cue = np.zeros((len(series), num_trials))
+    mask = np.zeros((len(series), num_trials), dtype=bool)
+    for i, events in enumerate(series):
+        if events:
+            outcome[i, :len(events)], cue[i, :len(events)] = np.asarray(events, dtype=np.float64).T
+            mask[i, :len(events)] = True
+    return outcome, cue, mask
+
+
+def rescorla_wagner_predictions(alpha: np.ndarray, outcome: np.ndarray, cue: np.ndarray,
+                                mask: np.ndarray) -> np.ndarray:
+    """
+    Evaluate the Rescorla-Wagner recursion for many learning rates and all subjects at once.
+
+    The prediction for each trial is w . x, with cues x = (1, cue) and weights w starting at zero.
+    After each trial the weights are updated by w += alpha * (outcome - prediction) * x.
+
+    :param alpha: learning rates, shape (rates x subjects) or (rates x 1)
+    :return: predictions, shape (rates x subjects x trials)
+    """
+    num_subjects, num_trials = outcome.shape
+    alpha = np.broadcast_to(alpha, (alpha.shape[0], num_subjects))
+    intercept_weight = np.zeros(alpha.shape)
+    cue_weight = np.zeros(alpha.shape)
+    predictions = np.zeros(alpha.shape + (num_trials,))
+    for t in range(num_trials):
+        prediction = intercept_weight + cue_weight * cue[:, t]
+        predictions[..., t] = prediction
+        # Padded trials do not update the weights
+        update = alpha * (outcome[:, t] - prediction) * mask[:, t]
+        intercept_weight += update
+        cue_weight += update * cue[:, t]
+    return predictions
+
+
+def sum_squared_error(alpha: np.ndarray, outcome: np.ndarray, cue: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """:return: sum of squared prediction errors, shape (rates x subjects)"""
+    predictions = rescorla_wagner_predictions(alpha, outcome, cue, mask)
+    return np.sum(((outcome - predictions) * mask) ** 2, axis=-1)
+
+
+def objective(alpha: np.ndarray, outcome: np.ndarray, cue: np.ndarray, mask: np.ndarray,
+              prior: Union[Tuple[float, float], None]) -> np.ndarray:
+    """
+    Negative log likelihood of a Gaussian response model with the error variance profiled out,
+    plus the negative log density of a Beta(a, b) prior on alpha if :param prior: is given.
+    Constant terms are left out.
+    """
+    num_trials = np.maximum(mask.sum(axis=1), 1)
+    sse = sum_squared_error(alpha, outcome, cue, mask)
+    value = 0.5 * num_trials * np.log(np.maximum(sse, np.finfo(float).tiny) / num_trials)
+    if prior is not None:
+        a, b = prior
+        value -= (a - 1.0) * np.log(alpha) + (b - 1.0) * np.log1p(-alpha)
+    return value
+
+
+def fit_learning_rate(outcome: np.ndarray, cue: np.ndarray, mask: np.ndarray, grid_size: int = 101,
+                      iterations: int = 30, prior: Union[Tuple[float, float], None] = None) -> np.ndarray:
+    """
+    Fit the learning rate of every subject: evaluate a grid of learning rates for all subjects at once,
+    then refine each subject's best grid point by golden-section search between its neighbours.
+    :return: learning rate of each subject
+    """
+    # Keep away from 0 and 1, where the log prior is infinite
+    grid = np.linspace(0.0, 1.0, grid_size + 2)[1:-1]
+    values = objective(grid[:, np.newaxis], outcome, cue, mask, prior)
+    best = np.argmin(values, axis=0)
+    low = grid[np.maximum(best - 1, 0)]
+    high = grid[np.minimum(best + 1, grid_size - 1)]
+
+    for _ in range(iterations):
+        probes = np.stack((high - GOLDEN * (high - low), low + GOLDEN * (high - low)))
+        values = objective(probes, outcome, cue, mask, prior)
+        lower_is_better = values[0] < values[1]
+        high = np.where(lower_is_better, probes[1], high)
+        low = np.where(lower_is_better, low, probes[0])
+
+    alpha = (low + high) / 2.0
+    # Keep the grid point if the refinement did not improve on it
+    refined = objective(alpha[np.newaxis, :], outcome, cue, mask, prior)[0]
+    gridded = objective(grid[best][np.newaxis, :], outcome, cue, mask, prior)[0]
+    return np.where(refined <= gridded, alpha, grid[best])
+
+
+def fit_statistics(alpha: np.ndarray, outcome: np.ndarray, cue: np.ndarray, mask: np.ndarray) -> dict:
+    """
+    Fit statistics of a Gaussian response model, with alpha and the error variance as free parameters.
+    """
+    num_trials = mask.sum(axis=1)
+    sse = sum_squared_error(alpha[np.newaxis, :], outcome, cue, mask)[0]
+    variance = np.maximum(sse, np.finfo(float).tiny) / np.maximum(num_trials, 1)
+    log_likelihood = -0.5 * num_trials * (np.log(2.0 * np.pi * variance) + 1.0)
+    num_parameters = 2
+    return {'n_trials': num_trials,
+            'sse': sse,
+            'rmse': np.sqrt(variance),
+            'log_likelihood': log_likelihood,
+            'bic': num_parameters * np.log(np.maximum(num_trials, 1)) - 2.0 * log_likelihood}
+
+
+def read_series(input_dir: str, use_store: bool = False,
+                use_csv: bool = False) -> Tuple[List[str], List[List[Tuple]], List[List[Tuple]]]:
+    """
+    :param use_csv: stream the series from the behavioral .csv files, without events.tsv files (see sst_stream.py)
+    :return: subject IDs, and for each subject the go-trial series and the go-after-stop series
+    """
+    subject_ids, go_series, stop_series = [], [], []
+    if use_csv:
+        for subject_id, go, stop in rescorla_wagner_series(stream_subjects(input_dir)):
+            subject_ids.append(subject_id)
+            go_series.append(go)
+            stop_series.append(stop)
+    elif use_store:
+        store = load_event_store(store_path(input_dir))
+        for subject_id in sorted(store.subjects):
+            _, duration, trial_type = subject_events(store, subject_id)
+            subject_ids.append(f'{STUDY_ID}{subject_id}')
+            go_series.append(rescorla_wagner_events(duration, trial_type))
+            stop_series.append(go_no_go_events(duration, trial_type))
+    else:
+        pattern = f'({STUDY_ID}' + '\\d{3})'
+        for f in sorted(Path(input_dir).glob('*_task-SST_acq-1_events.tsv')):
+            match = re.search(pattern, str(f.name))
+            subject_ids.append(match.group(1) if match else f.name)
+            go_series.append(tsv_data_read_for_rescorla_wagner(f))
+            stop_series.append(tsv_data_read_go_no_go(f))
+    return subject_ids, go_series, stop_series
+
+
+def write_fit_table(file: Path, rows: List[Tuple[str, str, float, dict]]):
+    columns = ['n_trials', 'sse', 'rmse', 'log_likelihood', 'bic']
+    with open(str(file), mode='w') as f:
+        f.write('\t'.join(['subject_id', 'model', 'alpha'] + columns) + '\n')
+        for subject_id, model, alpha, statistics in rows:
+            values = [f'{statistics[c]:d}' if c == 'n_trials' else f'{statistics[c]:.6g}' for c in columns]
+            f.write('\t'.join([subject_id, model, f'{alpha:.6g}'] + values) + '\n')
+
+
+def main(input_dir: str, use_store: bool = False, grid_size: int = 101,
+         prior: Union[Tuple[float, float], None] = None, use_csv: bool = False):
+    subject_ids, go_series, stop_series = read_series(input_dir, use_store, use_csv)
+
+    rows = []
+    for model, series in (('go', go_series), ('stop', stop_series)):
+        outcome, cue, mask = pad_series(series)
+        alpha = fit_learning_rate(outcome, cue, mask, grid_size=grid_size, prior=prior)
+        statistics = fit_statistics(alpha, outcome, cue, mask)
+        for i, subject_id in enumerate(subject_ids):
+            rows.append((subject_id, model, alpha[i], {k: v[i] for k, v in statistics.items()}))
+
+    write_fit_table(Path(input_dir) / 'rescorla_wagner_fit.tsv', rows)
+
+
+if __name__ == "__main__":
+    description = f'Fit Rescorla-Wagner learning rates for the SST task in {STUDY_ID} study, all subjects at once'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-i', '--input', metavar='Input directory', action='store',
+                        type=str, required=True,
+                        help='absolute path to directory containing events.tsv files from the SST task.',
+                        dest='input_dir'
+                        )
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='read events from the cohort event store written by multiconds.py, '
+                             'instead of the events.tsv files.',
+                        dest='use_store'
+                        )
+    parser.add_argument('-c', '--csv', action='store_true',
+                        help='read events straight from the behavioral .csv files of the SST task, '
+                             'instead of the events.tsv files.',
+                        dest='use_csv'
+                        )
+    parser.add_argument('-g', '--grid', metavar='Grid size', action='store',
+                        type=int, required=False, default=101,
+                        help='number of learning rates in the grid search before refinement.',
+                        dest='grid_size'
+                        )
+    parser.add_argument('-p', '--prior', metavar=('a', 'b'), action='store',
+                        type=float, nargs=2, required=False, default=None,
+                        help='parameters of a Beta(a, b) prior on the learning rate. '
+                             'Without a prior, the learning rate is fit by maximum likelihood.',
+                        dest='prior'
+                        )
+    args = parser.parse_args()
+
+    main(args.input_dir, args.use_store, args.grid_size, args.prior, args.use_csv)
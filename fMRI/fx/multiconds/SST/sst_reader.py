@@ -0,0 +1,99 @@
+"""
+Columnar readers for SST behavioral .csv files and BIDS events.tsv files.
+
+Only the requested columns are parsed, in a single pass by numpy's C reader. String columns
+(image names and trial types) are classified with vectorized operations on the whole column,
+instead of calling a Python converter once per row.
+"""
+from os import PathLike
+from typing import Union, Tuple, Sequence
+
+import numpy as np
+
+# Image names that start with one of these prefixes indicate 'go' trials.
+# Image names that start with 'unhealthy', 'p2unhealthy', or 'flower' indicate 'no-go' trials.
+GO_IMAGE_PREFIXES = ('healthy', 'p3healthy', 'bird')
+
+# Trial types written to events.tsv files. The position in this tuple is the trial type code.
+TRIAL_TYPE_NAMES = ('correct-go', 'correct-stop', 'failed-stop', 'failed-go', 'null')
+CORRECT_GO, CORRECT_STOP, FAILED_STOP, FAILED_GO, NULL = range(len(TRIAL_TYPE_NAMES))
+UNKNOWN_TRIAL_TYPE = -1
+# Trial type written to events.tsv files for each trial type code. Trials of no condition
+# (UNKNOWN_TRIAL_TYPE, the last entry) are written as 'None', as earlier versions of multiconds.py wrote them.
+EVENTS_TSV_TRIAL_TYPES = TRIAL_TYPE_NAMES + ('None',)
+
+# Width of string columns. Only prefixes are inspected, so longer values may be truncated.
+STRING_WIDTH = 16
+
+
+def read_columns(file: Union[PathLike, str], usecols: Sequence[int], dtypes: Sequence,
+                 delimiter: str = ',', skiprows: int = 1) -> Tuple[np.ndarray, ...]:
+    """
+    Read only the columns :param usecols: of a delimited text file in a single pass.
+    :param dtypes: numpy dtype for each column in :param usecols:
+    :return: tuple of typed 1-d arrays, one per column
+    """
+    dtype = np.dtype([(f'column{i}', t) for i, t in zip(usecols, dtypes)])
+    data = np.loadtxt(str(file),
+                      delimiter=delimiter,
+                      skiprows=skiprows,
+                      usecols=usecols,
+                      dtype=dtype,
+                      ndmin=1)
+    return tuple(np.ascontiguousarray(data[name]) for name in dtype.names)
+
+
+def classify_prefix(values: np.ndarray, prefixes: Sequence[str]) -> np.ndarray:
+    """
+    :return: boolean array that is True where :param values: starts with any of :param prefixes:
+    """
+    result = np.zeros(values.shape, dtype=bool)
+    for prefix in prefixes:
+        # Casting to a string type of the prefix length truncates every value to its first
+        # len(prefix) characters, which is much faster than np.char.startswith
+        result |= values.astype(f'U{len(prefix)}') == prefix
+    return result
+
+
+def trial_type_codes(trial_type: np.ndarray) -> np.ndarray:
+    """
+    Translate trial type names into codes, the position of the name in TRIAL_TYPE_NAMES.
+    Unrecognized trial types are given the code UNKNOWN_TRIAL_TYPE.
+    """
+    codes = np.full(trial_type.shape, UNKNOWN_TRIAL_TYPE, dtype=np.int8)
+    for code, name in enumerate(TRIAL_TYPE_NAMES):
+        codes[trial_type == name] = code
+    return codes
+
+
+def read_sst_csv(file: Union[PathLike, str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read behavioral data out of .csv files. The data is interpreted as follows:
+
+    column 7 - trial number
+    column 9 - start time of trial (milliseconds)
+    column 10 - trial duration (milliseconds)
+    column 13 - reaction time (milliseconds)
+    column 23 - image name, classified into trial type. 0=NoGo, 1=Go
+
+    :return: trial_number, start_time, duration, reaction_time, is_go_trial
+    """
+    trial_number, start_time, duration, reaction_time, image_name = read_columns(
+        file,
+        usecols=(7, 9, 10, 13, 23),
+        dtypes=(np.float64, np.float64, np.float64, np.float64, f'U{STRING_WIDTH}'))
+
+    is_go_trial = classify_prefix(image_name, GO_IMAGE_PREFIXES).astype(np.float64)
+    return trial_number, start_time, duration, reaction_time, is_go_trial
+
+
+def read_events_tsv(file: Union[PathLike, str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read an events.tsv file with onset, duration and trial_type columns.
+    :return: onset, duration, trial type codes (see TRIAL_TYPE_NAMES)
+    """
+    onset, duration, trial_type = read_columns(file,
+                                               usecols=(0, 1, 2),
+                                               dtypes=(np.float64, np.float64, f'U{STRING_WIDTH}'),
+                                               delimiter='\t')
+    return onset, duration, trial_type_codes(trial_type)
@@ -0,0 +1,245 @@
+"""
+In-memory streaming API from the SST behavioral .csv files to the downstream models.
+
+stream_subjects() reads one subject at a time and yields a typed record of its events. The transforms consume
+those records lazily and yield what each model needs, in the same process:
+
+    rescorla_wagner_series()  (subject ID, go-trial series, go-after-stop series), as multiconds_rescorla_wagner.py
+    latent_class_rows()       (subject ID, failed go count, mean and SD of correct go duration), as
+                              multiconds_latent_class.py
+    long_format_rows()        one row per trial, for the multilevel model and plots
+
+Writing intermediate files is optional: the sinks (tee_events_tsv(), tee_rescorla_wagner_tsv(),
+write_latent_class_tsv(), write_long_format_tsv()) write the same files as the multiconds tools. The tee sinks
+pass their input through, so they can sit anywhere in a chain. For example, to fit Rescorla-Wagner learning
+rates straight from the .csv files:
+
+    records = stream_subjects(input_dir)
+    subject_ids, go_series, stop_series = zip(*rescorla_wagner_series(records))
+
+Events are kept at full precision, instead of the 5 decimals of events.tsv files.
+"""
+import argparse
+import re
+import sys
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from multiconds_latent_class import latent_class_features, write_latent_class_analysis_header, \
+    write_for_latent_class_analysis
+from multiconds_rescorla_wagner import rescorla_wagner_events, go_no_go_events, write_for_rescorla_wagner
+from sst_reader import read_sst_csv, EVENTS_TSV_TRIAL_TYPES, CORRECT_GO, CORRECT_STOP, FAILED_STOP, FAILED_GO, \
+    UNKNOWN_TRIAL_TYPE
+
+STUDY_ID = 'CC'
+WAVE = '1'
+CSV_PATTERN = f'{STUDY_ID}' + '(\\d{3})_stopsignal_fMRI_clean.csv'
+LONG_FORMAT_COLUMNS = ('subject_id', 'trial', 'onset', 'duration', 'reaction_time', 'trial_type')
+GO_TRIAL = 1
+NO_GO_TRIAL = 0
+
+
+class SubjectEvents(NamedTuple):
+    """
+    Events of one subject, one typed column per field. Trial types are int8 codes rather than strings, and the
+    trials of each condition are taken as views of one grouped copy of the onsets and durations (see split()).
+    """
+    subject_id: str  # without the study prefix, e.g. '001'
+    trial_number: np.ndarray
+    onset: np.ndarray  # seconds
+    duration: np.ndarray  # seconds
+    reaction_time: np.ndarray  # seconds, 0 for trials without a response
+    trial_type: np.ndarray  # int8 codes of sst_reader.TRIAL_TYPE_NAMES
+    is_go_trial: np.ndarray  # int8, GO_TRIAL or NO_GO_TRIAL
+
+    def split(self, key: np.ndarray, groups: Sequence[int]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :return: (onset, duration) of the trials of each of :param groups: of :param key:, in trial order.
+        The trials are grouped by one stable sort of :param key:, and every group is a view into the grouped copy.
+        """
+        order = np.argsort(key, kind='stable')
+        grouped_key = key[order]
+        onset, duration = self.onset[order], self.duration[order]
+        starts = np.searchsorted(grouped_key, groups, side='left')
+        stops = np.searchsorted(grouped_key, groups, side='right')
+        return [(onset[start:stop], duration[start:stop]) for start, stop in zip(starts, stops)]
+
+    def conditions(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """(onset, duration) of the correct go, correct stop, failed stop and failed go trials"""
+        return self.split(self.trial_type, (CORRECT_GO, CORRECT_STOP, FAILED_STOP, FAILED_GO))
+
+    def go_no_go(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """(onset, duration) of the go and the no-go trials"""
+        return self.split(self.is_go_trial, (GO_TRIAL, NO_GO_TRIAL))
+
+
+def trial_type_codes(is_go_trial: np.ndarray, reaction_time: np.ndarray) -> np.ndarray:
+    """
+    Trial type of each trial: go trials with a response are correct, no-go trials with a response failed.
+    Trials with a negative or missing reaction time are left UNKNOWN_TRIAL_TYPE.
+    """
+    is_go = is_go_trial == GO_TRIAL
+    is_no_go = is_go_trial == NO_GO_TRIAL
+    responded = reaction_time > 0.0
+    codes = np.full(is_go_trial.shape, UNKNOWN_TRIAL_TYPE, dtype=np.int8)
+    codes[is_go & responded] = CORRECT_GO
+    codes[is_no_go & (reaction_time == 0.0)] = CORRECT_STOP
+    codes[is_no_go & responded] = FAILED_STOP
+    codes[is_go & (reaction_time == 0.0)] = FAILED_GO
+    return codes
+
+
+def read_subject(file: Union[PathLike, str], subject_id: str) -> SubjectEvents:
+    """Events of one subject from its .csv file, with times in seconds"""
+    trial_number, start_time, duration, reaction_time, is_go_trial = read_sst_csv(file)
+    reaction_time = reaction_time / 1000.0
+    return SubjectEvents(subject_id, trial_number, start_time / 1000.0, duration / 1000.0, reaction_time,
+                         trial_type_codes(is_go_trial, reaction_time), is_go_trial.astype(np.int8))
+
+
+def subject_files(input_dir: Union[PathLike, str]) -> List[Tuple[str, Path]]:
+    """:return: (subject ID, .csv file) of every subject in :param input_dir:, in subject order"""
+    files = []
+    for f in sorted(Path(input_dir).glob(f'{STUDY_ID}*stopsignal_fMRI_clean.csv')):
+        match = re.search(CSV_PATTERN, f.name)
+        if match:
+            files.append((match.group(1), f))
+    return files
+
+
+def stream_subjects(input_dir: Union[PathLike, str], subjects: Optional[Iterable[str]] = None,
+                    skip_errors: bool = True) -> Iterator[SubjectEvents]:
+    """
+    Yield the events of each subject in :param input_dir:, or of :param subjects: only, reading one file at a time.
+    With :param skip_errors:, subjects whose file cannot be read are reported on stderr and left out.
+    """
+    selected = set(subjects) if subjects is not None else None
+    for subject_id, f in subject_files(input_dir):
+        if selected is not None and subject_id not in selected:
+            continue
+        try:
+            yield read_subject(f, subject_id)
+        except Exception as e:
+            if not skip_errors:
+                raise
+            print(f'{STUDY_ID}{subject_id}: {type(e).__name__}: {e}', file=sys.stderr)
+
+
+def rescorla_wagner_series(records: Iterable[SubjectEvents]) -> Iterator[Tuple[str, List[Tuple], List[Tuple]]]:
+    """Yield (subject ID with study prefix, go-trial series, go-after-stop series) of each subject"""
+    for record in records:
+        yield (f'{STUDY_ID}{record.subject_id}',
+               rescorla_wagner_events(record.duration, record.trial_type),
+               go_no_go_events(record.duration, record.trial_type))
+
+
+def latent_class_rows(records: Iterable[SubjectEvents]) -> Iterator[Tuple[str, int, float, float]]:
+    """Yield (subject ID with study prefix, failed go count, mean and SD of correct go duration) of each subject"""
+    for record in records:
+        yield (f'{STUDY_ID}{record.subject_id}', *latent_class_features(record.duration, record.trial_type))
+
+
+def long_format_rows(records: Iterable[SubjectEvents]) -> Iterator[Tuple]:
+    """Yield one (subject ID, trial, onset, duration, reaction time, trial type name) row per trial"""
+    names = EVENTS_TSV_TRIAL_TYPES
+    for record in records:
+        subject_id = f'{STUDY_ID}{record.subject_id}'
+        for trial, onset, duration, reaction_time, code in zip(record.trial_number, record.onset, record.duration,
+                                                               record.reaction_time, record.trial_type):
+            yield subject_id, int(trial), onset, duration, reaction_time, names[code]
+
+
+def events_tsv_name(subject_id: str) -> str:
+    return f'sub-{STUDY_ID}{subject_id}_ses-wave{WAVE}_task-SST_acq-1_events.tsv'
+
+
+def tee_events_tsv(records: Iterable[SubjectEvents], output_dir: Union[PathLike, str]) -> Iterator[SubjectEvents]:
+    """Write each subject's events.tsv file, as multiconds.py does, and pass its record on"""
+    for record in records:
+        names = np.asarray(EVENTS_TSV_TRIAL_TYPES)[record.trial_type]
+        with open(str(Path(output_dir) / events_tsv_name(record.subject_id)), 'w') as f:
+            f.write('onset\tduration\ttrial_type\n')
+            f.writelines(f'{onset:10.5f}\t{duration:10.5f}\t{name}\n'
+                         for onset, duration, name in zip(record.onset, record.duration, names))
+        yield record
+
+
+def tee_rescorla_wagner_tsv(series: Iterable[Tuple[str, List[Tuple], List[Tuple]]],
+                            output_dir: Union[PathLike, str]) -> Iterator[Tuple[str, List[Tuple], List[Tuple]]]:
+    """Write the _go and _stop files of each subject, as multiconds_rescorla_wagner.py does, and pass them on"""
+    for subject_id, go_events, stop_events in series:
+        f = Path(output_dir) / events_tsv_name(subject_id[len(STUDY_ID):])
+        write_for_rescorla_wagner(f, go_events)
+        write_for_rescorla_wagner(f, stop_events, is_go=False)
+        yield subject_id, go_events, stop_events
+
+
+def write_latent_class_tsv(rows: Iterable[Tuple[str, int, float, float]], file: Union[PathLike, str]):
+    """Write latent_class_analysis.tsv, as multiconds_latent_class.py does"""
+    with open(str(file), 'w') as f:
+        write_latent_class_analysis_header(f)
+        for subject_id, *features in rows:
+            write_for_latent_class_analysis(f, subject_id, features)
+
+
+def write_long_format_tsv(rows: Iterable[Tuple], file: Union[PathLike, str]):
+    with open(str(file), 'w') as f:
+        f.write('\t'.join(LONG_FORMAT_COLUMNS) + '\n')
+        f.writelines(f'{subject_id}\t{trial}\t{onset:.5f}\t{duration:.5f}\t{reaction_time:.5f}\t{name}\n'
+                     for subject_id, trial, onset, duration, reaction_time, name in rows)
+
+
+def main(input_dir: str, output_dir: str, events_tsv: bool, rescorla_wagner: bool, latent_class: bool,
+         long_format: bool):
+    """
+    Read the .csv files once and write only the requested files. The records of a cohort are small, so they are
+    kept in memory and each transform runs over them.
+    """
+    output_dir = Path(output_dir or input_dir)
+    records = stream_subjects(input_dir)
+    if events_tsv:
+        records = tee_events_tsv(records, output_dir)
+    records = list(records)
+    if rescorla_wagner:
+        for _ in tee_rescorla_wagner_tsv(rescorla_wagner_series(records), output_dir):
+            pass
+    if latent_class:
+        write_latent_class_tsv(latent_class_rows(records), output_dir / 'latent_class_analysis.tsv')
+    if long_format:
+        write_long_format_tsv(long_format_rows(records), output_dir / 'sst_long_format.tsv')
+    print(f'Streamed {len(records)} subjects from {input_dir}')
+
+
+if __name__ == "__main__":
+    description = f'Stream SST behavioral .csv files of the {STUDY_ID} study to the inputs of the downstream models'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', metavar='Input directory', action='store',
+                        type=str, required=True,
+                        help='absolute path to directory containing behavioral output from the SST task.',
+                        dest='input_dir')
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory for the files written. By default, the input directory.',
+                        dest='output_dir')
+    parser.add_argument('-e', '--events', action='store_true',
+                        help='write the events.tsv file of each subject.',
+                        dest='events_tsv')
+    parser.add_argument('-r', '--rescorla-wagner', action='store_true',
+                        help='write the _go and _stop files of each subject.',
+                        dest='rescorla_wagner')
+    parser.add_argument('-l', '--latent-class', action='store_true',
+                        help='write latent_class_analysis.tsv.',
+                        dest='latent_class')
+    parser.add_argument('-t', '--long', action='store_true',
+                        help='write sst_long_format.tsv, one row per trial.',
+                        dest='long_format')
+    args = parser.parse_args()
+
+    main(args.input_dir, args.output_dir, args.events_tsv, args.rescorla_wagner, args.latent_class,
+         args.long_format)
@@ -0,0 +1,126 @@
+"""
+Synthetic SST cohorts, for benchmarks and checks of the multiconds pipeline without real data.
+
+Each subject gets a CC###_stopsignal_fMRI_clean.csv file with the column layout of the SST task output:
+
+    column 7 - trial number
+    column 9 - start time of trial (milliseconds)
+    column 10 - trial duration (milliseconds)
+    column 13 - reaction time (milliseconds), 0 if there was no response
+    column 23 - image name, whose prefix gives the trial type (see sst_reader.GO_IMAGE_PREFIXES)
+
+and, optionally, the matching events.tsv file that multiconds.py writes for it.
+The other columns hold random digits.
+"""
+import argparse
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from sst_reader import TRIAL_TYPE_NAMES
+
+STUDY_ID = 'CC'
+NUM_COLUMNS = 26
+
+GO_IMAGE_NAMES = ['healthy01.jpg', 'p3healthy02.jpg', 'bird03.jpg']
+NO_GO_IMAGE_NAMES = ['unhealthy04.jpg', 'p2unhealthy05.jpg', 'flower06.jpg']
+IMAGE_NAMES = GO_IMAGE_NAMES + NO_GO_IMAGE_NAMES
+
+# Fraction of go trials, and the probability of a response on go and on no-go trials
+GO_FRACTION = 0.75
+GO_RESPONSE_RATE = 0.9
+NO_GO_RESPONSE_RATE = 0.3
+
+
+def csv_file_name(subject: int) -> str:
+    return f'{STUDY_ID}{subject:03d}_stopsignal_fMRI_clean.csv'
+
+
+def events_file_name(subject: int) -> str:
+    return f'sub-{STUDY_ID}{subject:03d}_ses-wave1_task-SST_acq-1_events.tsv'
+
+
+def write_subject(output_dir: Path, subject: int, num_trials: int, rng: np.random.Generator,
+                  events: bool = True) -> List[Path]:
+    """Write the .csv file of one subject, and its events.tsv file if :param events:. :return: files written"""
+    is_go = rng.random(num_trials) < GO_FRACTION
+    image_name = np.where(is_go, rng.choice(GO_IMAGE_NAMES, size=num_trials),
+                          rng.choice(NO_GO_IMAGE_NAMES, size=num_trials))
+    responded = rng.random(num_trials) < np.where(is_go, GO_RESPONSE_RATE, NO_GO_RESPONSE_RATE)
+    reaction_time = rng.integers(250, 1000, size=num_trials) * responded
+    duration = rng.integers(500, 1500, size=num_trials)
+    # Trials are separated by a jittered fixation
+    gaps = rng.integers(500, 4000, size=num_trials)
+    start_time = np.concatenate(([0], np.cumsum(duration + gaps)[:-1]))
+
+    columns = rng.integers(0, 10, size=(num_trials, NUM_COLUMNS)).astype('U16')
+    columns[:, 7] = np.arange(1, num_trials + 1).astype(str)
+    columns[:, 9] = start_time.astype(str)
+    columns[:, 10] = duration.astype(str)
+    columns[:, 13] = reaction_time.astype(str)
+    columns[:, 23] = image_name
+
+    csv_file = output_dir / csv_file_name(subject)
+    with open(str(csv_file), 'w') as f:
+        f.write(','.join(f'column{i}' for i in range(NUM_COLUMNS)) + '\n')
+        f.write('\n'.join(','.join(row) for row in columns) + '\n')
+    if not events:
+        return [csv_file]
+
+    # Trial types as sst_stream.trial_type_codes() assigns them
+    trial_type = np.select([is_go & responded, ~is_go & ~responded, ~is_go & responded, is_go & ~responded],
+                           TRIAL_TYPE_NAMES[:4], default=TRIAL_TYPE_NAMES[-1])
+    events_file = output_dir / events_file_name(subject)
+    with open(str(events_file), 'w') as f:
+        f.write('onset\tduration\ttrial_type\n')
+        f.writelines(f'{onset:10.5f}\t{d:10.5f}\t{t}\n'
+                     for onset, d, t in zip(start_time / 1000.0, duration / 1000.0, trial_type))
+    return [csv_file, events_file]
+
+
+def write_synthetic_cohort(output_dir: Path, num_subjects: int, num_trials: int, seed: int = 0,
+                           events: bool = True) -> List[Path]:
+    """
+    Write the .csv files of :param num_subjects: subjects, numbered from 1, with :param num_trials: trials each,
+    and their events.tsv files if :param events:. The same seed always gives the same cohort.
+    :return: files written
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for subject in range(1, num_subjects + 1):
+        files += write_subject(output_dir, subject, num_trials, rng, events)
+    return files
+
+
+if __name__ == "__main__":
+    description = f'Write a synthetic cohort of SST task output in the format of the {STUDY_ID} study'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=True,
+                        help='directory for the .csv files.',
+                        dest='output_dir')
+    parser.add_argument('-n', '--subjects', metavar='Number of subjects', action='store',
+                        type=int, required=False, default=100,
+                        help='number of synthetic subjects.',
+                        dest='num_subjects')
+    parser.add_argument('-t', '--trials', metavar='Number of trials', action='store',
+                        type=int, required=False, default=256,
+                        help='number of trials per subject.',
+                        dest='num_trials')
+    parser.add_argument('--seed', metavar='Seed', action='store',
+                        type=int, required=False, default=0,
+                        help='seed of the random number generator.',
+                        dest='seed')
+    parser.add_argument('-e', '--events', action='store_true',
+                        help='also write the events.tsv file of each subject.',
+                        dest='events')
+    args = parser.parse_args()
+
+    files = write_synthetic_cohort(Path(args.output_dir), args.num_subjects, args.num_trials, args.seed, args.events)
+    print(f'Wrote {len(files)} files to {args.output_dir}')
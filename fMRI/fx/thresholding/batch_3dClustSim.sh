@@ -3,6 +3,9 @@
 #--------------------------------------------------------------
 # This script runs 3dClustSim for each model using acf parameters 
 # generated by calculate_group_average.R
+# cluster_simulation.py simulates all models in one job instead, in parallel,
+# and reuses one simulation for models that share a mask, e.g.
+# python3 cluster_simulation.py -d ${MODELDIR} -m ${MODELS[@]} -a ACFparameters_group_average.txt -o ${OUTPUTDIR} -j 8
 #	
 # D.Cos 2018.11.06
 #--------------------------------------------------------------
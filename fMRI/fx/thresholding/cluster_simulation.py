@@ -0,0 +1,282 @@
+"""
+Monte Carlo cluster-extent thresholds for a model mask and ACF parameters, as 3dClustSim -acf computes them.
+
+Each iteration simulates a Gaussian noise field with the spatial autocorrelation
+    acf(r) = a exp(-r^2 / (2 b^2)) + (1 - a) exp(-r / c)
+of the group ACF parameters (ACFparameters_group_average.txt), by multiplying the FFT of white noise by the
+square root of the FFT of the ACF. Each field is thresholded at every voxelwise p, and the size of its largest
+cluster within the mask is recorded. Fields are simulated and labeled in batches, and batches are split across a
+process pool, each with its own seed from one SeedSequence, so results do not depend on the number of jobs.
+
+The largest cluster sizes are cached by mask contents, ACF parameters, iterations, seed and voxelwise p, so
+models that share a mask reuse one simulation.
+"""
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import List, Tuple
+
+import nibabel as nib
+import numpy as np
+from scipy import fft, ndimage
+from scipy.stats import norm
+
+P_VALUES = (0.05, 0.02, 0.01, 0.005, 0.002, 0.001, 0.0005, 0.0002, 0.0001)
+ALPHAS = (0.10, 0.05, 0.02, 0.01, 0.001)
+# Face, edge and corner neighbours, as 3dClustSim -NN 1, 2 and 3
+NEIGHBOURHOODS = (1, 2, 3)
+SIDES = ('1sided', '2sided')
+
+# The noise grid extends past the mask by the radius where the ACF falls below this value
+MIN_ACF = 1e-3
+
+
+def acf_model(r: np.ndarray, a: float, b: float, c: float) -> np.ndarray:
+    return a * np.exp(-r ** 2 / (2.0 * b ** 2)) + (1.0 - a) * np.exp(-r / c)
+
+
+def read_acf_parameters(file: str) -> Tuple[float, float, float]:
+    """:return: a, b and c from ACFparameters_group_average.txt"""
+    with open(file, 'r') as f:
+        a, b, c = [float(v) for v in f.read().split()[:3]]
+    return a, b, c
+
+
+def load_mask(file: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """:return: mask cropped to its bounding box, and voxel size"""
+    image = nib.load(str(file))
+    mask = np.asanyarray(image.dataobj).reshape(image.shape[:3]) > 0
+    voxels = np.nonzero(mask)
+    box = tuple(slice(v.min(), v.max() + 1) for v in voxels)
+    return mask[box], np.asarray(image.header.get_zooms()[:3], dtype=np.float64)
+
+
+def noise_filter(shape: Tuple[int, ...], voxel_size: np.ndarray, acf: Tuple[float, float, float]) -> np.ndarray:
+    """
+    Square root of the power spectrum of noise with the ACF :param acf:, on a periodic grid of :param shape:.
+    Since the ACF is 1 at r = 0, filtered unit white noise has unit variance.
+    """
+    axes = [np.fft.fftfreq(n, 1.0 / n) * size for n, size in zip(shape, voxel_size)]
+    x, y, z = np.meshgrid(*axes, indexing='ij', sparse=True)
+    power = fft.rfftn(acf_model(np.sqrt(x ** 2 + y ** 2 + z ** 2), *acf))
+    return np.sqrt(np.maximum(power.real, 0.0))
+
+
+def acf_radius(acf: Tuple[float, float, float]) -> float:
+    """Radius (mm) beyond which both terms of acf_model(), and so the ACF, are below MIN_ACF / 2 and MIN_ACF"""
+    a, b, c = acf
+    radii = [0.0]
+    if a > MIN_ACF / 2.0:
+        radii.append(b * np.sqrt(2.0 * np.log(2.0 * a / MIN_ACF)))
+    if 1.0 - a > MIN_ACF / 2.0:
+        radii.append(c * np.log(2.0 * (1.0 - a) / MIN_ACF))
+    return max(radii)
+
+
+def grid_shape(mask_shape: Tuple[int, ...], voxel_size: np.ndarray, acf: Tuple[float, float, float]) -> Tuple[int, ...]:
+    """
+    Mask bounding box padded by the ACF radius, so the periodic noise does not wrap into the mask.
+    A radius beyond the extent of the mask is an error, rather than a noise grid many times the size of the mask.
+    """
+    radius = acf_radius(acf)
+    extent = float(np.max(np.asarray(mask_shape) * voxel_size))
+    if radius > extent:
+        raise ValueError(f'ACF parameters a={acf[0]:g} b={acf[1]:g} c={acf[2]:g} stay above {MIN_ACF:g} up to '
+                         f'{radius:.0f} mm, beyond the {extent:.0f} mm extent of the mask')
+    return tuple(fft.next_fast_len(n + int(np.ceil(radius / size))) for n, size in zip(mask_shape, voxel_size))
+
+
+def neighbourhood(nn: int) -> np.ndarray:
+    """Connectivity within each field of a batch: no connections across the first (batch) axis"""
+    structure = np.zeros((3, 3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(3, nn)
+    return structure
+
+
+def max_cluster_sizes(above: np.ndarray, nn: int) -> np.ndarray:
+    """
+    :param above: batch x mask voxels above threshold
+    :return: size of the largest cluster of each field of the batch
+    """
+    labels, num_labels = ndimage.label(above, structure=neighbourhood(nn))
+    sizes = np.bincount(labels.reshape(-1), minlength=num_labels + 1)
+    sizes[0] = 0
+    # Labels increase in scan order, so the labels of each field are a contiguous range
+    last_label = labels.reshape(len(labels), -1).max(axis=1)
+    first_label = np.concatenate(([1], np.maximum.accumulate(last_label)[:-1] + 1))
+    maxima = np.zeros(len(labels), dtype=np.int64)
+    has_clusters = last_label >= first_label
+    if np.any(has_clusters):
+        starts = first_label[has_clusters]
+        # Fields without clusters have empty ranges, so each range runs up to the next field with clusters
+        maxima[has_clusters] = np.maximum.reduceat(sizes, starts)
+    return maxima
+
+
+def simulate_batch(mask: np.ndarray, voxel_size: np.ndarray, acf: Tuple[float, float, float],
+                   p_values: Tuple[float, ...], num_fields: int, seed: np.random.SeedSequence) -> np.ndarray:
+    """
+    :return: largest cluster sizes, fields x SIDES x NEIGHBOURHOODS x p values
+    """
+    rng = np.random.default_rng(seed)
+    shape = grid_shape(mask.shape, voxel_size, acf)
+    kernel = noise_filter(shape, voxel_size, acf)
+    white = rng.standard_normal((num_fields,) + shape)
+    fields = fft.irfftn(fft.rfftn(white, axes=(1, 2, 3)) * kernel, s=shape, axes=(1, 2, 3))
+    box = (slice(None),) + tuple(slice(0, n) for n in mask.shape)
+    fields = fields[box]
+
+    maxima = np.zeros((num_fields, len(SIDES), len(NEIGHBOURHOODS), len(p_values)), dtype=np.int64)
+    for k, p in enumerate(p_values):
+        for s, above in enumerate(((fields > norm.isf(p)) & mask,
+                                   (np.abs(fields) > norm.isf(p / 2.0)) & mask)):
+            for n, nn in enumerate(NEIGHBOURHOODS):
+                maxima[:, s, n, k] = max_cluster_sizes(above, nn)
+    return maxima
+
+
+def simulate(mask: np.ndarray, voxel_size: np.ndarray, acf: Tuple[float, float, float],
+             p_values: Tuple[float, ...], iterations: int, seed: int = 0, batch_size: int = 25,
+             jobs: int = 1) -> np.ndarray:
+    """:return: largest cluster sizes of :param iterations: fields, iterations x SIDES x NEIGHBOURHOODS x p values"""
+    batch_sizes = [min(batch_size, iterations - start) for start in range(0, iterations, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    arguments = (repeat(mask), repeat(voxel_size), repeat(acf), repeat(p_values), batch_sizes, seeds)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            batches = list(executor.map(simulate_batch, *arguments))
+    else:
+        batches = list(map(simulate_batch, *arguments))
+    return np.concatenate(batches)
+
+
+def cluster_thresholds(maxima: np.ndarray, alphas: Tuple[float, ...]) -> np.ndarray:
+    """
+    Smallest cluster size k such that the fraction of fields with a cluster of k or more voxels is at most alpha.
+    :return: ... x alphas, for the ... dimensions of :param maxima: after the first (iterations)
+    """
+    iterations = len(maxima)
+    ordered = np.sort(maxima, axis=0)
+    # At most floor(alpha * iterations) fields may have a cluster of the threshold size or more
+    ranks = [iterations - int(np.floor(alpha * iterations)) - 1 for alpha in alphas]
+    return np.stack([ordered[max(rank, 0)] + 1 for rank in ranks], axis=-1)
+
+
+def cache_key(mask: np.ndarray, voxel_size: np.ndarray, acf: Tuple[float, float, float],
+              p_values: Tuple[float, ...], iterations: int, seed: int, batch_size: int) -> str:
+    h = hashlib.sha256()
+    h.update(np.asarray(mask.shape, dtype='<i8').tobytes())
+    h.update(np.asarray(grid_shape(mask.shape, voxel_size, acf), dtype='<i8').tobytes())
+    h.update(np.packbits(mask).tobytes())
+    h.update(np.asarray(voxel_size, dtype='<f8').tobytes())
+    h.update(repr((tuple(round(v, 6) for v in acf), tuple(p_values), iterations, seed, batch_size)).encode('ascii'))
+    return h.hexdigest()
+
+
+def cached_simulation(cache_dir: Path, mask: np.ndarray, voxel_size: np.ndarray, acf: Tuple[float, float, float],
+                      p_values: Tuple[float, ...], iterations: int, seed: int, batch_size: int,
+                      jobs: int) -> np.ndarray:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    file = cache_dir / f'{cache_key(mask, voxel_size, acf, p_values, iterations, seed, batch_size)}.npy'
+    try:
+        return np.load(str(file))
+    except (FileNotFoundError, ValueError, EOFError):
+        pass
+    maxima = simulate(mask, voxel_size, acf, p_values, iterations, seed, batch_size, jobs)
+    tmp_file = file.with_name(f'{file.stem}.{os.getpid()}.tmp')
+    with open(str(tmp_file), 'wb') as f:
+        np.save(f, maxima)
+    os.replace(str(tmp_file), str(file))
+    return maxima
+
+
+def write_thresholds(file: Path, thresholds: np.ndarray, p_values: Tuple[float, ...], alphas: Tuple[float, ...],
+                     acf: Tuple[float, float, float], iterations: int, mask_file: Path):
+    """Write one table of cluster size thresholds (voxels) per sidedness and neighbourhood, like 3dClustSim"""
+    lines = [f'# mask {mask_file}',
+             f'# acf {acf[0]:.6g} {acf[1]:.6g} {acf[2]:.6g}',
+             f'# iterations {iterations}']
+    for s, side in enumerate(SIDES):
+        for n, nn in enumerate(NEIGHBOURHOODS):
+            lines += ['#',
+                      f'# NN{nn} {side}',
+                      '# pthr    ' + ' '.join(f'{f"alpha={alpha:g}":>11}' for alpha in alphas)]
+            for k, p in enumerate(p_values):
+                lines.append(f'{p:<9g} ' + ' '.join(f'{t:11d}' for t in thresholds[s, n, k]))
+    with open(str(file), mode='w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def main(model_dir: str, models: List[str], acf_file: str, output_dir: str, iterations: int = 10000,
+         seed: int = 0, jobs: int = 1, cache_dir: str = None, p_values: Tuple[float, ...] = P_VALUES,
+         alphas: Tuple[float, ...] = ALPHAS, batch_size: int = 25):
+    acf = read_acf_parameters(acf_file)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = Path(cache_dir) if cache_dir else output_dir / 'cluster_simulation_cache'
+
+    for model in models:
+        mask_file = Path(model_dir) / model / 'mask.nii'
+        mask, voxel_size = load_mask(mask_file)
+        print(f'simulating {model}')
+        maxima = cached_simulation(cache_dir, mask, voxel_size, acf, tuple(p_values), iterations, seed, batch_size,
+                                   jobs)
+        write_thresholds(output_dir / f'ClustSim_{model}.txt', cluster_thresholds(maxima, alphas),
+                         p_values, alphas, acf, iterations, mask_file)
+
+
+if __name__ == "__main__":
+    description = 'Simulate cluster-extent thresholds of models from their masks and the group ACF parameters'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--model-dir', metavar='Model directory', action='store',
+                        type=str, required=True,
+                        help='directory of the models, each containing mask.nii.',
+                        dest='model_dir')
+    parser.add_argument('-m', '--models', metavar='Model', action='store', nargs='+',
+                        type=str, required=True,
+                        help='models to simulate.',
+                        dest='models')
+    parser.add_argument('-a', '--acf', metavar='ACF parameters', action='store',
+                        type=str, required=False, default='ACFparameters_group_average.txt',
+                        help='file with the a b c ACF parameters, written by residual_acf.py group or '
+                             'calculate_group_average.R.',
+                        dest='acf_file')
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=True,
+                        help='directory for the ClustSim_<model>.txt tables.',
+                        dest='output_dir')
+    parser.add_argument('-n', '--iterations', metavar='Iterations', action='store',
+                        type=int, required=False, default=10000,
+                        help='number of simulated noise fields.',
+                        dest='iterations')
+    parser.add_argument('--seed', metavar='Seed', action='store',
+                        type=int, required=False, default=0,
+                        help='seed of the simulation.',
+                        dest='seed')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of batches of noise fields to simulate in parallel.',
+                        dest='jobs')
+    parser.add_argument('-c', '--cache-dir', metavar='Cache directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory of cached simulations. By default, cluster_simulation_cache in the output '
+                             'directory.',
+                        dest='cache_dir')
+    parser.add_argument('-p', '--pthr', metavar='p', action='store', nargs='+',
+                        type=float, required=False, default=list(P_VALUES),
+                        help='voxelwise p thresholds.',
+                        dest='p_values')
+    parser.add_argument('--athr', metavar='alpha', action='store', nargs='+',
+                        type=float, required=False, default=list(ALPHAS),
+                        help='cluster-level alpha thresholds.',
+                        dest='alphas')
+    args = parser.parse_args()
+
+    main(args.model_dir, args.models, args.acf_file, args.output_dir, args.iterations, args.seed, args.jobs,
+         args.cache_dir, tuple(args.p_values), tuple(args.alphas))
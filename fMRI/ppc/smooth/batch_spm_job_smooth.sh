@@ -1,6 +1,8 @@
 #!/bin/bash
 #--------------------------------------------------------------
 # This script executes $SHELL_SCRIPT for $SUB and matlab $SCRIPT
+# smooth.py applies the same kernel to all subjects and tasks in one job, without MATLAB, e.g.
+# python3 smooth.py -i /projects/sanlab/shared/DEV/bids_data/derivatives/fmriprep -s test_subject_list.txt -t ROC WTP SST -j 8
 #	
 # D.Cos 2018.11.06
 #--------------------------------------------------------------
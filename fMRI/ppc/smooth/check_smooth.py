@@ -0,0 +1,114 @@
+import argparse
+import gzip
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy.integrate import quad
+from scipy.ndimage import convolve
+from scipy.stats import norm
+
+from smooth import smooth, smoothing_kernels
+
+
+def reference_kernel(fwhm_mm: float, voxel_size: float) -> np.ndarray:
+    """
+    The kernel of spm_smooth along one axis, from its definition rather than the closed form of spm_smoothkern:
+    a Gaussian of the FWHM in voxels convolved with the triangle of linear interpolation, integrated numerically
+    at x = -round(6 sigma) .. round(6 sigma), and normalized to sum to 1
+    """
+    sigma = fwhm_mm / voxel_size / np.sqrt(8.0 * np.log(2.0))
+    half_width = int(np.round(6.0 * sigma))
+    kernel = np.array([quad(lambda u: norm.pdf(x - u, scale=sigma) * (1.0 - abs(u)), -1.0, 1.0,
+                            points=[0.0], epsabs=1e-13)[0]
+                       for x in range(-half_width, half_width + 1)])
+    return kernel / kernel.sum()
+
+
+def reference_smooth(data: np.ndarray, fwhm, voxel_size) -> np.ndarray:
+    """
+    Direct (non-separable) convolution of each volume with the full 3-d kernel, the outer product of the
+    reference kernels of each axis, with zeros outside the volume
+    """
+    kx, ky, kz = (reference_kernel(f, size) for f, size in zip(fwhm, voxel_size))
+    kernel = kx[:, np.newaxis, np.newaxis] * ky[np.newaxis, :, np.newaxis] * kz[np.newaxis, np.newaxis, :]
+    return np.stack([convolve(data[..., t].astype(np.float64), kernel, mode='constant', cval=0.0)
+                     for t in range(data.shape[3])], axis=3)
+
+
+def synthetic_run(file: Path, shape, voxel_size, seed: int = 0) -> np.ndarray:
+    """Write a gzipped float32 4-d image of random blobs, like fMRIPrep output. :return: its data"""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100.0, 10.0, size=shape).astype(np.float32)
+    data[:2] = 0.0
+    affine = np.diag(list(voxel_size) + [1.0])
+    image = nib.Nifti1Image(data, affine)
+    image.header.set_zooms(tuple(voxel_size) + (2.0,))
+    with gzip.open(str(file), 'wb') as f:
+        f.write(image.to_bytes())
+    return data
+
+
+def main(fwhm: float, num_volumes: int, jobs: int, memory: int):
+    shape = (40, 48, 36, num_volumes)
+    voxel_size = (2.5, 2.5, 3.0)
+    fwhm = (fwhm,) * 3
+
+    # Kernels match SPM, also for a FWHM smaller than a voxel, where the triangle dominates
+    for kernel_fwhm in (fwhm, (1.5, 4.0, 9.0)):
+        for kernel, f, size in zip(smoothing_kernels(kernel_fwhm, voxel_size), kernel_fwhm, voxel_size):
+            reference = reference_kernel(f, size)
+            assert kernel.shape == reference.shape and np.allclose(kernel, reference, rtol=1e-8, atol=1e-12), f
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file = Path(tmp_dir) / 'sub-01_task-SST_bold_space-MNI152NLin2009cAsym_preproc.nii.gz'
+        data = synthetic_run(file, shape, voxel_size)
+
+        start = time.perf_counter()
+        smooth([file], fwhm, 's6_', jobs, memory << 20)
+        elapsed = time.perf_counter() - start
+
+        output = nib.load(str(file.with_name('s6_' + file.name[:-len('.gz')])))
+        assert output.shape == shape and output.get_data_dtype() == np.float32
+        assert np.allclose(output.affine, nib.load(str(file)).affine)
+        smoothed = np.asanyarray(output.dataobj)
+
+        start = time.perf_counter()
+        reference = reference_smooth(data, fwhm, voxel_size)
+        reference_elapsed = time.perf_counter() - start
+
+    difference = np.max(np.abs(smoothed - reference))
+    print(f'Largest difference from direct 3-d convolution: {difference:.3g}')
+    if difference > 1e-4 * np.max(np.abs(reference)):
+        raise AssertionError('smoothed volumes differ from the reference')
+    print(f'smooth.py:           {elapsed:8.3f} s ({num_volumes} volumes, {jobs} jobs, {memory} MB chunks)')
+    print(f'direct convolution:  {reference_elapsed:8.3f} s')
+
+
+if __name__ == "__main__":
+    description = 'Check smooth.py against direct 3-d convolution with the SPM kernel'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-f', '--fwhm', metavar='FWHM (mm)', action='store',
+                        type=float, required=False, default=6.0,
+                        help='FWHM of the kernel in mm.',
+                        dest='fwhm')
+    parser.add_argument('-n', '--volumes', metavar='Number of volumes', action='store',
+                        type=int, required=False, default=20,
+                        help='number of volumes of the synthetic run.',
+                        dest='num_volumes')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=2,
+                        help='number of chunks to smooth in parallel.',
+                        dest='jobs')
+    parser.add_argument('-m', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=4,
+                        help='memory budget of each job, small to split the run into several chunks.',
+                        dest='memory')
+    args = parser.parse_args()
+
+    main(args.fwhm, args.num_volumes, args.jobs, args.memory)
@@ -0,0 +1,211 @@
+"""
+Spatial smoothing of preprocessed BOLD images, as smooth.m does with SPM.
+
+For each run, the gzipped fMRIPrep output is decompressed once, memory-mapped, and smoothed in chunks of volumes
+that fit a memory budget. Chunks of all runs are spread over a process pool, and each worker writes its volumes
+directly into the output file. The kernel is the one spm_smooth uses: for each axis, a Gaussian with the FWHM
+in voxels (FWHM in mm over the voxel size in the header) convolved with a triangle (spm_smoothkern), truncated
+at 6 standard deviations and normalized to sum to 1, applied separably with zeros outside the volume.
+
+Outputs are written next to each input as <prefix><name>.nii, like the s6_ prefixed files from smooth.m.
+Float inputs keep their data type, as SPM does with dtype 0. Integer inputs are written as float32, instead of
+being rescaled to their integer type.
+"""
+import argparse
+import gzip
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import convolve1d
+from scipy.special import erf
+
+FILE_PATTERN = '*MNI152NLin2009cAsym_preproc.nii.gz'
+
+
+class Run(NamedTuple):
+    input_file: Path  # uncompressed input, memory-mapped by the workers
+    output_file: Path
+    shape: Tuple[int, int, int, int]
+    output_dtype: np.dtype
+    data_offset: int
+    voxel_size: Tuple[float, float, float]
+    temporary: bool  # whether input_file was decompressed for this run, and should be removed
+
+
+def spm_smoothkern(fwhm: float, x: np.ndarray) -> np.ndarray:
+    """
+    Gaussian kernel with :param fwhm: (voxels) convolved with a triangle, evaluated at :param x:,
+    as spm_smoothkern(fwhm, x, 1)
+    """
+    s = (fwhm / np.sqrt(8.0 * np.log(2.0))) ** 2 + np.finfo(float).eps
+    w1 = 1.0 / np.sqrt(2.0 * s)
+    w2 = -0.5 / s
+    w3 = np.sqrt(s / 2.0 / np.pi)
+    kernel = (0.5 * (erf(w1 * (x + 1)) * (x + 1) + erf(w1 * (x - 1)) * (x - 1) - 2.0 * erf(w1 * x) * x) +
+              w3 * (np.exp(w2 * (x + 1) ** 2) + np.exp(w2 * (x - 1) ** 2) - 2.0 * np.exp(w2 * x ** 2)))
+    return np.maximum(kernel, 0.0)
+
+
+def smoothing_kernels(fwhm: Tuple[float, float, float],
+                      voxel_size: Tuple[float, float, float]) -> List[np.ndarray]:
+    """One normalized 1-d kernel per axis, as spm_smooth builds them"""
+    kernels = []
+    for fwhm_mm, size in zip(fwhm, voxel_size):
+        fwhm_voxels = fwhm_mm / size
+        half_width = int(np.round(6.0 * fwhm_voxels / np.sqrt(8.0 * np.log(2.0))))
+        kernel = spm_smoothkern(fwhm_voxels, np.arange(-half_width, half_width + 1, dtype=np.float64))
+        kernels.append(kernel / kernel.sum())
+    return kernels
+
+
+def smooth_volumes(data: np.ndarray, kernels: List[np.ndarray]) -> np.ndarray:
+    """Separable convolution of the first three axes of :param data:, with zeros outside the volume"""
+    smoothed = np.asarray(data, dtype=np.float64)
+    for axis, kernel in enumerate(kernels):
+        smoothed = convolve1d(smoothed, kernel, axis=axis, mode='constant', cval=0.0)
+    return smoothed
+
+
+def decompress(file: Path, tmp_dir: Path) -> Path:
+    """Decompress a .nii.gz file to tmp_dir, so it can be memory-mapped"""
+    output = tmp_dir / f'{file.name[:-len(".gz")]}.{os.getpid()}.tmp.nii'
+    with gzip.open(str(file), 'rb') as source, open(str(output), 'wb') as destination:
+        shutil.copyfileobj(source, destination, 1 << 24)
+    return output
+
+
+def output_name(file: Path, prefix: str) -> Path:
+    name = file.name[:-len('.gz')] if file.name.endswith('.gz') else file.name
+    return file.with_name(prefix + name)
+
+
+def prepare_run(file: Path, prefix: str, tmp_dir: Union[Path, None]) -> Run:
+    """
+    Decompress the input if needed, and create the output file: the header of the input with the output
+    data type, and space for the data, which workers fill in chunk by chunk.
+    """
+    temporary = file.name.endswith('.gz')
+    input_file = decompress(file, tmp_dir or file.parent) if temporary else file
+    image = nib.load(str(input_file))
+    shape = tuple(image.shape[:3]) + ((image.shape[3],) if len(image.shape) > 3 else (1,))
+    input_dtype = image.get_data_dtype()
+    output_dtype = input_dtype if np.issubdtype(input_dtype, np.floating) else np.dtype(np.float32)
+
+    header = image.header.copy()
+    header.set_data_dtype(output_dtype)
+    header.set_slope_inter(1.0, 0.0)
+    # In the byte order of the header
+    output_dtype = header.get_data_dtype()
+    header['vox_offset'] = 0
+    output_file = output_name(file, prefix)
+    with open(str(output_file), 'wb') as f:
+        header.write_to(f)
+        data_offset = header.get_data_offset()
+        f.truncate(data_offset + int(np.prod(shape)) * output_dtype.itemsize)
+    voxel_size = tuple(float(v) for v in image.header.get_zooms()[:3])
+    return Run(input_file, output_file, shape, output_dtype, data_offset, voxel_size, temporary)
+
+
+def smooth_chunk(run: Run, start: int, stop: int, fwhm: Tuple[float, float, float]):
+    """Smooth volumes start..stop - 1 of :param run: and write them into its output file"""
+    image = nib.load(str(run.input_file), mmap=True)
+    data = np.asanyarray(image.dataobj[..., start:stop]) if len(image.shape) > 3 else \
+        np.asanyarray(image.dataobj)[..., np.newaxis]
+    smoothed = smooth_volumes(data, smoothing_kernels(fwhm, run.voxel_size))
+    output = np.memmap(str(run.output_file), dtype=run.output_dtype, mode='r+', offset=run.data_offset,
+                       shape=run.shape, order='F')
+    output[..., start:stop] = smoothed
+    output.flush()
+    del output
+
+
+def chunks(run: Run, memory_budget: int) -> List[Tuple[int, int]]:
+    """
+    Volume ranges of :param run: whose working memory fits :param memory_budget: bytes:
+    the input and two float64 copies of each volume
+    """
+    volume_bytes = int(np.prod(run.shape[:3])) * (run.output_dtype.itemsize + 2 * 8)
+    volumes = max(1, memory_budget // volume_bytes)
+    return [(start, min(start + volumes, run.shape[3])) for start in range(0, run.shape[3], volumes)]
+
+
+def find_runs(fmriprep_dir: str, subjects: List[str], tasks: List[str]) -> List[Path]:
+    """Preprocessed BOLD files of each subject, of the given tasks if any"""
+    files = []
+    for subject in subjects:
+        subject_files = sorted((Path(fmriprep_dir) / f'sub-{subject}').rglob(FILE_PATTERN))
+        files += [f for f in subject_files if not tasks or any(f'task-{task}' in f.name for task in tasks)]
+    return files
+
+
+def smooth(files: List[Path], fwhm: Tuple[float, float, float], prefix: str, jobs: int = 1,
+           memory_budget: int = 1 << 30, tmp_dir: Path = None):
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        runs = list(executor.map(prepare_run, files, [prefix] * len(files), [tmp_dir] * len(files)))
+        try:
+            tasks = [(run, start, stop) for run in runs for start, stop in chunks(run, memory_budget)]
+            futures = [executor.submit(smooth_chunk, run, start, stop, fwhm) for run, start, stop in tasks]
+            for future in futures:
+                future.result()
+        finally:
+            for run in runs:
+                if run.temporary:
+                    run.input_file.unlink()
+    for run in runs:
+        print(f'Smoothed {run.output_file}')
+
+
+def read_subject_list(file: str) -> List[str]:
+    with open(file, 'r') as f:
+        return f.read().split()
+
+
+if __name__ == "__main__":
+    description = 'Smooth preprocessed BOLD images with a Gaussian kernel, as SPM smooth does'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', metavar='fMRIPrep directory', action='store',
+                        type=str, required=True,
+                        help='fmriprep derivatives directory, containing sub-<subject> directories.',
+                        dest='fmriprep_dir')
+    parser.add_argument('-s', '--subjects', metavar='Subject list', action='store',
+                        type=str, required=True,
+                        help='file listing subject IDs (without sub-), separated by whitespace.',
+                        dest='subject_list')
+    parser.add_argument('-t', '--tasks', metavar='Task', action='store', nargs='*',
+                        type=str, required=False, default=['ROC', 'WTP', 'SST'],
+                        help='tasks to smooth. With no tasks, every preprocessed run is smoothed.',
+                        dest='tasks')
+    parser.add_argument('-f', '--fwhm', metavar='FWHM (mm)', action='store', nargs='+',
+                        type=float, required=False, default=[6.0],
+                        help='FWHM of the kernel in mm, one value or one per axis.',
+                        dest='fwhm')
+    parser.add_argument('-p', '--prefix', metavar='Prefix', action='store',
+                        type=str, required=False, default=None,
+                        help='prefix of the smoothed files. By default, s<FWHM>_, e.g. s6_.',
+                        dest='prefix')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of chunks to smooth in parallel.',
+                        dest='jobs')
+    parser.add_argument('-m', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1024,
+                        help='memory budget of each job for a chunk of volumes.',
+                        dest='memory')
+    parser.add_argument('--tmp-dir', metavar='Temporary directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory for decompressed inputs. By default, next to each input.',
+                        dest='tmp_dir')
+    args = parser.parse_args()
+
+    fwhm = tuple(args.fwhm * 3) if len(args.fwhm) == 1 else tuple(args.fwhm)
+    prefix = args.prefix if args.prefix is not None else f's{args.fwhm[0]:g}_'
+    files = find_runs(args.fmriprep_dir, read_subject_list(args.subject_list), args.tasks)
+    smooth(files, fwhm, prefix, args.jobs, args.memory << 20, Path(args.tmp_dir) if args.tmp_dir else None)
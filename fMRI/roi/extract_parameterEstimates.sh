@@ -3,6 +3,8 @@
 # This script extracts mean parameter estimates and SDs within an ROI or parcel
 # from subject images (e.g. FX condition contrasts). Output is 
 # saved as a text file in the output directory.
+# extract_parameter_estimates.py does the same for a whole subject list in one job,
+# resamples each roi once per image grid (see roi_cache.py), and writes a single table.
 
 module load afni
 
@@ -24,16 +26,22 @@ image_dir=/projects/sanlab/shared/study/nonbids_data/fMRI/fx/models/task/wave/mo
 roi_dir=/projects/sanlab/shared/study/nonbids_data/fMRI/rx/models/task/wave/modelname #roi directory (alt. example: roi_dir=/projects/sanlab/shared/study/bids_data/derivatives/freesurfer/sub-"${SUB}"/mri/fromannots)
 output_dir=/projects/sanlab/shared/study/study_scripts/fMRI/roi/parameterEstimates #parameter estimate output directory
 
+aligned_dir="${output_dir}"/aligned_rois/sub-"${SUB}" #aligned rois of this subject, so concurrent jobs do not overwrite each other's
+
 if [ ! -d ${output_dir} ]; then
 	mkdir -p ${output_dir}
 fi
 
+if [ ! -d ${aligned_dir} ]; then
+	mkdir -p ${aligned_dir}
+fi
+
 # Align images and extract mean parameter estimates and SDs for each contrast and roi/parcel
 # ------------------------------------------------------------------------------------------
 for roi in ${rois[@]}; do 
-	3dAllineate -source "${roi_dir}"/"${roi}".nii -master "${image_dir}"/mask.nii -final NN -1Dparam_apply '1D: 12@0'\' -prefix "${roi_dir}"/aligned_"${roi}"
+	3dAllineate -source "${roi_dir}"/"${roi}".nii -master "${image_dir}"/mask.nii -final NN -1Dparam_apply '1D: 12@0'\' -overwrite -prefix "${aligned_dir}"/aligned_"${roi}"
 	for image in ${images[@]}; do 
-	echo "${SUB}" "${image}" "${roi}" `3dmaskave -sigma -quiet -mask "${roi_dir}"/aligned_"${roi}"+tlrc "${image_dir}"/"${image}"` >> "${output_dir}"/"${SUB}"_parameterEstimates.txt
+	echo "${SUB}" "${image}" "${roi}" `3dmaskave -sigma -quiet -mask "${aligned_dir}"/aligned_"${roi}"+tlrc "${image_dir}"/"${image}"` >> "${output_dir}"/"${SUB}"_parameterEstimates.txt
 	done
 done
 
@@ -0,0 +1,196 @@
+"""
+Extract mean parameter estimates and SDs within ROIs or parcels from subject images (e.g. FX condition contrasts).
+
+This does what extract_parameterEstimates.sh does with 3dAllineate and 3dmaskave, for a whole subject list:
+each ROI is resampled to the grid of the subject's mask.nii by nearest neighbour with an identity transform
+(once per grid, through roi_cache.py),
+each image is memory-mapped once, and the mean and SD of every ROI are computed together with
+label-indexed reductions over the ROI voxels. The output is one table with a row per subject, image and ROI.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import nibabel as nib
+import numpy as np
+
+from roi_cache import RoiCache
+
+
+class RoiVoxels(NamedTuple):
+    """Voxels of all ROIs on one image grid. ROIs may overlap, so a voxel can appear once per ROI."""
+    voxels: np.ndarray  # flat indices of ROI voxels on the image grid, in NIfTI (Fortran) order
+    labels: np.ndarray  # ROI index of each voxel
+    num_rois: int
+
+
+def load_data(file: Path) -> np.ndarray:
+    """
+    Image data, memory-mapped if the file is uncompressed and unscaled, so only the pages that
+    hold ROI voxels are read.
+    """
+    image = nib.load(str(file), mmap=True)
+    return np.asanyarray(image.dataobj)
+
+
+@lru_cache(maxsize=None)
+def get_roi_cache(cache_dir: str, max_bytes: int) -> RoiCache:
+    """One cache per worker process, so ROIs loaded for one subject are reused for the next"""
+    return RoiCache(Path(cache_dir), max_bytes)
+
+
+def roi_voxels(roi_files: List[Path], shape: Tuple[int, ...], affine: np.ndarray, cache: RoiCache) -> RoiVoxels:
+    masks = [cache.voxels(f, shape, affine) for f in roi_files]
+    voxels = np.concatenate(masks) if masks else np.empty(0, dtype=np.int64)
+    labels = np.repeat(np.arange(len(masks)), [len(m) for m in masks])
+    return RoiVoxels(voxels, labels, len(masks))
+
+
+def roi_statistics(data: np.ndarray, rois: RoiVoxels) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Mean and SD (n - 1 denominator, as 3dmaskave -sigma) of :param data: in every ROI, in one pass.
+    Like AFNI, non-finite values (SPM writes NaN outside the brain) count as 0.
+    :return: mean, SD and number of voxels of each ROI
+    """
+    # NIfTI data are stored in Fortran order, so this reshape of a memory-mapped image does not copy it
+    values = np.asarray(data.reshape(-1, order='F')[rois.voxels], dtype=np.float64)
+    values[~np.isfinite(values)] = 0.0
+    counts = np.bincount(rois.labels, minlength=rois.num_rois)
+    sums = np.bincount(rois.labels, weights=values, minlength=rois.num_rois)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        squares = np.bincount(rois.labels, weights=(values - means[rois.labels]) ** 2, minlength=rois.num_rois)
+        sds = np.sqrt(squares / (counts - 1))
+    return means, sds, counts
+
+
+def extract_subject(subject: str, image_dir: str, roi_dir: str, images: List[str], rois: List[str],
+                    cache_dir: str, cache_bytes: int) -> List[Tuple]:
+    """
+    :param image_dir: first level model directory, with {subject} in place of the subject ID
+    :param roi_dir: ROI directory, with {subject} in place of the subject ID for subject-specific ROIs
+    :param cache_dir: directory of ROIs resampled to image grids, shared by all subjects
+    :return: (subject, image, ROI, mean, SD, number of voxels) rows
+    """
+    image_dir = Path(image_dir.format(subject=subject))
+    roi_files = [Path(roi_dir.format(subject=subject)) / f'{roi}.nii' for roi in rois]
+    master = nib.load(str(image_dir / 'mask.nii'))
+    cache = get_roi_cache(cache_dir, cache_bytes)
+    master_rois = roi_voxels(roi_files, master.shape, master.affine, cache)
+
+    rows = []
+    for image in images:
+        file = image_dir / image
+        header = nib.load(str(file), mmap=True)
+        # Images of a first level model share the grid of its mask, so ROIs are usually resampled once
+        if header.shape[:3] == master.shape[:3] and np.allclose(header.affine, master.affine):
+            image_rois = master_rois
+        else:
+            image_rois = roi_voxels(roi_files, header.shape, header.affine, cache)
+        means, sds, counts = roi_statistics(load_data(file), image_rois)
+        rows += [(subject, image, roi, mean, sd, count) for roi, mean, sd, count in zip(rois, means, sds, counts)]
+    return rows
+
+
+def safe_extract_subject(subject: str, *args) -> Tuple[str, List[Tuple], str]:
+    """:return: subject, rows, and the error if extraction failed"""
+    try:
+        return subject, extract_subject(subject, *args), ''
+    except Exception as e:
+        return subject, [], f'{type(e).__name__}: {e}'
+
+
+def write_table(file: Path, rows: List[Tuple]):
+    with open(str(file), mode='w') as f:
+        f.write('subject_id\timage\troi\tmean\tsd\tnum_voxels\n')
+        f.write(''.join(f'{s}\t{i}\t{r}\t{m:.6f}\t{sd:.6f}\t{n}\n' for s, i, r, m, sd, n in rows))
+
+
+def read_subject_list(file: str) -> List[str]:
+    with open(file, 'r') as f:
+        return [line for line in f.read().split() if line]
+
+
+def main(subject_list: str, image_dir: str, roi_dir: str, images: List[str], rois: List[str],
+         output_file: str, jobs: int = 1, cache_dir: str = None, cache_bytes: int = 1 << 30):
+    subjects = read_subject_list(subject_list)
+    if cache_dir is None:
+        cache_dir = str(Path(output_file).absolute().parent / 'roi_cache')
+    arguments = (subjects, repeat(image_dir), repeat(roi_dir), repeat(images), repeat(rois), repeat(cache_dir),
+                 repeat(cache_bytes))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(safe_extract_subject, *arguments))
+    else:
+        results = list(map(safe_extract_subject, *arguments))
+
+    rows = [row for _, subject_rows, _ in results for row in subject_rows]
+    write_table(Path(output_file), rows)
+    for subject, _, error in results:
+        if error:
+            print(f'Error extracting {subject}: {error}')
+    print(f'Extracted {len(rows)} parameter estimates of {len(subjects)} subjects to {output_file}')
+
+
+if __name__ == "__main__":
+    description = 'Extract mean parameter estimates and SDs within ROIs from subject images'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-s', '--subjects', metavar='Subject list', action='store',
+                        type=str, required=False, default='subject_list.txt',
+                        help='file listing subject IDs, separated by whitespace.',
+                        dest='subject_list'
+                        )
+    parser.add_argument('-d', '--image-dir', metavar='Image directory', action='store',
+                        type=str, required=True,
+                        help='fx directory of each subject, containing mask.nii and the images, '
+                             'with {subject} in place of the subject ID, '
+                             'e.g. /projects/sanlab/shared/study/nonbids_data/fMRI/fx/models/task/wave/modelname/sub-{subject}',
+                        dest='image_dir'
+                        )
+    parser.add_argument('-r', '--roi-dir', metavar='ROI directory', action='store',
+                        type=str, required=True,
+                        help='directory of the ROI masks. For subject-specific ROIs, use {subject} in place of '
+                             'the subject ID.',
+                        dest='roi_dir'
+                        )
+    parser.add_argument('--rois', metavar='ROI', action='store', nargs='+',
+                        type=str, required=True,
+                        help='ROI masks, without the .nii extension, e.g. pgACC vmPFC VS',
+                        dest='rois'
+                        )
+    parser.add_argument('--images', metavar='Image', action='store', nargs='+',
+                        type=str, required=True,
+                        help='images to extract parameter estimates from, e.g. con_0001.nii con_0002.nii',
+                        dest='images'
+                        )
+    parser.add_argument('-o', '--output', metavar='Output file', action='store',
+                        type=str, required=False, default='parameterEstimates.tsv',
+                        help='table of parameter estimates of all subjects.',
+                        dest='output_file'
+                        )
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of subjects to extract in parallel.',
+                        dest='jobs'
+                        )
+    parser.add_argument('-c', '--cache-dir', metavar='Cache directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory of ROIs resampled to image grids. By default, roi_cache next to the output file.',
+                        dest='cache_dir'
+                        )
+    parser.add_argument('--cache-size', metavar='Cache size (MB)', action='store',
+                        type=int, required=False, default=1024,
+                        help='size of the ROI cache, beyond which the least recently used ROIs are removed.',
+                        dest='cache_size'
+                        )
+    args = parser.parse_args()
+
+    main(args.subject_list, args.image_dir, args.roi_dir, args.images, args.rois, args.output_file, args.jobs,
+         args.cache_dir, args.cache_size << 20)
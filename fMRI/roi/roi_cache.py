@@ -0,0 +1,114 @@
+"""
+Content-addressed cache of ROIs resampled to image grids.
+
+A resampled ROI is stored as the flat (NIfTI order) indices of its voxels on the target grid, in a .npy file
+named by the hash of the ROI file contents, the target affine and the target shape. Most subjects share a
+template grid, so each ROI is resampled once per grid, not once per subject. Files are written to a temporary
+name and renamed into place, so concurrent workers never read a partial file, and two workers resampling the
+same ROI at once write identical content. Reading a file updates its modification time, and the least recently
+used files are removed when the cache grows past its size limit.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Tuple
+
+import nibabel as nib
+import numpy as np
+
+# Decimals of the affine that are part of the key, so grids that differ by floating point noise share entries
+AFFINE_DECIMALS = 6
+
+
+def resample_nearest(roi_file: Path, shape: Tuple[int, ...], affine: np.ndarray) -> np.ndarray:
+    """
+    Resample an ROI to a target grid by nearest neighbour, with an identity transform between the
+    world coordinates of both grids, like 3dAllineate -final NN -1Dparam_apply '1D: 12@0'\\'
+    :return: boolean mask on the target grid
+    """
+    roi = nib.load(str(roi_file))
+    roi_data = np.asanyarray(roi.dataobj)
+    roi_data = roi_data.reshape(roi_data.shape[:3])
+    if roi_data.shape == tuple(shape[:3]) and np.allclose(roi.affine, affine):
+        return roi_data != 0
+
+    # Voxel coordinates of the target grid in the voxel space of the ROI
+    target_to_roi = np.linalg.inv(roi.affine) @ affine
+    ijk = np.indices(shape[:3]).reshape(3, -1)
+    source = np.rint(target_to_roi[:3, :3] @ ijk + target_to_roi[:3, 3:]).astype(np.int64)
+    inside = np.all((source >= 0) & (source < np.array(roi_data.shape)[:, np.newaxis]), axis=0)
+    mask = np.zeros(ijk.shape[1], dtype=bool)
+    mask[inside] = roi_data[tuple(source[:, inside])] != 0
+    return mask.reshape(shape[:3])
+
+
+class RoiCache:
+    def __init__(self, cache_dir: Path, max_bytes: int = 1 << 30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Hashes of ROI files, by (path, size, modification time), so each ROI is read once per process
+        self._file_hashes: Dict[Tuple[str, int, int], str] = {}
+        # Voxel indices already loaded by this process
+        self._voxels: Dict[str, np.ndarray] = {}
+
+    def file_hash(self, file: Path) -> str:
+        stat = os.stat(str(file))
+        key = (str(Path(file).resolve()), stat.st_size, stat.st_mtime_ns)
+        if key not in self._file_hashes:
+            with open(str(file), 'rb') as f:
+                self._file_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+        return self._file_hashes[key]
+
+    def key(self, roi_file: Path, shape: Tuple[int, ...], affine: np.ndarray) -> str:
+        h = hashlib.sha256(self.file_hash(roi_file).encode('ascii'))
+        h.update(np.asarray(shape[:3], dtype='<i8').tobytes())
+        # Adding 0.0 turns -0.0 into 0.0
+        h.update((np.round(np.asarray(affine, dtype=np.float64), AFFINE_DECIMALS) + 0.0).astype('<f8').tobytes())
+        return h.hexdigest()
+
+    def voxels(self, roi_file: Path, shape: Tuple[int, ...], affine: np.ndarray) -> np.ndarray:
+        """
+        :return: flat indices, in NIfTI (Fortran) order, of the voxels of :param roi_file: resampled by
+        nearest neighbour to the grid of :param shape: and :param affine:
+        """
+        key = self.key(roi_file, shape, affine)
+        if key in self._voxels:
+            return self._voxels[key]
+
+        file = self.cache_dir / f'{key}.npy'
+        try:
+            voxels = np.load(str(file))
+            os.utime(str(file))
+        except (FileNotFoundError, ValueError, EOFError):
+            voxels = np.flatnonzero(resample_nearest(roi_file, shape, affine).ravel(order='F'))
+            self._write(file, voxels)
+            self.evict()
+        self._voxels[key] = voxels
+        return voxels
+
+    def _write(self, file: Path, voxels: np.ndarray):
+        tmp_file = file.with_name(f'{file.stem}.{os.getpid()}.tmp')
+        with open(str(tmp_file), 'wb') as f:
+            np.save(f, voxels)
+        os.replace(str(tmp_file), str(file))
+
+    def evict(self):
+        """Remove the least recently used files until the cache is within its size limit"""
+        entries = []
+        for entry in os.scandir(str(self.cache_dir)):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
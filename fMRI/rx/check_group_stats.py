@@ -0,0 +1,114 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy import stats
+
+from group_stats import FWE_MAP, MASK_NAME, NULL_NAME, group_stats, read_groups, sign_flips
+
+SHAPE = (12, 14, 10)
+
+
+def synthetic_cohort(tmp_dir: Path, num_subjects: int, rng: np.random.Generator):
+    """
+    Write con_0001.nii and con_0002.nii of every subject, NaN outside the brain and in a few voxels of some
+    subjects, the make_con_lists.py list of each contrast, and is_control.tsv. :return: the list files
+    """
+    brain = np.zeros(SHAPE, dtype=bool)
+    brain[2:10, 2:12, 1:9] = True
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    lists = {1: [], 2: []}
+    with open(str(tmp_dir / 'is_control.tsv'), 'w') as f:
+        f.write('subject_id\tis_treatment\n')
+        for i in range(1, num_subjects + 1):
+            subject = f'REV{i:03d}'
+            f.write(f'"{subject}"\t{i % 2}\n')
+            subject_dir = tmp_dir / f'sub-{subject}' / 'fx' / 'gng'
+            subject_dir.mkdir(parents=True)
+            for con, effect in ((1, 0.5), (2, 0.0)):
+                data = np.where(brain, rng.normal(effect + 0.3 * (i % 2), 1.0, size=SHAPE), np.nan)
+                if i % 5 == 0:
+                    data[4, 4, 4] = np.nan
+                file = subject_dir / f'con_{con:04d}.nii'
+                nib.save(nib.Nifti1Image(data.astype(np.float32), affine), str(file))
+                lists[con].append(f"'{file}'")
+    files = []
+    for con, lines in lists.items():
+        files.append(tmp_dir / f'con_{con:04d}20240101-1200.txt')
+        files[-1].write_text('\n'.join(lines) + '\n')
+    return [str(f) for f in files]
+
+
+def main(num_subjects: int, num_permutations: int, jobs: int, memory: int):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        list_files = synthetic_cohort(tmp_dir, num_subjects, rng)
+        groups = read_groups(str(tmp_dir / 'is_control.tsv'))
+
+        start = time.perf_counter()
+        group_stats(list_files, str(tmp_dir / 'rx'), groups, None, num_permutations, 0, jobs, memory << 20)
+        elapsed = time.perf_counter() - start
+
+        for list_file in list_files:
+            contrast_dir = tmp_dir / 'rx' / Path(list_file).stem
+            files = [line.strip("'\n") for line in open(list_file)]
+            data = np.stack([np.asarray(nib.load(f).dataobj, dtype=np.float64) for f in files])
+            mask = np.all(np.isfinite(data), axis=0)
+            assert np.array_equal(np.asarray(nib.load(str(contrast_dir / MASK_NAME)).dataobj) > 0, mask)
+            values = data[:, mask]
+
+            def load(name):
+                image = np.asarray(nib.load(str(contrast_dir / f'{name}.nii')).dataobj)
+                assert np.all(np.isnan(image[~mask]))
+                return image[mask]
+
+            assert np.allclose(load('one_sample_t'), stats.ttest_1samp(values, 0.0).statistic, rtol=1e-4)
+            group = np.array([groups[Path(f).parts[-4][len('sub-'):]] for f in files])
+            assert np.allclose(load('two_sample_t'),
+                               stats.ttest_ind(values[group == 1], values[group == 0]).statistic, rtol=1e-4)
+
+            # Permutation p values, one sign flip at a time
+            signs = sign_flips(len(files), num_permutations, 0)
+            flipped = np.array([stats.ttest_1samp(s[:, np.newaxis] * values, 0.0).statistic for s in signs])
+            t = flipped[0]
+            assert np.allclose(np.loadtxt(str(contrast_dir / NULL_NAME)), flipped.max(axis=1), rtol=1e-4)
+            assert np.allclose(load('one_sample_p_unc'), (flipped >= t - 1e-6).mean(axis=0), atol=1.0 / len(signs))
+            fwe = load(FWE_MAP)
+            assert np.allclose(fwe, (flipped.max(axis=1)[:, np.newaxis] >= t - 1e-6).mean(axis=0),
+                               atol=1.0 / len(signs))
+            # Every flip counts the observed t, so no p is below 1 over the number of flips
+            assert min(np.nanmin(fwe), np.nanmin(load('one_sample_p_unc'))) * len(signs) > 1.0 - 1e-6
+        print(f'group_stats.py t maps and sign flip p maps match scipy.stats, {elapsed:.3f} s for '
+              f'{len(list_files)} contrasts of {num_subjects} subjects, {num_permutations} sign flips '
+              f'({jobs} jobs, {memory} MB blocks)')
+
+
+if __name__ == "__main__":
+    description = 'Check group_stats.py against scipy.stats on a synthetic cohort'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--subjects', metavar='Number of subjects', action='store',
+                        type=int, required=False, default=30,
+                        help='number of synthetic subjects.',
+                        dest='num_subjects')
+    parser.add_argument('-p', '--permutations', metavar='Number of sign flips', action='store',
+                        type=int, required=False, default=200,
+                        help='number of sign flips.',
+                        dest='num_permutations')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=2,
+                        help='number of blocks of voxels to process in parallel.',
+                        dest='jobs')
+    parser.add_argument('-m', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1,
+                        help='memory budget of each job, small to split each contrast into several blocks.',
+                        dest='memory')
+    args = parser.parse_args()
+
+    main(args.num_subjects, args.num_permutations, args.jobs, args.memory)
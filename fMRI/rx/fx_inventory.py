@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# Index of the first level model output of every subject and task:
+# {subject directory name: {task: {'mtime_ns': ..., 'con': [...], 'beta': [...], 'mask': [...]}}}
+# A subject is in the index only if its fx directory exists. If fx exists but fx/<task> does not,
+# the task entry has no files and no mtime_ns.
+Inventory = Dict[str, Dict[str, Dict]]
+
+CACHE_NAME = '.fx_inventory.json'
+FILE_KINDS = ('con', 'beta', 'mask')
+
+
+def get_subject_dir_names(toplevel_dir: str, study: str) -> List[str]:
+    """
+    List the subject directories in the first level model output directory.
+
+    @type toplevel_dir:     string
+    @param toplevel_dir:    path to first level model output directory that contains subject specific directories
+    @type study:            string
+    @param study:           study ID, as in sub-<study><number>
+
+    @rtype:                 list
+    @return:                sorted list of subject directory names
+    """
+    with os.scandir(toplevel_dir) as entries:
+        return sorted(e.name for e in entries if e.name.startswith('sub-' + study) and e.is_dir())
+
+
+def scan_task_dir(task_dir: str, mtime_ns: int) -> Dict:
+    """
+    List the con, beta and mask nifti files of one task directory with a single scandir.
+
+    @rtype:         dict
+    @return:        modification time of the directory, and sorted file names of each kind
+    """
+    entry = {'mtime_ns': mtime_ns}
+    entry.update({kind: [] for kind in FILE_KINDS})
+    with os.scandir(task_dir) as entries:
+        for e in entries:
+            kind = e.name.split('_')[0].split('.')[0]
+            if kind in FILE_KINDS and e.name.endswith('.nii'):
+                entry[kind].append(e.name)
+    for kind in FILE_KINDS:
+        entry[kind].sort()
+    return entry
+
+
+def scan_subject(toplevel_dir: str, subject: str, tasks: List[str],
+                 cached: Dict) -> Tuple[str, Optional[Dict]]:
+    """
+    Index the fx/<task> directories of one subject. A task directory is only listed again if its
+    modification time differs from the one in :param cached:, since adding or removing files changes it.
+
+    @rtype:         tuple
+    @return:        subject directory name, and dict of task to index entry, or None if there is no fx directory
+    """
+    fx_dir = os.path.join(toplevel_dir, subject, 'fx')
+    if not os.path.isdir(fx_dir):
+        return subject, None
+    subject_index = {}
+    for task in tasks:
+        task_dir = os.path.join(fx_dir, task)
+        try:
+            mtime_ns = os.stat(task_dir).st_mtime_ns
+        except FileNotFoundError:
+            subject_index[task] = {kind: [] for kind in FILE_KINDS}
+            continue
+        previous = cached.get(task)
+        if previous is not None and previous.get('mtime_ns') == mtime_ns:
+            subject_index[task] = previous
+        else:
+            subject_index[task] = scan_task_dir(task_dir, mtime_ns)
+    return subject, subject_index
+
+
+def read_cache(cache_file: str) -> Inventory:
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_cache(cache_file: str, inventory: Inventory):
+    """Write the cache to a temporary file first, so an interrupted run does not leave a truncated cache"""
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(inventory, f)
+    os.replace(tmp_file, cache_file)
+
+
+def build_inventory(toplevel_dir: str, study: str, tasks: List[str], cache_file: Optional[str] = None,
+                    jobs: int = 16) -> Inventory:
+    """
+    Index the first level model output of every subject, scanning subjects concurrently in a thread pool.
+    Most of the time is spent waiting on filesystem metadata, so threads overlap those round trips.
+
+    @type cache_file:       string
+    @param cache_file:      path to the JSON cache of the index, or None to always scan every directory
+    @type jobs:             numeric
+    @param jobs:            number of subjects to scan at once
+
+    @rtype:                 dict
+    @return:                index of subjects with an fx directory
+    """
+    cache = read_cache(cache_file) if cache_file else {}
+    subjects = get_subject_dir_names(toplevel_dir, study)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(lambda s: scan_subject(toplevel_dir, s, tasks, cache.get(s, {})), subjects)
+        inventory = {subject: subject_index for subject, subject_index in results if subject_index is not None}
+    if cache_file:
+        # Keep the entries of tasks that were not scanned this time
+        for subject, subject_index in inventory.items():
+            cache.setdefault(subject, {}).update(subject_index)
+        write_cache(cache_file, cache)
+    return inventory
+
+
+def write_lines(filename: str, lines: List[str]):
+    """
+    Write all lines of a report at once.
+
+    @type lines:        list
+    @param lines:       lines of text, without line separators
+    """
+    with open(filename, 'w') as f:
+        f.write(''.join(line + os.linesep for line in lines))
+
+
+def check_betas(inventory: Inventory, expected_betas: Dict[str, int], log_dir: str):
+    """
+    Write, for each task, a list of subjects with the expected number of beta files, and a list of subjects
+    with a different number along with the number of beta files they actually have.
+
+    @type expected_betas:   dict
+    @param expected_betas:  task to expected number of beta files
+    """
+    for task, num_betas in expected_betas.items():
+        extant = ['-------------------Participants WITH all beta maps-------------------']
+        missing = ['-------------------Participants MISSING beta maps-------------------']
+        for subject, subject_index in sorted(inventory.items()):
+            count = len(subject_index[task]['beta'])
+            if count != num_betas:
+                missing.append(f'{subject} = {count} files, expected {num_betas}')
+            else:
+                extant.append(subject)
+        write_lines(os.path.join(log_dir, f'extant_fx_files_{task}.txt'), extant)
+        write_lines(os.path.join(log_dir, f'missing_fx_files_{task}.txt'), missing)
+    print('Done. Reports are in ' + log_dir)
+
+
+def parse_expected_betas(values: List[str]) -> Dict[str, int]:
+    """Parse task=count pairs"""
+    expected_betas = {}
+    for value in values:
+        task, _, count = value.partition('=')
+        expected_betas[task] = int(count)
+    return expected_betas
+
+
+def main():
+    """
+    Check that the expected number of beta nifti files (created during first level modeling) exist for each participant.
+    """
+    parser = argparse.ArgumentParser(description='Check that first level models have the expected number of betas',
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--fx-dir', metavar='First level model output directory', action='store',
+                        type=str, required=True,
+                        help='absolute path to the directory containing sub-<study>* first level model output.',
+                        dest='fx_dir')
+    parser.add_argument('-s', '--study', metavar='Study', action='store',
+                        type=str, required=False, default='REV',
+                        help='study ID of the subject directories.',
+                        dest='study')
+    parser.add_argument('-b', '--betas', metavar='task=count', action='store', nargs='+',
+                        type=str, required=False, default=['sst=64', 'gng=96'],
+                        help='task(s) to check and the expected number of beta files of each.',
+                        dest='betas')
+    parser.add_argument('-l', '--log-dir', metavar='Log directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory for the reports. By default, logs in the first level model output directory.',
+                        dest='log_dir')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=16,
+                        help='number of subject directories to scan at once.',
+                        dest='jobs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='scan every directory, instead of reusing the index of unchanged directories.',
+                        dest='no_cache')
+    args = parser.parse_args()
+
+    expected_betas = parse_expected_betas(args.betas)
+    log_dir = args.log_dir or os.path.join(args.fx_dir, 'logs')
+    if not os.path.isdir(log_dir):
+        os.mkdir(log_dir)
+    cache_file = None if args.no_cache else os.path.join(args.fx_dir, CACHE_NAME)
+    inventory = build_inventory(args.fx_dir, args.study, list(expected_betas), cache_file, args.jobs)
+    check_betas(inventory, expected_betas, log_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""
+Group level (rx) t maps of first level contrasts, from the contrast lists of make_con_lists.py, in place of one
+SPM job per model.
+
+Each list (one quoted con_####.nii path per line) is one contrast. The con images of a contrast are
+memory-mapped and read in blocks of voxels that fit a memory budget, whatever the number of subjects, and the
+blocks of every contrast are spread over one process pool. For each contrast, the output directory gets a
+directory named after its list, with:
+    mask.nii                voxels where every con image is finite (SPM's implicit mask), and nonzero in the
+                            explicit mask if one is given
+    one_sample_mean.nii     mean over subjects
+    one_sample_t.nii        t of the mean, with n - 1 degrees of freedom
+    two_sample_diff.nii     (with groups) mean of is_treatment 1 minus mean of is_treatment 0
+    two_sample_t.nii        (with groups) t of the difference, with pooled variance and n1 + n2 - 2 degrees of
+                            freedom
+    one_sample_p_unc.nii    (with permutations) uncorrected p of the one-sample t, from sign flips
+    one_sample_p_fwe.nii    (with permutations) FWE corrected p of the one-sample t, from the maximum t of each
+                            sign flip over the mask
+    max_t_null.txt          (with permutations) maximum t of each sign flip, the first being the observed t
+and group_stats.tsv in the output directory lists the number of subjects and degrees of freedom of every test.
+Maps are NaN outside the mask.
+
+Sign flips are one-sided (positive t) and reuse the blocks read for the t maps: with the signs of every flip as
+the rows of a matrix S, the sums of a block under every flip are one matrix product S @ Y, and the sums of
+squares do not change with the signs. The same flips are used for every block, starting with no flip.
+"""
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from nibabel.volumeutils import native_code
+
+SUBJECT_PATTERN = re.compile(r'sub-([^/\\]+)')
+SUMMARY_NAME = 'group_stats.tsv'
+MASK_NAME = 'mask.nii'
+NULL_NAME = 'max_t_null.txt'
+ONE_SAMPLE_MAPS = ('one_sample_mean', 'one_sample_t')
+TWO_SAMPLE_MAPS = ('two_sample_diff', 'two_sample_t')
+PERMUTATION_MAPS = ('one_sample_p_unc',)
+FWE_MAP = 'one_sample_p_fwe'
+
+
+class Contrast(NamedTuple):
+    """One contrast prepared for the workers"""
+    name: str
+    output_dir: Path
+    files: List[str]  # con images, memory-mapped by the workers
+    shape: Tuple[int, int, int]
+    group: Optional[np.ndarray]  # is_treatment of each file, or None for the one-sample test only
+    explicit_mask: Optional[str]
+    maps: List[str]  # names of the float32 maps written block by block
+    data_offset: int  # of every map
+
+
+def read_con_list(file: str) -> List[str]:
+    """Paths of a make_con_lists.py list, one per line, with or without quotes"""
+    with open(file, 'r') as f:
+        return [line.strip().strip('\'"') for line in f if line.strip()]
+
+
+def read_groups(file: str) -> Dict[str, int]:
+    """
+    Read is_control.tsv, with a header and subject_id and is_treatment columns.
+    :return: dict of subject ID to is_treatment
+    """
+    groups = {}
+    with open(file, 'r') as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        subject_column, group_column = columns.index('subject_id'), columns.index('is_treatment')
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if len(values) > max(subject_column, group_column):
+                groups[values[subject_column].strip('"')] = int(values[group_column])
+    return groups
+
+
+def subject_id(file: str) -> Optional[str]:
+    """Subject ID of a con image, from the sub-<ID> directory of its path"""
+    matches = SUBJECT_PATTERN.findall(file)
+    return matches[-1] if matches else None
+
+
+def sign_flips(num_subjects: int, num_permutations: int, seed: int) -> np.ndarray:
+    """Signs of each permutation x subject, the first row without flips"""
+    rng = np.random.default_rng(seed)
+    signs = rng.choice(np.array([-1.0, 1.0]), size=(num_permutations, num_subjects))
+    signs[0] = 1.0
+    return signs
+
+
+def image_data(file: str) -> Tuple[np.ndarray, float, float]:
+    """Memory-mapped data of a 3D image, flattened in voxel order, with its scaling applied when it is read"""
+    image = nib.load(file, mmap=True)
+    data = image.dataobj.get_unscaled().reshape(-1, order='F')
+    return data, float(image.dataobj.slope), float(image.dataobj.inter)
+
+
+def read_block(contrast: Contrast, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+    """:return: the values of voxels start..stop - 1 of every con image, subjects x voxels, and the mask"""
+    block = np.empty((len(contrast.files), stop - start))
+    for i, file in enumerate(contrast.files):
+        data, slope, inter = image_data(file)
+        block[i] = np.asarray(data[start:stop], dtype=np.float64) * slope + inter
+    in_mask = np.all(np.isfinite(block), axis=0)
+    if contrast.explicit_mask:
+        data, _, _ = image_data(contrast.explicit_mask)
+        in_mask &= np.asarray(data[start:stop]) > 0
+    return block[:, in_mask], in_mask
+
+
+def one_sample_t(sums: np.ndarray, sums_of_squares: np.ndarray, n: int) -> np.ndarray:
+    """t of the mean from sums and sums of squares, with zero variance as NaN"""
+    mean = sums / n
+    variance = np.maximum(sums_of_squares - n * mean ** 2, 0.0) / (n - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(variance > 0.0, mean / np.sqrt(variance / n), np.nan)
+
+
+def block_stats(contrast: Contrast, start: int, stop: int,
+                signs: Optional[np.ndarray]) -> Tuple[int, Optional[np.ndarray]]:
+    """
+    Compute the maps of voxels start..stop - 1 of :param contrast: and write them into its images.
+    :return: the number of voxels in the mask, and the maximum t of each sign flip over them (if any)
+    """
+    values, in_mask = read_block(contrast, start, stop)
+    num_voxels = stop - start
+    outputs = np.full((len(contrast.maps), num_voxels), np.nan, dtype=np.float32)
+    n = values.shape[0]
+    sums = values.sum(axis=0)
+    sums_of_squares = np.einsum('ij,ij->j', values, values)
+    t = one_sample_t(sums, sums_of_squares, n)
+    maps = {'one_sample_mean': sums / n, 'one_sample_t': t}
+
+    if contrast.group is not None:
+        treatment, control = values[contrast.group == 1], values[contrast.group == 0]
+        n1, n2 = treatment.shape[0], control.shape[0]
+        difference = treatment.mean(axis=0) - control.mean(axis=0)
+        pooled = (((treatment - treatment.mean(axis=0)) ** 2).sum(axis=0) +
+                  ((control - control.mean(axis=0)) ** 2).sum(axis=0)) / (n1 + n2 - 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            maps['two_sample_diff'] = difference
+            maps['two_sample_t'] = np.where(pooled > 0.0, difference / np.sqrt(pooled * (1.0 / n1 + 1.0 / n2)),
+                                            np.nan)
+
+    max_t = None
+    if signs is not None:
+        flipped_t = one_sample_t(signs @ values, sums_of_squares[np.newaxis, :], n)
+        # The observed t is the first flip, so that it counts as exactly as large as itself
+        t = maps['one_sample_t'] = flipped_t[0]
+        with np.errstate(invalid='ignore'):
+            maps['one_sample_p_unc'] = (flipped_t >= t[np.newaxis, :]).sum(axis=0) / signs.shape[0]
+        maps['one_sample_p_unc'][np.isnan(t)] = np.nan
+        max_t = np.nanmax(flipped_t, axis=1, initial=-np.inf)
+
+    for i, name in enumerate(contrast.maps):
+        outputs[i, in_mask] = maps[name]
+    outputs = np.vstack([outputs, in_mask[np.newaxis].astype(np.float32)])
+    for name, image in zip(contrast.maps + ['mask'], outputs):
+        fd = os.open(str(contrast.output_dir / f'{name}.nii'), os.O_WRONLY)
+        try:
+            os.pwrite(fd, image.tobytes(), contrast.data_offset + start * image.itemsize)
+        finally:
+            os.close(fd)
+    return int(np.count_nonzero(in_mask)), max_t
+
+
+def prepare_contrast(list_file: str, output_dir: Path, groups: Optional[Dict[str, int]],
+                     explicit_mask: Optional[str], permutations: bool) -> Contrast:
+    """
+    Read the list of a contrast, check that its con images have one shape, and create its output images:
+    the header of the first con image, as float32, with room for the data
+    """
+    name = Path(list_file).stem
+    files = read_con_list(list_file)
+    if len(files) < 2:
+        raise ValueError(f'{list_file} lists {len(files)} con images, at least 2 are needed')
+    first = nib.load(files[0])
+    shape = tuple(first.shape[:3])
+    for file in files[1:]:
+        if tuple(nib.load(file).shape[:3]) != shape:
+            raise ValueError(f'{file} is not {shape}, like {files[0]}')
+
+    group = None
+    maps = list(ONE_SAMPLE_MAPS)
+    if groups is not None:
+        subjects = [subject_id(f) for f in files]
+        missing = [s for s in subjects if s not in groups]
+        if missing:
+            print(f'{name}: no is_treatment for {" ".join(str(s) for s in missing)}, left out', file=sys.stderr)
+        group = np.array([groups.get(s, -1) for s in subjects])
+        if np.count_nonzero(group == 1) < 1 or np.count_nonzero(group == 0) < 1 or \
+                np.count_nonzero(group >= 0) < 3:
+            raise ValueError(f'{list_file}: too few subjects in each group for a two-sample test')
+        maps += list(TWO_SAMPLE_MAPS)
+    if permutations:
+        maps += list(PERMUTATION_MAPS)
+
+    contrast_dir = output_dir / name
+    contrast_dir.mkdir(parents=True, exist_ok=True)
+    header = first.header.as_byteswapped(native_code) if first.header.endianness != native_code else \
+        first.header.copy()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1.0, 0.0)
+    header['vox_offset'] = 0
+    offsets = set()
+    for map_name in maps + ['mask']:
+        with open(str(contrast_dir / f'{map_name}.nii'), 'wb') as f:
+            header.write_to(f)
+            offsets.add(header.get_data_offset())
+            f.truncate(header.get_data_offset() + int(np.prod(shape)) * 4)
+    return Contrast(name, contrast_dir, files, shape, group, explicit_mask, maps, offsets.pop())
+
+
+def blocks(contrast: Contrast, memory_budget: int, num_permutations: int) -> List[Tuple[int, int]]:
+    """
+    Voxel ranges of :param contrast: whose working memory fits :param memory_budget: bytes:
+    two float64 copies of each voxel of every con image, and the t of every sign flip
+    """
+    num_voxels = int(np.prod(contrast.shape))
+    voxel_bytes = (2 * len(contrast.files) + 2 * num_permutations + len(contrast.maps) + 1) * 8
+    voxels = max(1, memory_budget // voxel_bytes)
+    return [(start, min(start + voxels, num_voxels)) for start in range(0, num_voxels, voxels)]
+
+
+def finish_contrast(contrast: Contrast, max_t: Optional[np.ndarray]) -> List[List[str]]:
+    """
+    Write the FWE corrected p map from the maximum t of each sign flip over all blocks, and the mask as uint8.
+    :return: rows of group_stats.tsv
+    """
+    t_image = nib.load(str(contrast.output_dir / 'one_sample_t.nii'))
+    if max_t is not None:
+        t = np.asarray(t_image.dataobj)
+        with np.errstate(invalid='ignore'):
+            # In the precision of the t map, in which the observed maximum is as large as its own voxel
+            p = (max_t.astype(t.dtype)[:, np.newaxis] >= t.reshape(1, -1)).sum(axis=0) / max_t.size
+        p = np.where(np.isnan(t.reshape(-1)), np.nan, p).reshape(t.shape).astype(np.float32)
+        nib.save(nib.Nifti1Image(p, t_image.affine, t_image.header), str(contrast.output_dir / f'{FWE_MAP}.nii'))
+        with open(str(contrast.output_dir / NULL_NAME), 'w') as f:
+            f.writelines(f'{v:.6g}\n' for v in max_t)
+    mask_file = contrast.output_dir / MASK_NAME
+    mask = np.asarray(nib.load(str(mask_file)).dataobj) > 0
+    header = t_image.header.copy()
+    header.set_data_dtype(np.uint8)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), t_image.affine, header), str(mask_file))
+
+    n = len(contrast.files)
+    rows = [[contrast.name, 'one_sample', str(n), '', '', str(n - 1)]]
+    if contrast.group is not None:
+        n1, n2 = int(np.count_nonzero(contrast.group == 1)), int(np.count_nonzero(contrast.group == 0))
+        rows.append([contrast.name, 'two_sample', str(n1 + n2), str(n1), str(n2), str(n1 + n2 - 2)])
+    return rows
+
+
+def group_stats(list_files: List[str], output_dir: str, groups: Optional[Dict[str, int]] = None,
+                explicit_mask: Optional[str] = None, num_permutations: int = 0, seed: int = 0, jobs: int = 1,
+                memory_budget: int = 1 << 30) -> List[List[str]]:
+    """
+    Compute the maps of every contrast in :param list_files:, with the blocks of all contrasts in one process
+    pool. :return: rows of group_stats.tsv
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        contrasts = list(executor.map(prepare_contrast, list_files, [output_dir] * len(list_files),
+                                      [groups] * len(list_files), [explicit_mask] * len(list_files),
+                                      [num_permutations > 0] * len(list_files)))
+        if groups is not None:
+            # Subjects without a group are left out of both tests, so that they use the same subjects
+            contrasts = [c._replace(files=[f for f, g in zip(c.files, c.group) if g >= 0],
+                                    group=c.group[c.group >= 0]) for c in contrasts]
+        futures = []
+        for contrast in contrasts:
+            signs = sign_flips(len(contrast.files), num_permutations, seed) if num_permutations > 0 else None
+            futures.append([executor.submit(block_stats, contrast, start, stop, signs)
+                            for start, stop in blocks(contrast, memory_budget, num_permutations)])
+
+        rows = [['contrast', 'test', 'subjects', 'is_treatment 1', 'is_treatment 0', 'df']]
+        for contrast, contrast_futures in zip(contrasts, futures):
+            results = [future.result() for future in contrast_futures]
+            max_t = np.max([m for _, m in results], axis=0) if num_permutations > 0 else None
+            rows += finish_contrast(contrast, max_t)
+            print(f'{contrast.name}: {len(contrast.files)} subjects, {sum(v for v, _ in results)} voxels in the mask')
+
+    tmp_file = output_dir / f'{SUMMARY_NAME}.{os.getpid()}.tmp'
+    with open(str(tmp_file), 'w') as f:
+        f.writelines('\t'.join(row) + '\n' for row in rows)
+    os.replace(str(tmp_file), str(output_dir / SUMMARY_NAME))
+    return rows
+
+
+if __name__ == "__main__":
+    description = 'Compute one- and two-sample t maps of first level contrasts from make_con_lists.py lists'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-l', '--lists', metavar='Contrast list', action='store', nargs='+',
+                        type=str, required=True,
+                        help='contrast lists written by make_con_lists.py, one per contrast.',
+                        dest='list_files')
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=True,
+                        help='directory for the maps, in one directory per contrast list.',
+                        dest='output_dir')
+    parser.add_argument('-g', '--groups', metavar='Groups file', action='store',
+                        type=str, required=False, default=None,
+                        help='is_control.tsv, with subject_id and is_treatment columns, for the two-sample test. '
+                             'Subject IDs are matched to the sub-<ID> directory of each con image.',
+                        dest='groups_file')
+    parser.add_argument('-m', '--mask', metavar='Explicit mask', action='store',
+                        type=str, required=False, default=None,
+                        help='mask image in the space of the con images.',
+                        dest='explicit_mask')
+    parser.add_argument('-p', '--permutations', metavar='Number of sign flips', action='store',
+                        type=int, required=False, default=0,
+                        help='number of sign flips, including no flip, for permutation p maps of the one-sample t.',
+                        dest='num_permutations')
+    parser.add_argument('--seed', metavar='Seed', action='store',
+                        type=int, required=False, default=0,
+                        help='seed of the sign flips.',
+                        dest='seed')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=1,
+                        help='number of blocks of voxels to process in parallel, over all contrasts.',
+                        dest='jobs')
+    parser.add_argument('-M', '--memory', metavar='Memory (MB)', action='store',
+                        type=int, required=False, default=1024,
+                        help='memory budget of each job for a block of voxels.',
+                        dest='memory')
+    args = parser.parse_args()
+
+    groups = read_groups(args.groups_file) if args.groups_file else None
+    group_stats(args.list_files, args.output_dir, groups, args.explicit_mask, args.num_permutations, args.seed,
+                args.jobs, args.memory << 20)
@@ -1,19 +1,53 @@
+import argparse
 import os
 from datetime import datetime
 
+from fx_inventory import CACHE_NAME, build_inventory, write_lines
+
+
 def main():
     """
-    Create a text file that lists the full path to first level model contrast files - one text file per contrast.  
+    Create a text file that lists the full path to first level model contrast files - one text file per contrast.
     """
-    task = 'gng'
-    study = 'REV'
-    number_confiles = 12
-    output_directory = os.path.join(os.path.sep, 'projects', 'sanlab', 'shared', study, study + '_scripts', 'fMRI', 'rx', 'prepost_analysis', task, 'confile_lists')
+    parser = argparse.ArgumentParser(description='Create lists of first level model contrast files, one per contrast',
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--study', metavar='Study', action='store',
+                        type=str, required=False, default='REV',
+                        help='study ID, as in sub-<study><number>.',
+                        dest='study')
+    parser.add_argument('-t', '--task', metavar='Task', action='store',
+                        type=str, required=False, default='gng',
+                        help='task of the first level models.',
+                        dest='task')
+    parser.add_argument('-n', '--contrasts', metavar='Number of contrasts', action='store',
+                        type=int, required=False, default=12,
+                        help='number of contrast files that exist per participant.',
+                        dest='number_confiles')
+    parser.add_argument('-d', '--fx-dir', metavar='First level model output directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory containing sub-<study>* first level model output. '
+                             'By default, /projects/sanlab/shared/<study>/bids_data/derivatives/prepost_analysis.',
+                        dest='toplevel_dir_confiles')
+    parser.add_argument('-o', '--output', metavar='Output directory', action='store',
+                        type=str, required=False, default=None,
+                        help='directory for the contrast file lists. By default, '
+                             '/projects/sanlab/shared/<study>/<study>_scripts/fMRI/rx/prepost_analysis/<task>/confile_lists.',
+                        dest='output_directory')
+    parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                        type=int, required=False, default=16,
+                        help='number of subject directories to scan at once.',
+                        dest='jobs')
+    args = parser.parse_args()
+
+    task = args.task
+    study = args.study
+    output_directory = args.output_directory or os.path.join(os.path.sep, 'projects', 'sanlab', 'shared', study, study + '_scripts', 'fMRI', 'rx', 'prepost_analysis', task, 'confile_lists')
     check_dir(output_directory)
-    toplevel_dir_confiles = os.path.join(os.path.sep, 'projects', 'sanlab', 'shared', study, 'bids_data', 'derivatives', 'prepost_analysis')
-    confiles = get_confiles(number_confiles)
-    subject_dir_fullpaths = get_subject_dirs(toplevel_dir_confiles)
-    check_confiles(confiles, subject_dir_fullpaths, output_directory, task)
+    toplevel_dir_confiles = args.toplevel_dir_confiles or os.path.join(os.path.sep, 'projects', 'sanlab', 'shared', study, 'bids_data', 'derivatives', 'prepost_analysis')
+    confiles = get_confiles(args.number_confiles)
+    inventory = build_inventory(toplevel_dir_confiles, study, [task], os.path.join(toplevel_dir_confiles, CACHE_NAME), args.jobs)
+    check_confiles(confiles, inventory, toplevel_dir_confiles, output_directory, task)
 
 
 def check_dir(dir_fullpath:str):
@@ -27,28 +61,6 @@ def check_dir(dir_fullpath:str):
         os.mkdir(dir_fullpath)
 
 
-def touch(path:str):
-    """
-    Create a new file.
-    
-    @type path:     string
-    @param path:    path to - including name of - file to be created
-    """
-    with open(path, 'a'):
-        os.utime(path, None)
-
-
-def write_to_file(filename, message):
-    """
-    Write text to the specified text file.
-
-    @type message:          string
-    @param message:         text to be written to the file
-    """
-    with open(filename, 'a') as logfile:
-        logfile.write(message + os.linesep)
-
-
 def get_confiles(number_confiles:int):
     """
     Create a list of contrast file names.
@@ -63,40 +75,39 @@ def get_confiles(number_confiles:int):
     return confiles
 
 
-def get_subject_dirs(toplevel_dir_confiles):
+def check_confiles(confiles, inventory, toplevel_dir_confiles, output_directory, task):
     """
-    Create a list containing each absolute path for the subject directories in the first level model output directory.
-
-    @type toplevel_dir_confiles     string
-    @param toplevel_dir_confiles    path to first level model output directory that contains subject specific directories
+    Write, for each contrast, the list of existing contrast files and the list of missing ones.
+    Each list is written at once, and all lists of a run share one timestamp.
 
-    @rtype:                         list
-    @return                         list of paths to each subject's first level model output (at the subject-level directory)
+    @type inventory:                dict
+    @param inventory:               index of first level model output, from fx_inventory.build_inventory()
     """
-    subject_dir_fullpaths = [ os.path.join(toplevel_dir_confiles, d) for d in os.listdir(toplevel_dir_confiles) if 'sub-REV' in d]
-    return subject_dir_fullpaths
-
-
-def check_confiles(confiles, subject_dir_fullpaths, output_directory, task):
-    for subject_dir_fullpath in subject_dir_fullpaths:
-        for confile in confiles:
-            output_textfile = os.path.join(output_directory, confile[0:-4] + datetime.now().strftime("%Y%m%d-%H%M") + '.txt')
-            error_textfile = os.path.join(output_directory, 'missing_' + confile[0:-4] + datetime.now().strftime("%Y%m%d-%H%M") + '.txt')
-            subject_confile_fullpath = os.path.join(subject_dir_fullpath, 'fx', task, confile)
-            if not os.path.isfile(output_textfile):
-                touch(output_textfile)
-            if not os.path.isfile(error_textfile):
-                touch(error_textfile)
-            create_confile_reports(output_directory, confile, subject_confile_fullpath, output_textfile, error_textfile, subject_dir_fullpath, task)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M")
+    for confile in confiles:
+        output_textfile = os.path.join(output_directory, confile[0:-4] + timestamp + '.txt')
+        error_textfile = os.path.join(output_directory, 'missing_' + confile[0:-4] + timestamp + '.txt')
+        extant, missing = create_confile_reports(confile, inventory, toplevel_dir_confiles, task)
+        write_lines(output_textfile, extant)
+        write_lines(error_textfile, missing)
     print('Done. Reports can be found in ' + output_directory)
 
-                
-def create_confile_reports(output_directory, confile, subject_confile_fullpath, output_textfile, error_textfile, subject_dir_fullpath, task):
-        if os.path.isfile(subject_confile_fullpath):
-            write_to_file(output_textfile, "'" + subject_confile_fullpath + "'")
-        else:
-            if os.path.isdir(os.path.join(subject_dir_fullpath, 'fx', task)):
-                write_to_file(error_textfile, subject_confile_fullpath)
 
-
-main()
\ No newline at end of file
+def create_confile_reports(confile, inventory, toplevel_dir_confiles, task):
+    """
+    @rtype:                         tuple
+    @return:                        lines listing the existing contrast files, quoted, and lines listing
+                                    the missing contrast files of subjects that have a first level model of the task
+    """
+    extant = []
+    missing = []
+    for subject, subject_index in sorted(inventory.items()):
+        subject_confile_fullpath = os.path.join(toplevel_dir_confiles, subject, 'fx', task, confile)
+        if confile in subject_index[task]['con']:
+            extant.append("'" + subject_confile_fullpath + "'")
+        elif 'mtime_ns' in subject_index[task]:  # fx/<task> exists
+            missing.append(subject_confile_fullpath)
+    return extant, missing
+
+
+main()
@@ -0,0 +1,271 @@
+"""
+Plan and run the units of work of a pipeline stage (one subject, or one subject and task) in batches,
+instead of one sbatch submission per unit.
+
+A stage is defined in a JSON file:
+    {
+        "name": "fx_event",
+        "kind": "matlab",                  # or "shell"
+        "working_dir": "/projects/sanlab/shared/study/study_scripts/fMRI/fx/models",
+        "units": {"task": ["ROC", "WTP"]}, # optional, crossed with the subject list
+        "outputs": ["/projects/.../sub-{subject}/fx/{task}/SPM.mat"],
+        "units_per_job": 10,
+        "setup": ["module load matlab"],
+        "log_dir": "/projects/sanlab/shared/study/study_scripts/fMRI/fx/models/output",
+
+        # matlab stages: each batch runs make_sid_matlabbatch.m and spm_jobman for every unit in one session
+        "spm_path": "/projects/sanlab/shared/spm12",
+        "script": "/projects/.../fMRI/fx/models/fx_event_{task}.m",
+        "replacesid": "001",
+
+        # shell stages: each batch runs the command for every unit, with the unit fields in the environment
+        "command": "bash spm_job.sh",
+        "environment": {"SUB": "{subject}", "TASK": "{task}"},
+
+        "slurm": {"cpus-per-task": 1, "mem-per-cpu": "8G", "account": "sanlab", "max_parallel": 50}
+    }
+Strings may use {subject} and the fields of "units". Units whose outputs all exist are skipped.
+
+The plan command writes the batches to <log_dir>/<name>_plan.json. With the slurm backend, it writes one array
+job script with one task per batch (and submits it with --submit). With the local backend, it runs the batches
+in a pool of worker processes. Either way, each batch runs as
+    python3 batch_planner.py run --plan <plan> --index <batch>
+"""
+import argparse
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+Unit = Dict[str, str]
+
+
+def read_subject_list(file: str) -> List[str]:
+    with open(file, 'r') as f:
+        return f.read().split()
+
+
+def read_stage(file: str) -> Dict:
+    with open(file, 'r') as f:
+        stage = json.load(f)
+    for key in ('name', 'kind', 'log_dir'):
+        if key not in stage:
+            raise ValueError(f'Stage definition {file} has no "{key}"')
+    if stage['kind'] not in ('matlab', 'shell'):
+        raise ValueError(f'Unknown stage kind {stage["kind"]}, expected matlab or shell')
+    return stage
+
+
+def units(subjects: List[str], fields: Dict[str, List[str]]) -> List[Unit]:
+    """Every combination of a subject and the values of the other fields"""
+    names = list(fields)
+    return [dict(zip(['subject'] + names, values))
+            for values in itertools.product(subjects, *(fields[name] for name in names))]
+
+
+def is_done(stage: Dict, unit: Unit) -> bool:
+    outputs = stage.get('outputs', [])
+    return bool(outputs) and all(os.path.exists(output.format(**unit)) for output in outputs)
+
+
+def plan(stage: Dict, subjects: List[str], force: bool = False) -> List[List[Unit]]:
+    """:return: batches of the units that are not done yet"""
+    todo = [unit for unit in units(subjects, stage.get('units', {})) if force or not is_done(stage, unit)]
+    size = max(1, int(stage.get('units_per_job', 1)))
+    return [todo[i:i + size] for i in range(0, len(todo), size)]
+
+
+def plan_path(stage: Dict) -> Path:
+    return Path(stage['log_dir']) / f'{stage["name"]}_plan.json'
+
+
+def write_plan(stage: Dict, batches: List[List[Unit]]) -> Path:
+    file = plan_path(stage)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file.with_name(file.name + '.tmp')
+    with open(str(tmp_file), 'w') as f:
+        json.dump({'stage': stage, 'batches': batches}, f, indent=1)
+    os.replace(str(tmp_file), str(file))
+    return file
+
+
+def matlab_quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def matlab_command(stage: Dict, batch: List[Unit]) -> List[str]:
+    """
+    One MATLAB session for all units of :param batch:. Each unit runs make_sid_matlabbatch.m and spm_jobman,
+    as spm_job.sh does for one subject, and an error in one unit does not stop the others.
+    """
+    subs = ' '.join(matlab_quote(unit['subject']) for unit in batch)
+    scripts = ' '.join(matlab_quote(stage['script'].format(**unit)) for unit in batch)
+    replacesid = matlab_quote(str(stage.get('replacesid', '')))
+    statements = (f"clear; addpath({matlab_quote(stage['spm_path'])}); spm_jobman('initcfg'); "
+                  f"subs = {{{subs}}}; scripts = {{{scripts}}}; failed = 0; "
+                  f"for unit = 1:numel(subs), "
+                  f"clear matlabbatch; sub = subs{{unit}}; script_file = scripts{{unit}}; replacesid = {replacesid}; "
+                  f"fprintf('%s\\n', repmat('-', 1, 79)); fprintf('%s\\nRunning %s\\n', sub, script_file); "
+                  f"try, run('make_sid_matlabbatch.m'); spm_jobman('run', matlabbatch); "
+                  f"catch err, failed = failed + 1; disp(getReport(err)); end; end; "
+                  f"exit(min(failed, 1))")
+    options = ['-nosplash', '-nodisplay', '-nodesktop']
+    if stage.get('single_comp_thread', True):
+        options.append('-singleCompThread')
+    return ['matlab'] + options + ['-r', statements]
+
+
+def run_batch(stage: Dict, batch: List[Unit]) -> int:
+    """Run every unit of :param batch: in this process's working directory. :return: number of failed units"""
+    working_dir = stage.get('working_dir') or None
+    if stage['kind'] == 'matlab':
+        return 0 if subprocess.call(matlab_command(stage, batch), cwd=working_dir) == 0 else len(batch)
+
+    failed = 0
+    for unit in batch:
+        environment = dict(os.environ)
+        environment.update({key: value.format(**unit) for key, value in stage.get('environment', {}).items()})
+        command = stage['command'].format(**unit)
+        print('-' * 79, flush=True)
+        print(f'{unit}: {command}', flush=True)
+        if subprocess.call(command, shell=True, cwd=working_dir, env=environment) != 0:
+            failed += 1
+    return failed
+
+
+def batch_command(plan_file: Path, index: str) -> str:
+    """Shell command that runs one batch of a plan"""
+    return ' '.join([shlex.quote(sys.executable), shlex.quote(str(Path(__file__).resolve())), 'run',
+                     '--plan', shlex.quote(str(plan_file.resolve())), '--index', index])
+
+
+def setup_lines(stage: Dict) -> List[str]:
+    return list(stage.get('setup', []))
+
+
+class SlurmBackend:
+    """Write one SLURM array job with a task per batch, and submit it if asked to"""
+    def __init__(self, submit: bool = False):
+        self.submit = submit
+
+    def run(self, stage: Dict, plan_file: Path, num_batches: int):
+        slurm = dict(stage.get('slurm', {}))
+        max_parallel = slurm.pop('max_parallel', None)
+        array = f'0-{num_batches - 1}' + (f'%{max_parallel}' if max_parallel else '')
+        log_dir = Path(stage['log_dir'])
+        lines = ['#!/bin/bash',
+                 f'#SBATCH --job-name={stage["name"]}',
+                 f'#SBATCH --array={array}',
+                 f'#SBATCH --output={log_dir / (stage["name"] + "_%a.log")}']
+        lines += [f'#SBATCH --{option}={value}' for option, value in slurm.items()]
+        lines += [''] + setup_lines(stage) + [batch_command(plan_file, '${SLURM_ARRAY_TASK_ID}')]
+
+        script = log_dir / f'{stage["name"]}_array.sh'
+        with open(str(script), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        print(f'Wrote {script}: {num_batches} array tasks')
+        if self.submit:
+            subprocess.check_call(['sbatch', str(script)])
+
+
+class LocalBackend:
+    """Run the batches on this machine, each in its own worker process, :param jobs: at a time"""
+    def __init__(self, jobs: int = 1):
+        self.jobs = jobs
+
+    def run(self, stage: Dict, plan_file: Path, num_batches: int):
+        log_dir = Path(stage['log_dir'])
+
+        def run_one(index: int) -> int:
+            script = '\n'.join(setup_lines(stage) + [batch_command(plan_file, str(index))])
+            with open(str(log_dir / f'{stage["name"]}_{index}.log'), 'w') as log:
+                return subprocess.call(['bash', '-c', script], stdout=log, stderr=subprocess.STDOUT)
+
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+            codes = list(executor.map(run_one, range(num_batches)))
+        failed = [index for index, code in enumerate(codes) if code != 0]
+        print(f'Ran {num_batches} batches, {len(failed)} with failures' +
+              (f': see {stage["name"]}_<batch>.log in {log_dir} for batches {failed}' if failed else ''))
+
+
+def main_plan(args):
+    stage = read_stage(args.stage_file)
+    subjects = read_subject_list(args.subject_list)
+    batches = plan(stage, subjects, args.force)
+    num_units = sum(len(batch) for batch in batches)
+    print(f'{stage["name"]}: {num_units} units to run in {len(batches)} batches')
+    if args.dry_run or not batches:
+        for index, batch in enumerate(batches):
+            print(f'{index}: {" ".join("/".join(unit.values()) for unit in batch)}')
+        return
+
+    plan_file = write_plan(stage, batches)
+    backend = SlurmBackend(args.submit) if args.backend == 'slurm' else LocalBackend(args.jobs)
+    backend.run(stage, plan_file, len(batches))
+
+
+def main_run(args):
+    with open(args.plan_file, 'r') as f:
+        saved = json.load(f)
+    failed = run_batch(saved['stage'], saved['batches'][int(args.index)])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    description = 'Run the units of a pipeline stage in batches, on SLURM or locally'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser('plan', help='batch the units of a stage and run or submit them',
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    plan_parser.add_argument('-d', '--stage', metavar='Stage definition', action='store',
+                             type=str, required=True,
+                             help='JSON stage definition.',
+                             dest='stage_file')
+    plan_parser.add_argument('-s', '--subjects', metavar='Subject list', action='store',
+                             type=str, required=True,
+                             help='file listing subject IDs, separated by whitespace.',
+                             dest='subject_list')
+    plan_parser.add_argument('-b', '--backend', action='store',
+                             choices=('slurm', 'local'), required=False, default='slurm',
+                             help='write a SLURM array job, or run the batches on this machine.',
+                             dest='backend')
+    plan_parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                             type=int, required=False, default=1,
+                             help='number of batches to run at once with the local backend.',
+                             dest='jobs')
+    plan_parser.add_argument('--submit', action='store_true',
+                             help='submit the SLURM array job with sbatch.',
+                             dest='submit')
+    plan_parser.add_argument('-f', '--force', action='store_true',
+                             help='run units whose outputs already exist.',
+                             dest='force')
+    plan_parser.add_argument('-n', '--dry-run', action='store_true',
+                             help='print the batches without writing or running anything.',
+                             dest='dry_run')
+
+    run_parser = subparsers.add_parser('run', help='run one batch of a plan',
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    run_parser.add_argument('-p', '--plan', metavar='Plan', action='store',
+                            type=str, required=True,
+                            help='plan written by the plan command.',
+                            dest='plan_file')
+    run_parser.add_argument('-i', '--index', metavar='Batch', action='store',
+                            type=str, required=True,
+                            help='index of the batch to run, e.g. ${SLURM_ARRAY_TASK_ID}.',
+                            dest='index')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        main_plan(args)
+    else:
+        main_run(args)
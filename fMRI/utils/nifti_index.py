@@ -0,0 +1,259 @@
+"""
+Index of NIfTI-1 image metadata (dimensions, number of volumes, voxel size, TR and affine), read from the
+348-byte headers only, so that stages which need image geometry do not open image data, or call 3dinfo.
+
+For .nii.gz files, only the start of the gzip stream is decompressed. The index is a JSON file of
+    {absolute path: {'mtime_ns': ..., 'size': ..., 'dims': [...], 'num_volumes': ..., 'voxel_size': [...],
+                     'tr': ..., 'datatype': ..., 'affine': [[...], ...]}}
+and an update only reads the headers of files that are new, or whose modification time or size changed.
+
+From the shell, e.g. to number the residuals of each run as 3dinfo -nv does:
+    python3 nifti_index.py update -x ${BIDS_DIR}/.nifti_index.json -r ${BIDS_DIR}
+    nvols=$(python3 nifti_index.py query -x ${BIDS_DIR}/.nifti_index.json -f nv ${file})
+and from Python:
+    index = NiftiIndex(index_file)
+    index.get(file).num_volumes
+"""
+import argparse
+import gzip
+import json
+import math
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+HEADER_SIZE = 348
+INDEX_NAME = '.nifti_index.json'
+# BOLD runs of the BIDS tree, and first level model output (con, beta, mask and residual images)
+DEFAULT_PATTERNS = ['sub-*/ses-*/func/*_bold.nii.gz', 'sub-*/fx/**/*.nii']
+
+# Scale of the xyzt_units codes to mm and seconds
+SPACE_UNITS = {1: 1000.0, 2: 1.0, 3: 0.001}
+TIME_UNITS = {8: 1.0, 16: 0.001, 24: 1e-6}
+
+
+class Header(NamedTuple):
+    mtime_ns: int
+    size: int
+    dims: List[int]
+    num_volumes: int
+    voxel_size: List[float]  # mm
+    tr: float  # seconds, 0 for 3D images
+    datatype: int  # NIfTI datatype code, e.g. 16 for float32
+    affine: List[List[float]]  # voxel to world (mm) transform, as nibabel's Nifti1Image.affine
+
+
+def quaternion_affine(b: float, c: float, d: float, qfac: float, pixdim: List[float],
+                      offset: List[float]) -> List[List[float]]:
+    """The qform affine, from the quaternion, the voxel size and the offset"""
+    a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+    scale = [pixdim[1], pixdim[2], pixdim[3] * qfac]
+    return [[rotation[i][j] * scale[j] for j in range(3)] + [offset[i]] for i in range(3)] + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def base_affine(dims: List[int], pixdim: List[float]) -> List[List[float]]:
+    """Affine of an image without qform or sform: voxel size scaling, centered, with x flipped (as nibabel)"""
+    shape = (list(dims[:3]) + [1, 1, 1])[:3]
+    zooms = [pixdim[1], pixdim[2], pixdim[3]]
+    signs = [-1.0, 1.0, 1.0]
+    return [[signs[i] * zooms[i] if j == i else 0.0 for j in range(3)] + [-signs[i] * zooms[i] * (shape[i] - 1) / 2.0]
+            for i in range(3)] + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def parse_header(data: bytes) -> Dict:
+    """:return: dims, num_volumes, voxel_size, tr, datatype and affine of a NIfTI-1 header"""
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f'NIfTI header is {len(data)} bytes, expected {HEADER_SIZE}')
+    for endian in ('<', '>'):
+        if struct.unpack_from(endian + 'i', data, 0)[0] == HEADER_SIZE:
+            break
+    else:
+        raise ValueError('not a NIfTI-1 header (sizeof_hdr is not 348)')
+
+    dim = struct.unpack_from(endian + '8h', data, 40)
+    datatype = struct.unpack_from(endian + 'h', data, 70)[0]
+    pixdim = list(struct.unpack_from(endian + '8f', data, 76))
+    xyzt_units = data[123]
+    qform_code, sform_code = struct.unpack_from(endian + '2h', data, 252)
+    quatern = struct.unpack_from(endian + '6f', data, 256)
+    srows = struct.unpack_from(endian + '12f', data, 280)
+
+    dims = list(dim[1:max(1, min(dim[0], 7)) + 1])
+    num_volumes = dims[3] if len(dims) > 3 else 1
+    space_scale = SPACE_UNITS.get(xyzt_units & 0x07, 1.0)
+    time_scale = TIME_UNITS.get(xyzt_units & 0x38, 1.0)
+    voxel_size = [abs(v) * space_scale for v in pixdim[1:4]]
+    tr = pixdim[4] * time_scale if len(dims) > 3 else 0.0
+
+    if sform_code > 0:
+        affine = [list(srows[0:4]), list(srows[4:8]), list(srows[8:12]), [0.0, 0.0, 0.0, 1.0]]
+    elif qform_code > 0:
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        affine = quaternion_affine(quatern[0], quatern[1], quatern[2], qfac, pixdim, list(quatern[3:6]))
+    else:
+        affine = base_affine(dims, pixdim)
+    return {'dims': dims, 'num_volumes': num_volumes, 'voxel_size': voxel_size, 'tr': tr,
+            'datatype': datatype, 'affine': affine}
+
+
+def read_header(file: str, stat: Optional[os.stat_result] = None) -> Header:
+    """Read the header of :param file:, decompressing only its first bytes if it is gzipped"""
+    stat = stat or os.stat(file)
+    opener = gzip.open if file.endswith('.gz') else open
+    with opener(file, 'rb') as f:
+        data = f.read(HEADER_SIZE)
+    return Header(mtime_ns=stat.st_mtime_ns, size=stat.st_size, **parse_header(data))
+
+
+def find_files(root: str, patterns: List[str]) -> List[str]:
+    files = set()
+    for pattern in patterns:
+        files.update(os.path.abspath(str(f)) for f in Path(root).glob(pattern) if f.is_file())
+    return sorted(files)
+
+
+class NiftiIndex:
+    """Header metadata of NIfTI files, persisted in :param index_file:"""
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        try:
+            with open(index_file, 'r') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def lookup(self, file: str, stat: os.stat_result) -> Optional[Header]:
+        """:return: the indexed header of :param file:, if the file has not changed since it was indexed"""
+        entry = self.entries.get(file)
+        if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        return Header(**entry)
+
+    def get(self, file: str) -> Header:
+        """
+        :return: the header of :param file:, from the index if it is up to date, or else from the file.
+        Headers read here are added to the index in memory; save() writes them.
+        """
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        header = self.lookup(file, stat)
+        if header is None:
+            header = read_header(file, stat)
+            self.entries[file] = header._asdict()
+        return header
+
+    def update(self, root: str, patterns: List[str], jobs: int = 16, prune: bool = True) -> int:
+        """
+        Index the files under :param root: matching :param patterns:, reading headers of new and changed files
+        concurrently in a thread pool. With :param prune:, entries of files under root that no longer exist are
+        removed. :return: number of headers read
+        """
+        files = find_files(root, patterns)
+        stats = {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for file, stat in zip(files, executor.map(os.stat, files)):
+                if self.lookup(file, stat) is None:
+                    stats[file] = stat
+            headers = list(executor.map(read_header, list(stats), list(stats.values())))
+        for file, header in zip(stats, headers):
+            self.entries[file] = header._asdict()
+
+        if prune:
+            prefix = os.path.join(os.path.abspath(root), '')
+            for file in [f for f in self.entries if f.startswith(prefix) and not os.path.exists(f)]:
+                del self.entries[file]
+        return len(headers)
+
+    def save(self):
+        """Write the index to a temporary file first, so an interrupted write does not leave a truncated index"""
+        tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.index_file)
+
+
+def format_field(header: Header, field: str) -> str:
+    """A field of :param header: as text for the shell, with 3dinfo names (nv, tr, ...) where there is one"""
+    if field == 'nv':
+        return str(header.num_volumes)
+    if field == 'tr':
+        return f'{header.tr:g}'
+    if field in ('dims', 'voxel_size'):
+        return ' '.join(f'{v:g}' for v in getattr(header, field))
+    if field == 'affine':
+        return ' '.join(f'{v:g}' for row in header.affine for v in row)
+    return str(getattr(header, field))
+
+
+def main_update(args):
+    index = NiftiIndex(args.index_file or os.path.join(args.root, INDEX_NAME))
+    num_read = index.update(args.root, args.patterns, args.jobs)
+    index.save()
+    print(f'Indexed {len(index.entries)} files in {index.index_file}, read {num_read} headers')
+
+
+def main_query(args):
+    index = NiftiIndex(args.index_file)
+    for file in args.files:
+        header = index.get(file)
+        print(format_field(header, args.field))
+    if args.save:
+        index.save()
+
+
+if __name__ == "__main__":
+    description = 'Index NIfTI header metadata, and query it from shell scripts'
+
+    parser = argparse.ArgumentParser(description=description,
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    update_parser = subparsers.add_parser('update', help='index new and changed files under a directory',
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    update_parser.add_argument('-r', '--root', metavar='Root directory', action='store',
+                               type=str, required=True,
+                               help='directory searched for NIfTI files, e.g. bids_data or the fx model directory.',
+                               dest='root')
+    update_parser.add_argument('-x', '--index', metavar='Index file', action='store',
+                               type=str, required=False, default=None,
+                               help=f'index file. By default, {INDEX_NAME} in the root directory.',
+                               dest='index_file')
+    update_parser.add_argument('-p', '--patterns', metavar='Pattern', action='store', nargs='+',
+                               type=str, required=False, default=DEFAULT_PATTERNS,
+                               help='glob patterns of files to index, relative to the root directory.',
+                               dest='patterns')
+    update_parser.add_argument('-j', '--jobs', metavar='Number of jobs', action='store',
+                               type=int, required=False, default=16,
+                               help='number of headers to read at once.',
+                               dest='jobs')
+
+    query_parser = subparsers.add_parser('query', help='print a field of each file, one line per file',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    query_parser.add_argument('-x', '--index', metavar='Index file', action='store',
+                              type=str, required=True,
+                              help='index file. Files that are not in it, or changed, are read directly.',
+                              dest='index_file')
+    query_parser.add_argument('-f', '--field', action='store',
+                              choices=('nv', 'dims', 'voxel_size', 'tr', 'affine', 'datatype'),
+                              required=False, default='nv',
+                              help='field to print.',
+                              dest='field')
+    query_parser.add_argument('--save', action='store_true',
+                              help='add headers read directly to the index. Concurrent jobs should not save.',
+                              dest='save')
+    query_parser.add_argument('files', metavar='File', nargs='+',
+                              type=str,
+                              help='NIfTI files.')
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        main_update(args)
+    else:
+        main_query(args)